@@ -0,0 +1,317 @@
+"""
+Matching of IRC hostmask globs and extbans, such as the entries of a ban list,
+against users.
+
+Masks are nick!user@host globs where * matches any number of characters and
+? matches exactly one, compared case insensitively with the rfc1459 case
+mapping. Of the extbans, $a (logged in), $a:<account glob> and their negated
+forms ($~a) are understood. Other extbans never match.
+
+There are two indexes, for the two directions a lookup can go in:
+
+* MaskIndex holds masks and answers which of them match a given user. Most
+  bans are either on an exact host or on a domain (*.example.net), so masks
+  are filed by host: literal hosts in a dict, and hosts of the form
+  *.<domain> in a trie keyed on the domain's labels in reverse. Looking up a
+  user only checks the masks filed under their host and the domains it's in,
+  plus the few masks with other wildcards in the host.
+
+* UserIndex holds users and answers which of them a given mask matches. Users
+  are filed in the same kind of trie by their host, so a mask on a literal
+  host or a *.<domain> only checks the users under it.
+
+Either way, the candidates found are checked against the whole mask before
+they are returned.
+
+"""
+import re
+
+_LOWER = dict(zip(map(ord, "ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~"),
+    "abcdefghijklmnopqrstuvwxyz{}|^"))
+
+def irc_lower(s):
+    """Lowercases a string using the rfc1459 case mapping, where []\\~ are the
+    uppercase forms of {}|^
+
+    """
+    return s.translate(_LOWER)
+
+def normalize_mask(mask):
+    """Expands a ban mask the way servers do when it's set, so it can be
+    compared with the masks in a channel's lists: "nick" becomes
+    "nick!*@*" and "user@host" becomes "*!user@host". Extbans (starting with
+    $) are left alone.
+
+    """
+    if mask.startswith("$"):
+        return mask
+    if "!" not in mask and "@" not in mask:
+        return mask + "!*@*"
+    if "!" not in mask:
+        return "*!" + mask
+    if "@" not in mask:
+        return mask + "@*"
+    return mask
+
+def mask_key(mask):
+    """Returns the form of a mask that compares equal to every form of it the
+    server would consider the same: normalized and lowercased
+
+    """
+    mask = normalize_mask(mask)
+    if mask.startswith("$"):
+        # ~ negates an extban. It's not ^ in uppercase.
+        return mask.lower()
+    return irc_lower(mask)
+
+_compiled = {}
+
+def compile_glob(glob):
+    """Returns a compiled regular expression that matches the same
+    (lowercased) strings as the given glob
+
+    """
+    glob = irc_lower(glob)
+    try:
+        return _compiled[glob]
+    except KeyError:
+        pass
+    regex = re.compile("".join(
+        ".*" if c == "*" else "." if c == "?" else re.escape(c)
+        for c in glob) + r"\Z", re.S)
+    if len(_compiled) > 4096:
+        _compiled.clear()
+    _compiled[glob] = regex
+    return regex
+
+def match(glob, string):
+    """Tells whether the glob matches the string"""
+    return compile_glob(glob).match(irc_lower(string)) is not None
+
+def _has_wildcards(s):
+    return "*" in s or "?" in s
+
+def _labels(host):
+    """A lowercased host's labels, in reverse: ("net", "example", "www")"""
+    return tuple(reversed(host.split(".")))
+
+def _host_key(host):
+    """Says how a lowercased mask host can be filed. Returns ("literal",
+    labels) for hosts without wildcards, ("domain", labels) for * and
+    *.<domain> where the domain has no wildcards, and ("other", None) for
+    anything else.
+
+    """
+    if not _has_wildcards(host):
+        return "literal", _labels(host)
+    if host == "*":
+        return "domain", ()
+    if host.startswith("*.") and not _has_wildcards(host[2:]):
+        return "domain", _labels(host[2:])
+    return "other", None
+
+def _extban_matches(extban, account):
+    """Tells whether an extban matches a user logged in as account (None if
+    they aren't). Extbans we don't understand never match.
+
+    """
+    negated = extban.startswith("$~")
+    kind, _, arg = extban[2 if negated else 1:].partition(":")
+    if kind != "a":
+        return False
+    if arg:
+        matched = account is not None and match(arg, account)
+    else:
+        matched = account is not None
+    return matched != negated
+
+class _LabelTrie(object):
+    """A trie keyed on the labels of hostnames in reverse. Each node has a set
+    of items filed at exactly that node.
+
+    """
+    def __init__(self):
+        self.children = {}
+        self.items = set()
+
+    def add(self, labels, item):
+        node = self
+        for label in labels:
+            node = node.children.setdefault(label, _LabelTrie())
+        node.items.add(item)
+
+    def discard(self, labels, item):
+        path = [self]
+        for label in labels:
+            node = path[-1].children.get(label)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].items.discard(item)
+        # Prune nodes that are now empty
+        for parent, label, node in reversed(list(zip(path, labels, path[1:]))):
+            if node.items or node.children:
+                break
+            del parent.children[label]
+
+    def node(self, labels):
+        node = self
+        for label in labels:
+            node = node.children.get(label)
+            if node is None:
+                return None
+        return node
+
+    def along(self, labels):
+        """Yields the item sets of the nodes along the path to labels,
+        starting at the root, as (depth, items) tuples
+
+        """
+        node = self
+        yield 0, node.items
+        for depth, label in enumerate(labels, 1):
+            node = node.children.get(label)
+            if node is None:
+                return
+            yield depth, node.items
+
+    def under(self):
+        """Yields the item sets of this node and all nodes below it"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node.items
+            stack.extend(node.children.values())
+
+class MaskIndex(object):
+    """An index of masks, such as the entries of a ban list, for finding the
+    ones that match a user. Masks are added as they would be set, and
+    normalized like the server would (see normalize_mask()).
+
+    """
+    def __init__(self, masks=()):
+        # Maps lowercased normalized masks to the masks as added
+        self.masks = {}
+        self.literal = {}
+        self.domains = _LabelTrie()
+        self.other = set()
+        self.extbans = set()
+        for mask in masks:
+            self.add(mask)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __iter__(self):
+        return iter(self.masks.values())
+
+    def __contains__(self, mask):
+        return mask_key(mask) in self.masks
+
+    def _file(self, key):
+        """Returns the kind of place a lowercased mask is filed in and where"""
+        if key.startswith("$"):
+            return "extban", None
+        return _host_key(key.rpartition("@")[2])
+
+    def add(self, mask):
+        key = mask_key(mask)
+        if key in self.masks:
+            return
+        self.masks[key] = mask
+        kind, labels = self._file(key)
+        if kind == "extban":
+            self.extbans.add(key)
+        elif kind == "literal":
+            self.literal.setdefault(labels, set()).add(key)
+        elif kind == "domain":
+            self.domains.add(labels, key)
+        else:
+            self.other.add(key)
+
+    def discard(self, mask):
+        key = mask_key(mask)
+        if self.masks.pop(key, None) is None:
+            return
+        kind, labels = self._file(key)
+        if kind == "extban":
+            self.extbans.discard(key)
+        elif kind == "literal":
+            keys = self.literal.get(labels)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.literal[labels]
+        elif kind == "domain":
+            self.domains.discard(labels, key)
+        else:
+            self.other.discard(key)
+
+    def matches(self, hostmask, account=None):
+        """Returns the masks that match the user with the given
+        nick!user@host, who is logged in as account (None if they aren't)
+
+        """
+        lhostmask = irc_lower(hostmask)
+        labels = _labels(lhostmask.rpartition("@")[2])
+
+        candidates = set(self.literal.get(labels, ()))
+        for depth, keys in self.domains.along(labels):
+            # *.example.net needs at least one more label than example.net
+            if depth < len(labels) or depth == 0:
+                candidates.update(keys)
+        candidates.update(self.other)
+
+        found = [self.masks[key] for key in candidates
+                if compile_glob(key).match(lhostmask)]
+        found.extend(self.masks[key] for key in self.extbans
+                if _extban_matches(key, account))
+        return found
+
+class UserIndex(object):
+    """An index of users, such as the members of our channels, for finding
+    the ones a mask matches. Users are added by their nick!user@host, along
+    with the account they are logged in as, if any.
+
+    """
+    def __init__(self):
+        # Maps lowercased hostmasks to (hostmask, account) tuples
+        self.users = {}
+        self.hosts = _LabelTrie()
+
+    def __len__(self):
+        return len(self.users)
+
+    def add(self, hostmask, account=None):
+        key = irc_lower(hostmask)
+        self.users[key] = (hostmask, account)
+        self.hosts.add(_labels(key.rpartition("@")[2]), key)
+
+    def discard(self, hostmask):
+        key = irc_lower(hostmask)
+        if self.users.pop(key, None) is not None:
+            self.hosts.discard(_labels(key.rpartition("@")[2]), key)
+
+    def matching(self, mask):
+        """Returns the hostmasks of the users that mask matches"""
+        key = mask_key(mask)
+        if key.startswith("$"):
+            return [hostmask for hostmask, account in self.users.values()
+                    if _extban_matches(key, account)]
+
+        kind, labels = _host_key(key.rpartition("@")[2])
+        if kind == "literal":
+            node = self.hosts.node(labels)
+            candidates = node.items if node is not None else ()
+        elif kind == "domain":
+            node = self.hosts.node(labels)
+            candidates = set()
+            if node is not None:
+                for keys in node.under():
+                    candidates.update(keys)
+        else:
+            candidates = self.users
+
+        regex = compile_glob(key)
+        return [self.users[user][0] for user in candidates
+                if regex.match(user)]
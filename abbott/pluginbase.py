@@ -225,9 +225,15 @@ class BotPlugin(object):
     The REQUIRES class variable should be set to a list of plugins that this
     one depends on.
 
+    Plugins that handle the batch events the IRC plugin sends for bursts
+    (irc.on_mode_change_batch, irc.on_netsplit, irc.on_netjoin) can list the
+    single events they cover in BATCHED_EVENTS. Those events are then not
+    dispatched to on_event_* methods when marked batched.
+
     """
     REQUIRES = []
     DEFAULT_CONFIG = {}
+    BATCHED_EVENTS = ()
     def __init__(self, plugin_name, transport, pluginboss):
         self.plugin_name = plugin_name
         self.transport = transport
@@ -275,6 +281,9 @@ class BotPlugin(object):
 
     def received_event(self, event):
         """An event has been received by this plugin"""
+        if event.eventtype in self.BATCHED_EVENTS and \
+                getattr(event, "batched", False):
+            return
         method = getattr(self, "on_event_%s" % event.eventtype.replace(".","_"), None)
         if method:
             method(event)
@@ -1,6 +1,6 @@
 # encoding: UTF-8
 from __future__ import unicode_literals
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 import time
 import random
 import re
@@ -37,10 +37,23 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
 
     ALSO provides an interface to timed quiets for other plugins.
 
+    To turn nicks into ban masks without a whois each time, it remembers the
+    nick!user@host of everyone it sees join, talk or change nick, and the
+    ones in NAMES, WHO and WHOIS replies, up to hostmask_cache_size of the
+    most recently seen. Users are forgotten when they quit, or when they
+    haven't been seen for hostmask_cache_ttl seconds. Hostmasks known to the
+    ircutil.AccountTracker plugin take precedence.
+
     """
     REQUIRES = ["ircop.OpProvider"]
     DEFAULT_CONFIG = {
             "defaulttime": None,
+            "hostmask_cache_size": 1000,
+            "hostmask_cache_ttl": 600,
+            # kickmatch refuses to kick more users than this, or more than
+            # this fraction of the channel, without --force
+            "kickmatch_max": 5,
+            "kickmatch_max_fraction": 0.25,
             }
 
     def __init__(self, *args):
@@ -51,6 +64,9 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
         # given channel with the given parameter
         self.later_timers = {}
 
+        # Maps lowercased nicks to (nick!user@host, when last seen) tuples,
+        # least recently seen first
+        self.hostmask_cache = OrderedDict()
 
         super(IRCAdmin, self).__init__(*args)
 
@@ -210,6 +226,9 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
         self._set_all_timers()
 
         self.listen_for_event("irc.on_mode_change")
+        for event in ("irc.on_user_joined", "irc.on_notice", "irc.on_action",
+                "irc.on_nick_change", "irc.on_user_quit", "irc.on_unknown"):
+            self.listen_for_event(event)
 
         self.provides_request("ircadmin.timedquiet")
 
@@ -350,6 +369,129 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
                 helptext="OPs you for a few seconds, to show off your powah!",
                 )
 
+        # Commands acting on everyone matching a mask
+        self.install_command(
+                cmdname="whomatch",
+                cmdusage="<hostmask>",
+                argmatch="(?P<mask>[^ ]+)$",
+                permission="irc.op.ban",
+                callback=self.whomatch,
+                helptext="Lists who in the channel a hostmask or extban matches",
+                )
+        self.install_command(
+                cmdname="kickmatch",
+                cmdusage="[--force] <hostmask> [reason]",
+                argmatch="(?P<force>--force )?(?P<mask>[^ ]+)(?: (?P<reason>.*))?$",
+                permission="irc.op.kick",
+                callback=self.kickmatch,
+                helptext="Kicks everyone in the channel a hostmask or extban "
+                    "matches. Masks matching too many users need --force",
+                )
+        self.install_command(
+                cmdname="unbanall",
+                cmdusage="<nick or hostmask>",
+                argmatch="(?P<nick>[^ ]+)$",
+                permission="irc.op.ban",
+                callback=self.unbanall,
+                helptext="Removes every ban that matches a user",
+                )
+        self.install_command(
+                cmdname="unquietall",
+                cmdusage="<nick or hostmask>",
+                argmatch="(?P<nick>[^ ]+)$",
+                permission="irc.op.quiet",
+                callback=self.unquietall,
+                helptext="Removes every quiet that matches a user",
+                )
+
+    def _cache_hostmask(self, hostmask):
+        if "!" not in hostmask or "@" not in hostmask:
+            return
+        nick = hostmask.split("!",1)[0].lower()
+        self.hostmask_cache.pop(nick, None)
+        self.hostmask_cache[nick] = (hostmask, time.time())
+        while len(self.hostmask_cache) > self.config['hostmask_cache_size']:
+            self.hostmask_cache.popitem(last=False)
+
+    def on_event_irc_on_privmsg(self, event):
+        super(IRCAdmin, self).on_event_irc_on_privmsg(event)
+        self._cache_hostmask(event.user)
+
+    def on_event_irc_on_notice(self, event):
+        self._cache_hostmask(event.user)
+    on_event_irc_on_action = on_event_irc_on_notice
+
+    def on_event_irc_on_user_joined(self, event):
+        hostmask = getattr(event, "hostmask", None)
+        if hostmask:
+            self._cache_hostmask(hostmask)
+
+    def on_event_irc_on_nick_change(self, event):
+        cached = self.hostmask_cache.pop(event.oldnick.lower(), None)
+        if cached is not None:
+            self._cache_hostmask(event.newnick + "!" + cached[0].split("!",1)[1])
+
+    def on_event_irc_on_user_quit(self, event):
+        self.hostmask_cache.pop(event.user.split("!",1)[0].lower(), None)
+
+    def on_event_irc_on_unknown(self, event):
+        """Picks hostmasks out of NAMES (with userhost-in-names), WHO, WHOX and
+        WHOIS replies
+
+        """
+        params = event.params
+        if event.command == "RPL_NAMREPLY" and len(params) > 3:
+            for entry in params[3].split():
+                self._cache_hostmask(entry.lstrip("~&@%+"))
+        elif event.command == "RPL_WHOREPLY" and len(params) > 5:
+            self._cache_hostmask("{0}!{1}@{2}".format(params[5], params[2],
+                params[3]))
+        elif event.command == "RPL_WHOISUSER" and len(params) > 3:
+            self._cache_hostmask("{0}!{1}@{2}".format(params[1], params[2],
+                params[3]))
+        elif (event.command == "354" and len(params) == 8 and
+                params[1] == ircutil.AccountTracker.WHOX_TOKEN):
+            self._cache_hostmask("{0}!{1}@{2}".format(params[5], params[3],
+                params[4]))
+
+    @defer.inlineCallbacks
+    def _lookup_hostmask(self, nick):
+        """Returns a deferred that fires with the nick!user@host of a nick:
+        from the AccountTracker plugin if it knows, from our cache if we've
+        seen them, and otherwise with a whois. Raises the whois errors if it
+        comes to that.
+
+        The AccountTracker goes first since it forgets users as they leave
+        our channels, while our cache only forgets them when they quit, fall
+        out of it or haven't been seen for hostmask_cache_ttl seconds, so it
+        may hold the hostmask of someone who has since left and been replaced
+        under the same nick.
+
+        """
+        try:
+            hostmask = (yield self.transport.issue_request("irc.hostmask", nick))
+        except NotImplementedError:
+            hostmask = None
+        if hostmask:
+            self._cache_hostmask(hostmask)
+            defer.returnValue(hostmask)
+
+        cached = self.hostmask_cache.get(nick.lower())
+        if cached is not None and \
+                time.time() - cached[1] < self.config['hostmask_cache_ttl']:
+            # Move it to the end, as the most recently used
+            self.hostmask_cache[nick.lower()] = \
+                    self.hostmask_cache.pop(nick.lower())
+            defer.returnValue(cached[0])
+
+        whois_results = (yield self.transport.issue_request("irc.whois",
+                nick, priority="op"))
+        whoisuser = whois_results['RPL_WHOISUSER']
+        hostmask = "{0}!{1}@{2}".format(*whoisuser[:3])
+
+        self._cache_hostmask(hostmask)
+        defer.returnValue(hostmask)
+
     @defer.inlineCallbacks
     def _nick_to_hostmask(self, nick):
         """Takes a nick or a hostmask and returns a parameter suitable for the
@@ -357,9 +499,11 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
 
         If the items given looks like a hostmask (contains a ! and a @) then
         it is returned. If the item is an extban (starts with a $), then that
-        is returned. Otherwise, it is assumed the parameter is a nickname and a
-        whois is performed and the hostmask is returned with the first two
-        fields wildcarded.
+        is returned. Otherwise, it is assumed the parameter is a nickname and
+        its hostmask is looked up, and returned with the first two fields
+        wildcarded. Users in our channels are usually already known to the
+        ircutil.AccountTracker plugin or in our own cache; for anyone else a
+        whois is performed.
 
         This methed is intended to allow bans and quiets to match any nick!user
         combination by banning/quieting all users from that host.
@@ -376,11 +520,9 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
             defer.returnValue(nick)
             return
 
-        whois_results = (yield self.transport.issue_request("irc.whois", nick))
-
-        whoisuser = whois_results['RPL_WHOISUSER']
-
-        nick, username, host = whoisuser[0], whoisuser[1], whoisuser[2]
+        hostmask = (yield self._lookup_hostmask(nick))
+        nick, userhost = hostmask.split("!", 1)
+        username, host = userhost.split("@", 1)
 
         if host.startswith("gateway/web/freenode/ip."):
             nick = "*"
@@ -402,6 +544,139 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
 
         defer.returnValue(mask)
 
+    @defer.inlineCallbacks
+    def _full_hostmask(self, nick):
+        """Takes a nick or a hostmask and returns a deferred that fires with a
+        (nick!user@host, account) tuple for the user, where account is None
+        if they aren't logged in or we don't know. Unlike
+        _nick_to_hostmask(), nothing is wildcarded.
+
+        May raise the same errors as _nick_to_hostmask()
+
+        """
+        if "!" in nick and "@" in nick:
+            hostmask = nick
+        else:
+            hostmask = (yield self._lookup_hostmask(nick))
+
+        try:
+            account = (yield self.transport.issue_request("irc.account", hostmask))
+        except (NotImplementedError, ircutil.AccountUnknown):
+            account = None
+        defer.returnValue((hostmask, account))
+
+    @defer.inlineCallbacks
+    def _matching_users(self, event, mask):
+        """Returns a deferred that fires with the nicks in the event's channel
+        that mask matches, not counting us. Replies and fires with None if we
+        can't tell.
+
+        """
+        try:
+            hostmasks = (yield self.transport.issue_request("irc.match_users",
+                mask, event.channel))
+        except NotImplementedError:
+            event.reply("I don't know who's here. Is the ircutil.AccountTracker plugin loaded?")
+            return
+        mynick = (yield self.transport.issue_request("irc.getnick", event.channel))
+        defer.returnValue(sorted(nick for nick in
+            (hostmask.split("!",1)[0] for hostmask in hostmasks)
+            if nick.lower() != mynick.lower()))
+
+    @require_channel
+    @defer.inlineCallbacks
+    def whomatch(self, event, match):
+        nicks = (yield self._matching_users(event, match.groupdict()['mask']))
+        if nicks is None:
+            return
+        if not nicks:
+            event.reply("Nobody here matches that")
+        else:
+            event.reply("Matches: {0}".format(", ".join(nicks)))
+
+    @require_channel
+    @defer.inlineCallbacks
+    def kickmatch(self, event, match):
+        groupdict = match.groupdict()
+        nicks = (yield self._matching_users(event, groupdict['mask']))
+        if nicks is None:
+            return
+        requestor = event.user.split("!",1)[0]
+        nicks = [nick for nick in nicks if nick.lower() != requestor.lower()]
+        if not nicks:
+            event.reply("Nobody here matches that")
+            return
+
+        if not groupdict['force']:
+            try:
+                members = len((yield self.transport.issue_request("irc.names",
+                    event.channel)))
+            except Exception:
+                # No Names plugin, or the server didn't answer in time
+                members = None
+            if len(nicks) > self.config['kickmatch_max'] or (members and
+                    len(nicks) > members * self.config['kickmatch_max_fraction']):
+                event.reply("That matches {0} users{1}. Use --force if you "
+                        "really mean it".format(len(nicks),
+                            " of {0}".format(members) if members else ""))
+                return
+
+        results = (yield self.transport.issue_request("ircop.kick_many",
+            channel=event.channel, targets=nicks, reason=groupdict['reason']))
+        self._reply_failures(event, results)
+
+    @defer.inlineCallbacks
+    def _remove_all(self, event, target, letter):
+        """Removes every entry of the channel's list mode letter (b or q) that
+        matches a user
+
+        """
+        channel = event.channel
+        try:
+            hostmask, account = (yield self._full_hostmask(target))
+        except ircutil.NoSuchNick:
+            event.reply("There is no user by that nick on the network. "
+                        "Try specifying a full hostmask.")
+            return
+        except (ircutil.WhoisTimedout, ircutil.WhoisShed):
+            event.reply("I couldn't look up {0} right now. "
+                        "Try specifying a full hostmask.".format(target))
+            return
+
+        try:
+            entries = (yield self.transport.issue_request("ircop.list", channel,
+                letter, hostmask, account))
+        except ValueError as e:
+            event.reply(str(e))
+            return
+        except Exception as e:
+            log.err(e, "Getting the +{0} list of {1}".format(letter, channel))
+            event.reply("I couldn't get the +{0} list of {1}".format(letter,
+                channel))
+            return
+        if not entries:
+            event.reply("Nothing in the +{0} list matches {1}".format(letter,
+                hostmask))
+            return
+
+        masks = [mask for mask, _, _ in entries]
+        log.msg("-{0} for {1} in {2}".format(letter, " ".join(masks), channel))
+        results = (yield self.transport.issue_request(
+            "ircop.{0}_many".format({"b":"unban","q":"unquiet"}[letter]),
+            channel=channel, targets=masks))
+        self._reply_failures(event, results)
+        removed = [mask for mask in masks if results[mask] is None]
+        if removed:
+            event.reply("Removed {0}".format(", ".join(removed)))
+
+    @require_channel
+    def unbanall(self, event, match):
+        return self._remove_all(event, match.groupdict()['nick'], "b")
+
+    @require_channel
+    def unquietall(self, event, match):
+        return self._remove_all(event, match.groupdict()['nick'], "q")
+
     @require_channel
     @defer.inlineCallbacks
     def kick(self, event, match):
@@ -436,6 +711,30 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
                 target=requestor, reason="woops, my bad!")
             return True
 
+    def _reply_failures(self, event, results):
+        """Takes the per-target results of an ircop.*_many request and replies
+        with each distinct OpFailed message. Targets that failed with other
+        errors are logged and named in a reply of their own.
+
+        """
+        messages = []
+        others = []
+        for target, failure in results.items():
+            if failure is None:
+                continue
+            if not failure.check(ircop.OpFailed):
+                log.err(failure, "ircop request for {0}".format(target))
+                others.append(target)
+                continue
+            message = str(failure.value)
+            if message not in messages:
+                messages.append(message)
+        for message in messages:
+            event.reply(message)
+        if others:
+            event.reply("Something went wrong with {0}".format(
+                ", ".join(str(target) for target in others)))
+
     @require_channel
     @defer.inlineCallbacks
     def voice(self, event, match):
@@ -446,16 +745,9 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
             nicks = groupdict['nicks'].split()
         channel = event.channel
 
-        ds = [
-                self.transport.issue_request("ircop.voice", channel=channel,
-                    target=nick)
-                for nick in nicks
-                ]
-        try:
-            for d in ds:
-                yield d
-        except ircop.OpFailed as e:
-            event.reply(str(e))
+        results = (yield self.transport.issue_request("ircop.voice_many",
+            channel=channel, targets=nicks))
+        self._reply_failures(event, results)
 
     @require_channel
     @defer.inlineCallbacks
@@ -467,16 +759,9 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
             nicks = groupdict['nicks'].split()
         channel = event.channel
 
-        ds = [
-                self.transport.issue_request("ircop.devoice", channel=channel,
-                    target=nick)
-                for nick in nicks
-                ]
-        try:
-            for d in ds:
-                yield d
-        except ircop.OpFailed as e:
-            event.reply(str(e))
+        results = (yield self.transport.issue_request("ircop.devoice_many",
+            channel=channel, targets=nicks))
+        self._reply_failures(event, results)
 
     @require_channel
     @defer.inlineCallbacks
@@ -488,16 +773,9 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
             nicks = groupdict['nicks'].split()
         channel = event.channel
 
-        ds = [
-                self.transport.issue_request("ircop.op", channel=channel,
-                    target=nick)
-                for nick in nicks
-                ]
-        try:
-            for d in ds:
-                yield d
-        except ircop.OpFailed as e:
-            event.reply(str(e))
+        results = (yield self.transport.issue_request("ircop.op_many",
+            channel=channel, targets=nicks))
+        self._reply_failures(event, results)
 
     @require_channel
     @defer.inlineCallbacks
@@ -529,16 +807,9 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
             nicks = groupdict['nicks'].split()
         channel = event.channel
 
-        ds = [
-                self.transport.issue_request("ircop.deop", channel=channel,
-                    target=nick)
-                for nick in nicks
-                ]
-        try:
-            for d in ds:
-                yield d
-        except ircop.OpFailed as e:
-            event.reply(str(e))
+        results = (yield self.transport.issue_request("ircop.deop_many",
+            channel=channel, targets=nicks))
+        self._reply_failures(event, results)
 
     @require_channel
     @defer.inlineCallbacks
@@ -607,11 +878,8 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
             destchan = "##FIX_YOUR_CONNECTION"
 
         try:
-            whois_results = (yield self.transport.issue_request("irc.whois", nick))
-            whoisuser = whois_results['RPL_WHOISUSER']
-            nick = whoisuser[0]
-            username = whoisuser[1]
-            #hostname = whoisuser[2]
+            nick, userhost = (yield self._lookup_hostmask(nick)).split("!", 1)
+            username = userhost.split("@", 1)[0]
             hostmask = "*!{0}@*".format(username)
         except ircutil.NoSuchNick:
             hostmask = "{0}!*@*".format(nick)
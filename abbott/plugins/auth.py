@@ -12,8 +12,11 @@ from . import ircutil
 """
 
 The auth module provides the Auth plugin, which handles authorization of irc
-users. It identifies irc users by the response code 330 from a whois, commonly
-used to supply the username the user is logged in with.
+users. It identifies irc users by the account they're logged in with. If the
+server supports the IRCv3 account capabilities, this comes from the message
+itself or from the ircutil.AccountTracker plugin. Otherwise it falls back to
+the response code 330 from a whois, commonly used to supply the username the
+user is logged in with.
 
 The plugin hooks incoming irc events and adds a function to the event object:
 has_permission(). This function takes two parameters: a permission string, and
@@ -48,6 +51,9 @@ group, while not requiring having access to edit all groups or all permissions.
 
 """
 
+# Sentinel for "we don't know the user's account from the event itself"
+_UNKNOWN = object()
+
 def satisfies(user_perm, auth_perm):
     """Does the user permission satisfy the required auth_perm?
 
@@ -117,9 +123,15 @@ class Auth(command.CommandPluginSuperclass):
         # Install a middleware hook for all irc events
         self.install_middleware("irc.on_*")
 
+        # Bulk account information from the ircutil.AccountTracker plugin
+        self.listen_for_event("ircutil.on_accounts_resolved")
+
         # maps hostmasks to authenticated usernames, or None to indicate the
         # user doesn't have any auth information
         self.authd_users = {}
+        # maps hostmasks to the timers that will remove their None entries
+        # from authd_users
+        self.prune_timers = {}
 
         permgroup = self.install_cmdgroup(
                 grpname="permission",
@@ -230,53 +242,112 @@ class Auth(command.CommandPluginSuperclass):
                 "irc.on_action",
                 "irc.on_topic_updated",
                 ]:
-            event.has_permission = functools.partial(self._has_permission, event.user)
-            event.where_permission = functools.partial(self._where_permission, event.user)
+            # With account-tag, message events already say who sent them
+            account = getattr(event, "account", _UNKNOWN)
+            event.has_permission = functools.partial(self._has_permission,
+                    event.user, account=account)
+            event.where_permission = functools.partial(self._where_permission,
+                    event.user, account=account)
 
         return event
 
 
     @defer.inlineCallbacks
-    def _get_permissions(self, hostmask):
-        """This function returns the permissions granted to the given user,
-        identifying them in the process by doing a whois lookup if necessary.
+    def _get_authname(self, hostmask, account=_UNKNOWN):
+        """Returns a deferred that fires with the account name the given user
+        is logged in with, or None if they aren't logged in or couldn't be
+        identified.
 
-        It returns a deferred object which fires with an iterable over
-        (channel, permissionstr) tuples the user has, or an empty list of the
-        user does not have any permissions or the user could not be identified.
-        It does NOT include any default permissions, only permissions
-        explicitly granted to the user (along with any groups the user is in).
-        
-        This method may send a whois to the server, in which case it looks for
-        an IRC 330 command back from the server indicating the user's authname
+        If the account is already known (from the account message tag), pass
+        it in as `account`. Otherwise we ask the ircutil.AccountTracker
+        plugin, and if it doesn't know either, do a whois lookup and look for
+        an IRC 330 command back from the server indicating the user's
+        authname.
 
         """
+        if account is not _UNKNOWN:
+            defer.returnValue(account)
+            return
+
+        try:
+            authname = (yield self.transport.issue_request("irc.account", hostmask))
+        except (NotImplementedError, ircutil.AccountUnknown):
+            pass
+        else:
+            defer.returnValue(authname)
+            return
+
         # Check if the user is already identified by a previous whois
         if hostmask in self.authd_users:
-            authname = self.authd_users[hostmask]
+            defer.returnValue(self.authd_users[hostmask])
+            return
 
+        # No cached entry for that hostmask in authd_users. Do a whois and look
+        # it up.
+        log.msg("Permission request for %s, but I don't know the authname. Doing a whois" % (hostmask,))
+        nick = hostmask.split("!")[0]
+        try:
+            # These are triggered by anyone trying a command, so they go
+            # behind whoises for other things
+            whois_info = (yield self.transport.issue_request("irc.whois", nick,
+                priority="low"))
+        except ircutil.WhoisShed as e:
+            # Too busy to check. Treat them as unidentified for now, but don't
+            # remember that.
+            log.msg("Whois failed: %s" % e)
+            defer.returnValue(None)
+            return
+        except ircutil.WhoisError as e:
+            log.msg("Whois failed: %s" % e)
+            whois_info = {}
+
+        if "330" not in whois_info:
+            authname = None
         else:
-            # No cached entry for that hostmask in authd_users. Do a whois and look
-            # it up.
-            log.msg("Permission request for %s, but I don't know the authname. Doing a whois" % (hostmask,))
-            nick = hostmask.split("!")[0]
-            try:
-                whois_info = (yield self.transport.issue_request("irc.whois", nick))
-            except ircutil.WhoisError as e:
-                log.msg("Whois failed: %s" % e)
-                whois_info = {}
-
-            if "330" not in whois_info:
-                # No auth information. Cache this value for one minute
-                authname = None
-                self.authd_users[hostmask] = None
-                def cacheprune():
-                    if hostmask in self.authd_users and self.authd_users[hostmask] == None:
-                        del self.authd_users[hostmask]
-                reactor.callLater(60, cacheprune)
+            authname = whois_info["330"][1]
+        self._cache_authname(hostmask, authname)
 
-            else:
-                authname = self.authd_users[hostmask] = whois_info["330"][1]
+        defer.returnValue(authname)
+
+    def _cache_authname(self, hostmask, authname):
+        """Remembers the account the given hostmask is logged in as. A None
+        authname (no auth information) is only cached for one minute.
+
+        """
+        self.authd_users[hostmask] = authname
+
+        timer = self.prune_timers.pop(hostmask, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+
+        if authname is None:
+            def cacheprune():
+                del self.prune_timers[hostmask]
+                if hostmask in self.authd_users and self.authd_users[hostmask] == None:
+                    del self.authd_users[hostmask]
+            self.prune_timers[hostmask] = reactor.callLater(60, cacheprune)
+
+    def on_event_ircutil_on_accounts_resolved(self, event):
+        """A WHOX on a channel we joined told us the accounts of all its
+        members. Cache them so permission checks don't need a whois each.
+
+        """
+        for hostmask, authname in event.users.items():
+            self._cache_authname(hostmask, authname)
+
+    @defer.inlineCallbacks
+    def _get_permissions(self, hostmask, account=_UNKNOWN):
+        """This function returns the permissions granted to the given user,
+        identifying them in the process if necessary. (See _get_authname())
+
+        It returns a deferred object which fires with an iterable over
+        (channel, permissionstr) tuples the user has, or an empty list of the
+        user does not have any permissions or the user could not be identified.
+        It does NOT include any default permissions, only permissions
+        explicitly granted to the user (along with any groups the user is in).
+
+        """
+        authname = (yield self._get_authname(hostmask, account))
 
         # if authname is none at this point, it indicates the whois didn't
         # return any auth info. Remember this method does not account for
@@ -292,7 +363,7 @@ class Auth(command.CommandPluginSuperclass):
         defer.returnValue(perms)
 
     @defer.inlineCallbacks
-    def _has_permission(self, hostmask, permission, channel):
+    def _has_permission(self, hostmask, permission, channel, account=_UNKNOWN):
         """Asks if the user identified by hostmask has the given permission
         string `permission` in the given channel. Channel can be None to
         indicate a global permission is required.
@@ -309,7 +380,7 @@ class Auth(command.CommandPluginSuperclass):
             defer.returnValue(True)
             return
 
-        user_perms = (yield self._get_permissions(hostmask))
+        user_perms = (yield self._get_permissions(hostmask, account))
 
         for perm_channel, user_perm in chain(user_perms, self.config['defaultperms']):
             # Does perm_channel apply to `channel`?
@@ -329,7 +400,7 @@ class Auth(command.CommandPluginSuperclass):
         defer.returnValue(False)
 
     @defer.inlineCallbacks
-    def _where_permission(self, hostmask, permission):
+    def _where_permission(self, hostmask, permission, account=_UNKNOWN):
         """This is a call made specifically for help-related plugins. It
         returns a list of channels where the given user has the given
         permission.
@@ -347,7 +418,7 @@ class Auth(command.CommandPluginSuperclass):
             defer.returnValue([None])
             return
 
-        user_perms = (yield self._get_permissions(hostmask))
+        user_perms = (yield self._get_permissions(hostmask, account))
 
         channels = set()
         for perm_channel, user_perm in chain(user_perms, self.config['defaultperms']):
@@ -360,6 +431,12 @@ class Auth(command.CommandPluginSuperclass):
         defer.returnValue(channels)
 
     ### Reload event
+    def stop(self):
+        for timer in self.prune_timers.values():
+            if timer.active():
+                timer.cancel()
+        super(Auth, self).stop()
+
     def reload(self):
         super(Auth, self).reload()
         self.config['perms'] = defaultdict(list, self.config['perms'])
@@ -437,10 +514,12 @@ class Auth(command.CommandPluginSuperclass):
             groups = self.config['groups'][name]
         else:
             # Get info about the current user
-            perms = set((yield self._get_permissions(event.user)))
-            if self.authd_users.get(event.user, None):
-                event.reply("You are identified as %s" % self.authd_users[event.user])
-                groups = self.config['groups'][self.authd_users[event.user]]
+            account = getattr(event, "account", _UNKNOWN)
+            perms = set((yield self._get_permissions(event.user, account)))
+            authname = (yield self._get_authname(event.user, account))
+            if authname:
+                event.reply("You are identified as %s" % authname)
+                groups = self.config['groups'][authname]
             else:
                 event.reply("I don't know who you are")
                 groups = []
@@ -52,7 +52,7 @@ class RunCommand(CommandPluginSuperclass):
 
         self.currentprocess = ContinuousProcess(
                 self,
-                lambda s: event.reply(s, userprefix=False),
+                lambda s: event.reply(s, userprefix=False, priority="bulk"),
                 )
 
         cmd = match.groupdict()['cmd']
@@ -55,7 +55,8 @@ The kernel is an essential part of an operating system, but useless by itself; i
         for q in quote.split("\n"):
             if not q:
                 continue
-            reactor.callLater(t, event.reply, q, userprefix=False)
+            reactor.callLater(t, event.reply, q, userprefix=False,
+                    priority="bulk")
             t += 2
 
 class Repeater(BotPlugin):
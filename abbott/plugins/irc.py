@@ -1,11 +1,16 @@
+import bisect
+from collections import defaultdict, deque, OrderedDict
+import hashlib
+import re
+import sys
 from time import time
-import unicodedata
 
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol, defer
+from twisted.internet import reactor, protocol, defer, task
 from twisted.internet.ssl import ClientContextFactory
 from twisted.python import log
 
+from ..hostmask import irc_lower
 from ..pluginbase import BotPlugin
 from ..transport import Event
 from ..command import CommandPluginSuperclass
@@ -17,6 +22,717 @@ twisted Protocol-derived object (IRCBot) used in conjunction with IRCBotPlugin
 
 """
 
+def parse_tags(tagstr):
+    """Parses the tag section of an IRCv3 message (without the leading @)
+    into a dictionary. Tags without a value map to the empty string.
+
+    """
+    tags = {}
+    for tag in tagstr.split(";"):
+        if not tag:
+            continue
+        key, _, value = tag.partition("=")
+        if "\\" in value:
+            value = _unescape_tag_value(value)
+        tags[key] = value
+    return tags
+
+_TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+def _unescape_tag_value(value):
+    out = []
+    chars = iter(value)
+    for c in chars:
+        if c == "\\":
+            c = next(chars, "")
+            out.append(_TAG_ESCAPES.get(c, c))
+        else:
+            out.append(c)
+    return "".join(out)
+
+def decode_line(line):
+    """Decodes a line received from the server. Lines are supposed to be
+    UTF-8, but some clients still send CP1252.
+
+    """
+    try:
+        # This is the common case, and CPython's decoder has a fast path for
+        # all-ASCII input
+        return line.decode("UTF-8")
+    except UnicodeDecodeError:
+        return line.decode("CP1252", 'replace')
+
+def parse_line(line):
+    """Splits a decoded line into its IRCv3 message tags (a dict), prefix,
+    command and params (a list, the last of which may contain spaces). The
+    prefix is "" for lines without one. Raises irc.IRCBadMessage for lines
+    without a command.
+
+    This does the same as twisted's parsemsg(), plus the tags, but walks the
+    line once by position instead of splitting it up repeatedly.
+
+    """
+    tags = {}
+    pos = 0
+    if line.startswith("@"):
+        pos = line.find(" ")
+        if pos == -1:
+            raise irc.IRCBadMessage("Line with only tags")
+        tags = parse_tags(line[1:pos])
+        pos += 1
+        while line.startswith(" ", pos):
+            pos += 1
+
+    prefix = ""
+    if line.startswith(":", pos):
+        end = line.find(" ", pos)
+        if end == -1:
+            raise irc.IRCBadMessage("Line with only a prefix")
+        prefix = line[pos+1:end]
+        pos = end + 1
+
+    trailing = line.find(" :", pos)
+    if trailing == -1:
+        params = line[pos:].split()
+    else:
+        params = line[pos:trailing].split()
+        params.append(line[trailing+2:])
+    if not params:
+        raise irc.IRCBadMessage("Empty line.")
+    command = params.pop(0)
+    return tags, prefix, command, params
+
+def dispatch_table(cls):
+    """Builds the table IRCBot.lineReceived() dispatches commands with. It
+    maps each command and numeric to a tuple of its name as handlers know it
+    (the symbolic name, for numerics twisted knows, like RPL_WELCOME) and the
+    name of its irc_* method on cls, or None if it has none and goes to
+    irc_unknown().
+
+    """
+    table = {}
+    for numeric, name in irc.numeric_to_symbolic.items():
+        method = "irc_" + name
+        table[numeric] = (name, method if hasattr(cls, method) else None)
+    for method in dir(cls):
+        if method.startswith("irc_") and method != "irc_unknown":
+            name = method[4:]
+            table.setdefault(name, (name, method))
+    return table
+
+def pack_targets(command, targets, max_length, limit=None):
+    """Returns lines of the given command with the targets joined with commas
+    after it, as many in each line as fit within max_length(prefix) bytes
+    (see OutboundScheduler) and limit (None for no limit)
+
+    """
+    lines = []
+    batch = []
+    for target in targets:
+        line = "{0} {1}".format(command, ",".join(batch + [target]))
+        if batch and (len(line.encode("UTF-8")) + 2 > max_length(command + " ")
+                or (limit is not None and len(batch) >= limit)):
+            lines.append("{0} {1}".format(command, ",".join(batch)))
+            batch = []
+        batch.append(target)
+    if batch:
+        lines.append("{0} {1}".format(command, ",".join(batch)))
+    return lines
+
+# The quit message of users lost in a netsplit: the names of the two servers
+# that split
+NETSPLIT_QUIT = re.compile(r"[\w-]+(\.[\w-]+)+ [\w-]+(\.[\w-]+)+\Z")
+
+# Control characters that may be sent, for colors and formatting
+_FORMAT_CODES = frozenset([0x02, 0x03, 0x0f, 0x12, 0x1f])
+# The code points of every other control character. These are category Cc,
+# U+0000 to U+001F and U+007F to U+009F, which Unicode guarantees will never
+# change.
+_CONTROL_CODES = [c for c in list(range(0x20)) + list(range(0x7f, 0xa0))
+        if c not in _FORMAT_CODES]
+_UNSAFE = re.compile(u"[{0}]".format(
+    u"".join(u"\\x{0:02x}".format(c) for c in _CONTROL_CODES)))
+_STRIP_UNSAFE = dict.fromkeys(_CONTROL_CODES)
+
+def sanitize_line(line):
+    """Removes the control characters from a line, except for the ones for
+    colors and formatting
+
+    """
+    # Nearly every line is clean, and the search is much cheaper than the
+    # translation
+    if _UNSAFE.search(line) is None:
+        return line
+    return line.translate(_STRIP_UNSAFE)
+
+class OutboundScheduler(object):
+    """Decides when each line we send goes out to the server.
+
+    Servers allow a burst of lines and then about one line every couple of
+    seconds before they start delaying or disconnecting a client for
+    flooding. This is modelled with a token bucket: it holds up to `burst`
+    tokens, one is added every `period` seconds, and each line sent takes
+    one. Lines wait in a queue while the bucket is empty.
+
+    Waiting lines are sent by priority lane, highest first (see LANES), so a
+    KICK or MODE doesn't wait behind a wall of command output. Within a lane
+    the targets (channels or nicks) the lines are for take turns, one line
+    each. Lines in lanes with a max_age that waited longer than that are
+    dropped instead of being sent late.
+
+    PRIVMSGs and NOTICEs enqueued as mergeable are coalesced when they go
+    out: the messages waiting behind one for the same target and of the same
+    type are appended to it, joined with `separator`, for as long as the line
+    stays within max_length(prefix) bytes, where prefix is the line up to the
+    text. Then the messages with identical text waiting at the front of other
+    targets' queues are folded in as extra targets ("PRIVMSG #a,#b :text"),
+    up to targmax(command) targets (None for no limit). Mergeable messages
+    are held for `delay` seconds after they are enqueued, so the ones that
+    come right after them can be merged in even when the bucket isn't empty.
+    Only messages at the front of their target's queue are ever sent, so the
+    order of the messages to each target is kept.
+
+    send is called with each line when it's time to send it.
+
+    """
+    # Priority lanes, highest first. op is for everything but messages:
+    # server protocol, modes, kicks and the like.
+    LANES = ("op", "reply", "notice", "bulk")
+
+    def __init__(self, send, burst=5, period=2, max_age=None, delay=0,
+            separator=" | ", max_length=None, targmax=None):
+        self.send = send
+        self.burst = burst
+        self.period = period
+        # Maps lanes to how many seconds their lines may wait
+        self.max_age = dict(max_age or {})
+        self.delay = delay
+        self.separator = separator
+        self.max_length = max_length or (lambda prefix: 400)
+        self.targmax = targmax or (lambda command: 1)
+
+        self.tokens = float(burst)
+        self.last_refill = time()
+
+        # Maps each lane to an OrderedDict mapping lowercased targets to
+        # deques of (time queued, line, message) tuples, where message is
+        # (command, target, text) for mergeable lines and None for the rest.
+        # The first target is the next to go.
+        self.lanes = dict((lane, OrderedDict()) for lane in self.LANES)
+        self.timer = None
+        # Whether the timer is only waiting for held lines to be ready, as
+        # opposed to for a token
+        self.holding = False
+
+        # Counters, and the total and longest time lines waited, per lane
+        self.sent = defaultdict(int)
+        self.dropped = defaultdict(int)
+        self.coalesced = defaultdict(int)
+        self.waited = defaultdict(float)
+        self.max_wait = defaultdict(float)
+        # How long the last lines sent waited, in any lane
+        self.recent_waits = deque(maxlen=1000)
+        # How many times lines had to start waiting for a token, and whether
+        # they are now
+        self.throttles = 0
+        self.throttled = False
+
+    def _refill(self):
+        now = time()
+        self.tokens = min(self.burst,
+                self.tokens + (now - self.last_refill) / self.period)
+        self.last_refill = now
+
+    def enqueue(self, line, lane="op", target="", mergeable=False):
+        if lane not in self.lanes:
+            lane = "op"
+        message = None
+        if mergeable:
+            parts = line.split(" ", 2)
+            if (len(parts) == 3 and parts[0] in ("PRIVMSG", "NOTICE") and
+                    parts[2].startswith(":") and
+                    not parts[2].startswith(":\x01")):
+                message = (parts[0], parts[1], parts[2][1:])
+        self.lanes[lane].setdefault(target.lower(), deque()).append(
+                (time(), line, message))
+        self._run()
+
+    def depth(self, lane=None):
+        """How many lines are waiting, in one lane or in all of them"""
+        lanes = [lane] if lane else self.LANES
+        return sum(len(lines) for l in lanes for lines in self.lanes[l].values())
+
+    def _ready(self, entry):
+        """When a queued line may be sent"""
+        queued, line, message = entry
+        return queued + self.delay if message is not None else queued
+
+    def _fits(self, command, targets, text):
+        prefix = "{0} {1} :".format(command, ",".join(targets))
+        return len((prefix + text).encode("UTF-8")) + 2 <= \
+                self.max_length(prefix)
+
+    def _stale(self, lane, entry, now):
+        max_age = self.max_age.get(lane)
+        if max_age is not None and now - entry[0] > max_age:
+            self.dropped[lane] += 1
+            return True
+        return False
+
+    def _took(self, lane, entry, now):
+        wait = now - entry[0]
+        self.waited[lane] += wait
+        self.max_wait[lane] = max(self.max_wait[lane], wait)
+        self.recent_waits.append(wait)
+
+    def _coalesce(self, lane, target, entry, now):
+        """Merges the messages that can go with entry, which was just taken
+        off the front of target's queue, into it. Returns the line to send.
+
+        """
+        command, msgtarget, text = entry[2]
+        targets = [msgtarget]
+        lines = self.lanes[lane].get(target, ())
+
+        # Later messages to the same target
+        while lines and lines[0][2] is not None and \
+                lines[0][2][:2] == (command, msgtarget):
+            if self._stale(lane, lines[0], now):
+                lines.popleft()
+                continue
+            merged = text + self.separator + lines[0][2][2]
+            if not self._fits(command, targets, merged):
+                break
+            self._took(lane, lines.popleft(), now)
+            self.coalesced[lane] += 1
+            text = merged
+        if not lines:
+            self.lanes[lane].pop(target, None)
+
+        # The same text to other targets
+        limit = self.targmax(command)
+        for other, lines in list(self.lanes[lane].items()):
+            if limit is not None and len(targets) >= limit:
+                break
+            if other == target:
+                continue
+            head = lines[0]
+            message = head[2]
+            if message is None or message[0] != command or \
+                    message[2] != text or \
+                    not self._fits(command, targets + [message[1]], text):
+                continue
+            lines.popleft()
+            if not lines:
+                del self.lanes[lane][other]
+            if self._stale(lane, head, now):
+                continue
+            self._took(lane, head, now)
+            self.coalesced[lane] += 1
+            targets.append(message[1])
+
+        if len(targets) == 1 and text == entry[2][2]:
+            return entry[1]
+        return "{0} {1} :{2}".format(command, ",".join(targets), text)
+
+    def _next(self):
+        """Takes the next line to send off the queues and returns it with its
+        lane, or returns None if there are none ready. Drops stale lines on
+        the way.
+
+        """
+        now = time()
+        for lane in self.LANES:
+            targets = self.lanes[lane]
+            for target in list(targets):
+                lines = targets[target]
+                while lines and self._stale(lane, lines[0], now):
+                    lines.popleft()
+                if not lines:
+                    del targets[target]
+                    continue
+                if self._ready(lines[0]) > now:
+                    # Held for more messages to merge with. Keep its turn.
+                    continue
+                entry = lines.popleft()
+                # Move the target to the back of the line
+                del targets[target]
+                if lines:
+                    targets[target] = lines
+                self._took(lane, entry, now)
+                if entry[2] is None:
+                    return lane, entry[1]
+                return lane, self._coalesce(lane, target, entry, now)
+        return None
+
+    def _run(self):
+        if self.timer is not None and self.timer.active():
+            if not self.holding:
+                # _run() will be called when the timer fires
+                return
+            # Only waiting for held lines. Something new may be sendable now.
+            self.timer.cancel()
+        self.timer = None
+        self._refill()
+        while self.tokens >= 1:
+            item = self._next()
+            if item is None:
+                break
+            lane, line = item
+            self.tokens -= 1
+            self.sent[lane] += 1
+            self.send(line)
+        if not self.depth():
+            self.throttled = False
+            return
+        self.holding = self.tokens >= 1
+        if not self.holding and not self.throttled:
+            self.throttles += 1
+        self.throttled = not self.holding
+        if self.holding:
+            # Everything waiting is being held. Wake up when the first of it
+            # is ready.
+            wait = min(self._ready(lines[0])
+                    for targets in self.lanes.values()
+                    for lines in targets.values()) - time()
+        else:
+            wait = (1 - self.tokens) * self.period
+        self.timer = reactor.callLater(max(wait, 0), self._run)
+
+    def stop(self):
+        """Cancels the pending send, for when the connection is gone"""
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+    def stats(self):
+        """Returns a dict with the current queue depth per lane and in total,
+        and per lane the number of lines sent and dropped, the number of
+        messages merged into other lines, and the mean and longest time
+        messages waited. throttles is how many times lines had to start
+        waiting for the flood limit, and wait_p50 and wait_p95 the median
+        and 95th percentile of how long the last 1000 lines waited.
+
+        """
+        waits = sorted(self.recent_waits)
+        stats = {
+                "depth": self.depth(),
+                "tokens": self.tokens,
+                "throttles": self.throttles,
+                "wait_p50": waits[len(waits) // 2] if waits else 0,
+                "wait_p95": waits[len(waits) * 95 // 100] if waits else 0,
+                "lanes": {},
+                }
+        for lane in self.LANES:
+            taken = self.sent[lane] + self.coalesced[lane]
+            stats["lanes"][lane] = {
+                    "depth": self.depth(lane),
+                    "sent": self.sent[lane],
+                    "dropped": self.dropped[lane],
+                    "coalesced": self.coalesced[lane],
+                    "mean_wait": self.waited[lane] / taken if taken else 0,
+                    "max_wait": self.max_wait[lane],
+                    }
+        return stats
+
+class ReplayQueue(object):
+    """Holds irc.do_* events that come in while we're not connected, to be
+    replayed once we are.
+
+    Each event is held for ttl[eventtype] seconds (default_ttl for types not
+    in ttl), and types with a ttl of 0 aren't held at all. If more than
+    maxlen events are held, the one with the lowest priority[eventtype]
+    (default 0), and the oldest of those, is dropped to make room.
+
+    Events that supersede one another are collapsed, keeping only the last
+    one: modes changing the same mode (and parameter) on a channel, like +q
+    and then -q on the same mask (whether sent as irc.do_mode or as a raw
+    MODE line), topics for the same channel, joins and parts of the same
+    channel, nick changes, and away and back.
+
+    Events are held either for a channel, to be replayed once we're in it, or
+    for the connection, to be replayed when we're registered. They are
+    replayed in the order they came in. The events held for a channel we
+    fail to join are dropped.
+
+    """
+    def __init__(self, maxlen=500, ttl=None, default_ttl=300, priority=None):
+        self.maxlen = maxlen
+        self.ttl = dict(ttl or {})
+        self.default_ttl = default_ttl
+        self.priority = dict(priority or {})
+        # Maps keys to (expiry time, channel, event) tuples, oldest first.
+        # The key is the event's collapse key, or a number for events that
+        # don't collapse.
+        self.events = OrderedDict()
+        # Maps lowercased channels to how many events are held for them
+        self.held = defaultdict(int)
+        self.counter = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    @staticmethod
+    def channel_of(event):
+        """The lowercased channel an event has to wait for us to be in, or
+        None
+
+        """
+        if event.eventtype in ("irc.do_msg", "irc.do_notice"):
+            channel = getattr(event, "user", "")
+        elif event.eventtype in ("irc.do_say", "irc.do_topic", "irc.do_mode",
+                "irc.do_kick", "irc.do_invite", "irc.do_sync"):
+            channel = getattr(event, "channel", "")
+        elif event.eventtype == "irc.do_raw":
+            command, params = ReplayQueue._split_raw(event.line)
+            if command not in ReplayQueue.RAW_CHANNEL_COMMANDS or not params:
+                return None
+            channel = params[0]
+        else:
+            return None
+        if channel and channel[0] in irc.CHANNEL_PREFIXES:
+            return channel.lower()
+        return None
+
+    # Raw commands whose first parameter is the channel they're for
+    RAW_CHANNEL_COMMANDS = ("MODE", "KICK", "TOPIC", "PRIVMSG", "NOTICE")
+
+    @staticmethod
+    def _split_raw(line):
+        """Splits a raw line into its uppercased command and its parameters,
+        the trailing one included
+
+        """
+        line, _, trailing = line.partition(" :")
+        params = line.split()
+        if not params:
+            return None, []
+        if trailing:
+            params.append(trailing)
+        return params[0].upper(), params[1:]
+
+    @staticmethod
+    def collapse_key(event):
+        """The key events superseding this one share, or None"""
+        eventtype = event.eventtype
+        if eventtype == "irc.do_raw":
+            # Plugins that batch modes up send them raw. A line with a single
+            # change collapses with the same change made either way.
+            command, params = ReplayQueue._split_raw(event.line)
+            if command != "MODE" or len(params) not in (2, 3) or \
+                    len(params[1]) != 2 or params[1][0] not in "+-":
+                return None
+            param = params[2] if len(params) == 3 else None
+            return ("mode", params[0].lower(), params[1][1],
+                    param.lower() if param is not None else None)
+        if eventtype == "irc.do_mode" and len(event.modes) == 1:
+            param = getattr(event, "user", None) or \
+                    getattr(event, "mask", None) or \
+                    getattr(event, "limit", None)
+            return ("mode", event.channel.lower(), event.modes,
+                    str(param).lower() if param is not None else None)
+        if eventtype == "irc.do_topic":
+            return ("topic", event.channel.lower())
+        if eventtype == "irc.do_sync":
+            return ("sync", event.line)
+        if eventtype in ("irc.do_join_channel", "irc.do_leave_channel"):
+            return ("membership", event.channel.lower())
+        if eventtype == "irc.do_setnick":
+            return ("nick",)
+        if eventtype in ("irc.do_away", "irc.do_back"):
+            return ("away",)
+        return None
+
+    def add(self, event):
+        ttl = self.ttl.get(event.eventtype, self.default_ttl)
+        if not ttl:
+            return
+        key = self.collapse_key(event)
+        if key is None:
+            self.counter += 1
+            key = self.counter
+        elif key in self.events:
+            self._remove(key)
+        channel = self.channel_of(event)
+        self.events[key] = (time() + ttl, channel, event)
+        self.held[channel] += 1
+
+        self._expire()
+        while len(self.events) > self.maxlen:
+            # The first of the lowest priority
+            key = min(self.events, key=lambda k:
+                    self.priority.get(self.events[k][2].eventtype, 0))
+            log.msg("Replay queue full, dropping {0}".format(
+                self._remove(key).eventtype))
+            self.dropped += 1
+
+    def _remove(self, key):
+        _, channel, event = self.events.pop(key)
+        self.held[channel] -= 1
+        if not self.held[channel]:
+            del self.held[channel]
+        return event
+
+    def _expire(self):
+        now = time()
+        for key, (expires, channel, event) in list(self.events.items()):
+            if expires < now:
+                self._remove(key)
+                self.dropped += 1
+
+    def pending(self, channel):
+        """Tells whether any events are held for the given channel"""
+        return channel.lower() in self.held
+
+    def channels(self):
+        """The channels events are held for"""
+        return [channel for channel in self.held if channel is not None]
+
+    def take(self, channel=None):
+        """Removes and returns the events held for the given channel, or
+        with None, the ones held for the connection
+
+        """
+        self._expire()
+        if channel is not None:
+            channel = channel.lower()
+        if channel not in self.held:
+            return []
+        taken = []
+        for key, (expires, c, event) in list(self.events.items()):
+            if c == channel:
+                taken.append(self._remove(key))
+        return taken
+
+    def drop(self, channel):
+        """Drops the events held for the given channel, for when we can't get
+        into it. Returns how many there were.
+
+        """
+        dropped = len(self.take(channel))
+        self.dropped += dropped
+        return dropped
+
+class HashRing(object):
+    """A consistent hash ring, for sharding channels over the connections of
+    a pool. Each of the n nodes (numbered 0 to n-1) is put on the ring at
+    `replicas` points, and a key belongs to the node at the first point at or
+    after its own hash. Adding a node only moves the keys that land on its
+    points, about 1/n of them.
+
+    Keys are channel names, compared case insensitively.
+
+    """
+    def __init__(self, n, replicas=64):
+        points = []
+        for node in range(n):
+            for replica in range(replicas):
+                points.append((self._hash("{0}:{1}".format(node, replica)),
+                    node))
+        points.sort()
+        self.hashes = [h for h, _ in points]
+        self.nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode("UTF-8")).hexdigest()[:16], 16)
+
+    def get(self, key, alive=None):
+        """Returns the node a key belongs to. If alive is given, nodes it
+        returns false for are passed over for the next node on the ring, and
+        None is returned if there's no node left.
+
+        """
+        i = bisect.bisect_left(self.hashes, self._hash(irc_lower(key)))
+        if alive is None:
+            return self.nodes[i % len(self.nodes)]
+        for j in range(i, i + len(self.nodes)):
+            node = self.nodes[j % len(self.nodes)]
+            if alive(node):
+                return node
+        return None
+
+class ConnectionStats(object):
+    """I/O metrics of one connection of the pool, kept across reconnects.
+    The IRCBot of the connection updates them as it goes. Lines are counted
+    as they go over the wire, so bytes include the line endings.
+
+    depth holds up to `samples` (time, send queue depth) samples, and
+    rejoin_times how many seconds it took after each of the last few
+    disconnects to be back in all the channels and synced.
+
+    The lag is the round trip time of the last PING we sent, or, if the
+    server is slower than that answering the latest one, how long we've been
+    waiting so far.
+
+    """
+    def __init__(self, samples=360):
+        self.lines_in = 0
+        self.bytes_in = 0
+        self.lines_out = 0
+        self.bytes_out = 0
+        self.connects = 0
+        self.lost_at = None
+        self.rejoin_times = deque(maxlen=10)
+        self.depth = deque(maxlen=samples)
+        self.last_lag = None
+        self.ping_token = None
+        self.ping_sent = None
+
+    def received(self, line):
+        self.lines_in += 1
+        self.bytes_in += len(line) + 2
+
+    def sent(self, line):
+        self.lines_out += 1
+        self.bytes_out += len(line) + 2
+
+    def connected(self):
+        self.connects += 1
+        self.ping_token = self.ping_sent = None
+
+    def lost(self):
+        self.lost_at = time()
+
+    def synced(self):
+        """We're back in all our channels. Returns how long after the
+        connection was lost that was, or None if this is the first time.
+
+        """
+        if self.lost_at is None:
+            return None
+        rejoin = time() - self.lost_at
+        self.rejoin_times.append(rejoin)
+        self.lost_at = None
+        return rejoin
+
+    def pinged(self, token):
+        self.ping_token = token
+        self.ping_sent = time()
+
+    def ponged(self, token):
+        if token != self.ping_token:
+            return
+        self.last_lag = time() - self.ping_sent
+        self.ping_token = self.ping_sent = None
+
+    def lag(self):
+        if self.ping_sent is not None:
+            return max(self.last_lag or 0, time() - self.ping_sent)
+        return self.last_lag
+
+    def as_dict(self):
+        return {
+                "lines_in": self.lines_in,
+                "bytes_in": self.bytes_in,
+                "lines_out": self.lines_out,
+                "bytes_out": self.bytes_out,
+                "reconnects": max(self.connects - 1, 0),
+                "rejoin_times": list(self.rejoin_times),
+                "depth": list(self.depth),
+                "lag": self.lag(),
+                }
+
 class IRCBot(irc.IRCClient):
     """This is the IRC protocol object (not a bot plugin). One of these objects
     is created per connection to an IRC server by the Factory object
@@ -25,22 +741,65 @@ class IRCBot(irc.IRCClient):
     See twisted.words.protocols.irc for more information.
 
     """
+    # IRCv3 capabilities we ask the server for, if it offers them. The account
+    # caps let the bot learn who is logged in as what without a whois, and the
+    # NAMES caps give us every user's full prefix modes and hostmask when we
+    # join a channel.
+    WANTED_CAPS = frozenset([
+        "account-notify",
+        "extended-join",
+        "account-tag",
+        "multi-prefix",
+        "userhost-in-names",
+        ])
 
     ### ALL METHODS BELOW ARE OVERRIDDEN METHODS OF irc.IRCClient (or ancestors)
     ### AND ARE CALLED AUTOMATICALLY UPON THE APPROPRIATE EVENTS FROM THE IRC
     ### SERVER
 
     def lineReceived(self, line):
-        """Overrides IRCClient.lineReceived to decode incoming strings to unicode"""
+        """Overrides IRCClient.lineReceived to decode incoming strings to
+        unicode and parse them with parse_line(), which understands IRCv3
+        message tags. The tags of the line currently being processed are kept
+        in self.tags, and added to every event sent out while it is.
+
+        Commands are dispatched like IRCClient.handleCommand() would, but
+        through the precomputed DISPATCH table instead of looking up the
+        symbolic name and method of each one.
+
+        """
+        self.factory.iostats.received(line)
+        line = decode_line(line)
+        if "\x10" in line:
+            line = irc.lowDequote(line)
+
+        try:
+            self.tags, prefix, command, params = parse_line(line)
+        except irc.IRCBadMessage:
+            self.badMessage(line, *sys.exc_info())
+            return
+
         try:
-            line = line.decode("UTF-8")
-        except UnicodeDecodeError:
-            line = line.decode("CP1252", 'replace')
-        return irc.IRCClient.lineReceived(self, line)
+            if not self.factory.accept_line(self, prefix, command, params):
+                # Another connection of the pool has this one
+                return
+            command, method = self.DISPATCH.get(command, (command, None))
+            if method is not None:
+                getattr(self, method)(prefix, params)
+            else:
+                self.irc_unknown(prefix, command, params)
+        except Exception:
+            log.deferr()
+        finally:
+            self.tags = {}
 
     def sendLine(self, line):
         """Overrides IRCClient.sendLine to encode outgoing lines with UTF-8.
-        Also implements some rate-limiting logic.
+        Lines are queued in the OutboundScheduler, which sends them as fast as
+        the server allows: messages go in the reply lane (or the one in
+        self.lane), notices in the notice lane, and everything else in the op
+        lane. Messages may be coalesced with others unless self.coalesce is
+        false or coalescing is turned off in the config.
 
         This method is also exported to other plugins as the irc.do_raw event.
         
@@ -50,41 +809,44 @@ class IRCBot(irc.IRCClient):
 
         # Do some filtering. Make sure no characters are control characters,
         # except perhaps for some color control characters
-        whitelist = frozenset("\x02\x03\x0f\x12\x1f")
-        line = "".join(x for x in line if
-                unicodedata.category(x) != "Cc" or
-                x in whitelist
-                )
-
-        line = line.encode("UTF-8")
+        line = sanitize_line(line)
+
+        parts = line.split(" ", 2)
+        command = parts[0].upper()
+        target = parts[1] if len(parts) > 1 else ""
+        if command == "PRIVMSG":
+            lane = self.lane or "reply"
+        elif command == "NOTICE":
+            lane = self.lane or "notice"
+        else:
+            lane = "op"
+        mergeable = lane != "op" and self.coalesce and \
+                self.factory.config['coalesce']
 
-        # Implement some simple rate limiting logic: If a line is received
-        # within 2 seconds of the last line, increment the line_count var. If
-        # line_count is over 5, set lineRate to 2 seconds.
-        time_since_last_line = time() - self.time_of_last_line
-        self.time_of_last_line = time()
+        self.scheduler.enqueue(line, lane, target, mergeable)
 
-        if time_since_last_line < 2:
-            self.line_count += 1
-        else:
-            self.line_count = 0
+    def _sendScheduled(self, line):
+        """Sends a line the OutboundScheduler says can go out now"""
+        encoded = line.encode("UTF-8")
+        self.factory.iostats.sent(encoded)
+        # Python 2's IRCClient wants encoded byte strings. On Python 3 it does
+        # the encoding itself.
+        self._reallySendLine(encoded if bytes is str else line)
 
-        if self.line_count >= 5:
-            # Queuing of lines is done by the IRCClient class, we just have to
-            # set this var
-            self.lineRate = 2
-        elif not self._queue:
-            # Only reset here if the queue has been emptied. It's possible the
-            # queue is still emptying, in which case we want to keep the
-            # limited rate up until the queue is emptied.
-            self.lineRate = None
+    def _targmax(self, command):
+        """How many targets the server takes in one command, according to
+        its TARGMAX, or None for no limit. Without a TARGMAX it's one.
 
-        return irc.IRCClient.sendLine(self, line)
+        """
+        targmax = self.supported.getFeature("TARGMAX") or {}
+        if command not in targmax:
+            return 1
+        return targmax[command]
 
     def connectionMade(self):
         """This is called by Twisted once the connection has been made, and has
-        access to self.factory. Join the configured channels and do other
-        initialization.
+        access to self.factory. Start registering and do other initialization.
+        The configured channels are joined once we're registered.
 
         """
 
@@ -96,9 +858,62 @@ class IRCBot(irc.IRCClient):
             # but don't error if it's not a reconnecting factory
             pass
 
-        # These vars are used in rate limiting logic in sendLine()
-        self.time_of_last_line = 0
-        self.line_count = 0
+        # All lines go out through this. lane is the lane messages go in
+        # instead of the default, and coalesce is whether they may be merged
+        # with others; received_event() sets them from the event's priority
+        # and coalesce attributes.
+        config = self.factory.config
+        self.scheduler = OutboundScheduler(self._sendScheduled,
+                burst=config['flood_burst'], period=config['flood_period'],
+                max_age=config['max_age'], delay=config['coalesce_delay'],
+                separator=config['coalesce_separator'],
+                max_length=self._safeMaximumLineLength,
+                targmax=self._targmax)
+        self.lane = None
+        self.coalesce = True
+
+        # The reconnect pipeline: when we connected, the lowercased channels
+        # we've yet to join, the lines plugins asked to send to sync their
+        # state (see sync()), and how many seconds it took to be joined and
+        # synced
+        self.connected_at = time()
+        self.joining = set()
+        self.sync_queue = deque()
+        self.sync_timer = None
+        self.synced_after = None
+
+        # Metrics for irc.stats, in the factory's ConnectionStats. The send
+        # queue depth is sampled every stats_interval seconds, and the lag
+        # measured with a PING every lag_interval seconds once registered.
+        self.factory.iostats.connected()
+        self.sampler = task.LoopingCall(self._sample_depth)
+        self.sampler.clock = reactor
+        self.sampler.start(config['stats_interval'], now=False)
+        self.lag_pinger = task.LoopingCall(self._ping_lag)
+        self.lag_pinger.clock = reactor
+        self.lag_tokens = 0
+
+        # Storm coalescing (see modeChanged(), userQuit() and userJoined()).
+        # mode_changes collects the changes of the MODE line being handled.
+        # splits maps netsplit quit messages to (timer, nicks) of the quits
+        # being collected, and split_nicks maps the lowercased nicks lost in
+        # netsplits to when. netjoins maps lowercased channels to (timer,
+        # events) of the joins of those users coming back.
+        self.mode_changes = None
+        self.splits = {}
+        self.split_nicks = {}
+        self.netjoins = {}
+
+        # IRCv3 capability negotiation state. caps is the set of capabilities
+        # the server has acknowledged for this connection.
+        self.caps = set()
+        self._caps_offered = set()
+        self.tags = {}
+
+        # Start capability negotiation before registering. Servers that don't
+        # know about CAP will reply with an unknown command error and register
+        # us as normal.
+        self.sendLine("CAP LS 302")
 
         # Can't use super() because twisted doesn't use new-style classes
         irc.IRCClient.connectionMade(self)
@@ -106,10 +921,6 @@ class IRCBot(irc.IRCClient):
 
         log.msg("Connection made")
 
-        # Join the configured channels
-        for channel in self.factory.config['channels']:
-            self.join(channel)
-
     def connectionLost(self, reason):
         """The connection is down and this object is about to be destroyed,
         so do any cleanup here.
@@ -118,18 +929,215 @@ class IRCBot(irc.IRCClient):
         self.factory.client = None
         irc.IRCClient.connectionLost(self, reason)
 
+        # Don't leave the scheduler's timer running for a dead connection
+        self.scheduler.stop()
+        self.factory.iostats.lost()
+        for loop in (self.sampler, self.lag_pinger):
+            if loop.running:
+                loop.stop()
+        if self.sync_timer is not None and self.sync_timer.active():
+            self.sync_timer.cancel()
+        # Send out the storms collected so far
+        for message, (timer, _) in list(self.splits.items()):
+            timer.cancel()
+            self._flush_split(message)
+        for lchannel, (timer, _) in list(self.netjoins.items()):
+            timer.cancel()
+            self._flush_netjoin(lchannel)
+
+        timer = getattr(self.factory, "disconnect_timer", None)
+        if timer is not None and timer.active():
+            timer.cancel()
+
         log.msg("IRC Connection lost!")
 
+    ### IRCv3 capability negotiation
+
+    def irc_CAP(self, prefix, params):
+        """Handles the server's replies to our CAP commands.
+
+        The LS reply may span several lines, marked by a "*" parameter before
+        the capability list on all but the last one. Once we have the full
+        list, request the capabilities we want that the server offers.
+
+        """
+        subcommand = params[1].upper()
+        if subcommand == "LS":
+            if len(params) > 3 and params[2] == "*":
+                self._caps_offered.update(params[3].split())
+                return
+            self._caps_offered.update(params[-1].split())
+            # Capabilities may be advertised with a value, e.g. sasl=PLAIN
+            offered = set(x.split("=",1)[0] for x in self._caps_offered)
+            wanted = offered & self.WANTED_CAPS
+            if wanted:
+                self.sendLine("CAP REQ :" + " ".join(sorted(wanted)))
+            else:
+                self.sendLine("CAP END")
+
+        elif subcommand == "ACK":
+            acked = set(x for x in params[-1].split() if not x.startswith("-"))
+            self.caps.update(acked)
+            log.msg("Server acknowledged capabilities: %s" % " ".join(sorted(acked)))
+            self.factory.broadcast_message("irc.on_cap_ack", caps=set(self.caps))
+            self.sendLine("CAP END")
+
+        elif subcommand == "NAK":
+            log.msg("Server refused capabilities: %s" % params[-1])
+            self.sendLine("CAP END")
+
+        elif subcommand == "DEL":
+            removed = set(params[-1].split())
+            self.caps -= removed
+            self.factory.broadcast_message("irc.on_cap_del", caps=removed)
+
+    def _account_kwargs(self):
+        """Returns keyword arguments to add to message events carrying the
+        sender's account name, taken from the account message tag. If the
+        account-tag capability isn't enabled, we don't know, so nothing is
+        added. A value of None means the sender is not logged in.
+
+        """
+        if "account-tag" not in self.caps:
+            return {}
+        return {"account": self.tags.get("account")}
+
     ### The following are things that happen to us
 
+    def signedOn(self):
+        """We're registered with the server, and can send it anything. Join
+        the configured channels (that are this connection's to join).
+
+        """
+        self.join_many(self.factory.channels())
+        self.factory.replay_events()
+        self.factory.replay_unjoined(self)
+        if self.factory.config['lag_interval'] and not self.lag_pinger.running:
+            self.lag_pinger.start(self.factory.config['lag_interval'])
+
+    def _sample_depth(self):
+        self.factory.iostats.depth.append((time(), self.scheduler.depth()))
+
+    def _ping_lag(self):
+        """Sends a PING to measure the lag, unless the last one is still
+        unanswered. It goes out right away instead of through the scheduler,
+        so it measures the server and the network, not our send queue.
+
+        """
+        if self.factory.iostats.ping_sent is not None:
+            return
+        self.lag_tokens += 1
+        token = "lag-{0}".format(self.lag_tokens)
+        self.factory.iostats.pinged(token)
+        self._sendScheduled("PING :" + token)
+
+    def irc_PONG(self, prefix, params):
+        self.factory.iostats.ponged(params[-1])
+
+    def join_many(self, channels):
+        """Joins several channels with as few JOIN lines as fit"""
+        channels = [channel if channel[0] in irc.CHANNEL_PREFIXES
+                else "#" + channel for channel in channels]
+        self.joining.update(channel.lower() for channel in channels)
+        # Servers that don't give a TARGMAX for JOIN take lists of any length
+        limit = (self.supported.getFeature("TARGMAX") or {}).get("JOIN")
+        for line in pack_targets("JOIN", channels,
+                self._safeMaximumLineLength, limit):
+            self.sendLine(line)
+        self._check_synced()
+
+    def join(self, channel, key=None):
+        """Overrides IRCClient.join to keep track of the channels we're
+        joining
+
+        """
+        if channel[0] not in irc.CHANNEL_PREFIXES:
+            channel = "#" + channel
+        self.joining.add(channel.lower())
+        irc.IRCClient.join(self, channel, key)
+
+    def sync(self, line, channel=None):
+        """Queues a line that syncs our view of a channel, such as a MODE or
+        WHO query, to be sent sync_interval seconds after the one before it.
+        This way the queries plugins make when we join all our channels at
+        once don't use up the flood allowance. This is the irc.do_sync event.
+
+        """
+        self.sync_queue.append(line)
+        if self.sync_timer is None or not self.sync_timer.active():
+            self._send_sync()
+
+    def _send_sync(self):
+        self.sync_timer = None
+        if not self.sync_queue:
+            self._check_synced()
+            return
+        self.sendLine(self.sync_queue.popleft())
+        self.sync_timer = reactor.callLater(self.factory.config['sync_interval'],
+                self._send_sync)
+
+    def _check_synced(self):
+        """Reports how long it took after connecting to get into all the
+        channels and send their syncs, once we have"""
+        if self.synced_after is not None or self.joining or self.sync_queue:
+            return
+        self.synced_after = time() - self.connected_at
+        log.msg("Joined and synced in {0:.1f} seconds".format(self.synced_after))
+        rejoin = self.factory.iostats.synced()
+        if rejoin is not None:
+            log.msg("Rejoined {0:.1f} seconds after losing the connection"
+                    .format(rejoin))
+        self.factory.broadcast_message("irc.on_synced",
+                duration=self.synced_after)
+
     def joined(self, channel):
         """We have joined a channel"""
         log.msg("Joined channel %s" % channel)
+        self.joining.discard(channel.lower())
         self.factory.broadcast_message("irc.on_join", channel=channel)
+        self.factory.replay_events(channel)
 
         if channel not in self.factory.config['channels']:
             self.factory.config['channels'].append(channel)
             self.factory.config.save()
+        self._check_synced()
+
+    def _join_failed(self, prefix, params):
+        """The server wouldn't let us join a channel. Drop anything held
+        until we're in it.
+
+        """
+        if len(params) > 1:
+            log.msg("Couldn't join {0}: {1}".format(params[1], params[-1]))
+            self.joining.discard(params[1].lower())
+            self.factory.drop_events(params[1])
+            self._check_synced()
+
+    # Replies to a JOIN that failed. They still go out as irc.on_unknown
+    # events, too.
+    def irc_ERR_NOSUCHCHANNEL(self, prefix, params):
+        self._join_failed(prefix, params)
+        self.irc_unknown(prefix, "ERR_NOSUCHCHANNEL", params)
+
+    def irc_ERR_TOOMANYCHANNELS(self, prefix, params):
+        self._join_failed(prefix, params)
+        self.irc_unknown(prefix, "ERR_TOOMANYCHANNELS", params)
+
+    def irc_ERR_CHANNELISFULL(self, prefix, params):
+        self._join_failed(prefix, params)
+        self.irc_unknown(prefix, "ERR_CHANNELISFULL", params)
+
+    def irc_ERR_INVITEONLYCHAN(self, prefix, params):
+        self._join_failed(prefix, params)
+        self.irc_unknown(prefix, "ERR_INVITEONLYCHAN", params)
+
+    def irc_ERR_BANNEDFROMCHAN(self, prefix, params):
+        self._join_failed(prefix, params)
+        self.irc_unknown(prefix, "ERR_BANNEDFROMCHAN", params)
+
+    def irc_ERR_BADCHANNELKEY(self, prefix, params):
+        self._join_failed(prefix, params)
+        self.irc_unknown(prefix, "ERR_BADCHANNELKEY", params)
 
     def left(self, channel):
         """We have left a channel"""
@@ -152,12 +1160,14 @@ class IRCBot(irc.IRCClient):
 
         self.factory.broadcast_message("irc.on_privmsg",
                 user=user, channel=channel, message=message,
-                direct=channel == self.nickname)
+                direct=channel == self.nickname,
+                **self._account_kwargs())
 
     def noticed(self, user, channel, message):
         """Received a notice. This is like a privmsg, but distinct."""
         self.factory.broadcast_message("irc.on_notice",
-                user=user, channel=channel, message=message)
+                user=user, channel=channel, message=message,
+                **self._account_kwargs())
 
     def modeChanged(self, user, channel, set, modes, args):
         """A mode has changed on a user or a channel.
@@ -175,22 +1185,155 @@ class IRCBot(irc.IRCClient):
         # The event broadcast out is slightly different. Events will always
         # contain exactly one mode change, while we may get more than one mode
         # change from the irc server in a single call to this method. arg may
-        # be None for modes that don't set an arg.
-        for mode, arg in zip(modes, args):
+        # be None for modes that don't set an arg. irc_MODE() collects them
+        # to send them out together.
+        changes = [(set, mode, arg) for mode, arg in zip(modes, args)]
+        if self.mode_changes is not None:
+            self.mode_changes.extend(changes)
+        else:
+            self._broadcast_modes(user, channel, changes)
+
+    def irc_MODE(self, prefix, params):
+        """Overrides IRCClient.irc_MODE to send out all the changes of a MODE
+        line together. If there is more than one, they also go out as one
+        irc.on_mode_change_batch event with a list of (set, mode, arg) tuples
+        in its changes attribute, and the single irc.on_mode_change events are
+        marked batched.
+
+        """
+        self.mode_changes = []
+        try:
+            irc.IRCClient.irc_MODE(self, prefix, params)
+            changes = self.mode_changes
+        finally:
+            self.mode_changes = None
+        if changes:
+            self._broadcast_modes(prefix, params[0], changes)
+
+    def _broadcast_modes(self, user, channel, changes):
+        # Servers give the users coming back from a netsplit their modes right
+        # after their joins. Those of users whose irc.on_netjoin isn't out yet
+        # go in it too, so plugins can take the users from it.
+        netjoin = self.netjoins.get(channel.lower())
+        if netjoin is not None:
+            joins = dict((join['user'].lower(), join) for join in netjoin[1])
+            for set, mode, arg in changes:
+                if arg is not None and arg.lower() in joins:
+                    joins[arg.lower()].setdefault("modes", []).append(
+                            (set, mode))
+        batched = len(changes) > 1
+        for set, mode, arg in changes:
             self.factory.broadcast_message("irc.on_mode_change",
-                    user=user, channel=channel, set=set, mode=mode, arg=arg)
+                    user=user, channel=channel, set=set, mode=mode, arg=arg,
+                    batched=batched)
+        if batched:
+            self.factory.broadcast_message("irc.on_mode_change_batch",
+                    user=user, channel=channel, changes=changes)
 
-    def userJoined(self, user, channel):
-        self.factory.broadcast_message("irc.on_user_joined",
-                user=user, channel=channel)
+    def irc_JOIN(self, prefix, params):
+        """Overrides IRCClient.irc_JOIN to understand extended-join, where the
+        JOIN line carries the account name and real name of the user after
+        the channel name.
+
+        """
+        nick = prefix.split("!")[0]
+        channel = params[0]
+        if nick == self.nickname:
+            self.joined(channel)
+        elif "extended-join" in self.caps and len(params) >= 2:
+            account = params[1] if params[1] != "*" else None
+            self.userJoined(nick, channel, hostmask=prefix, account=account)
+        else:
+            self.userJoined(nick, channel, hostmask=prefix)
+
+    def userJoined(self, user, channel, **kwargs):
+        """Someone joined a channel we're in. If known, the event also has the
+        attributes hostmask, and (with extended-join) account, which is None
+        if the user is not logged in.
+
+        Users lost in a netsplit in the last netsplit_memory seconds are
+        taken to be coming back from it. Their joins to a channel within
+        storm_window seconds of each other are also sent as one irc.on_netjoin
+        event, with the channel, the nicks in users, and the attributes of
+        the single irc.on_user_joined events (which are marked batched) as
+        dicts in joins. Mode changes made to them before it's sent are added
+        to their dicts as a list of (set, mode) tuples in modes.
+
+        """
+        lnick = user.lower()
+        split = self.split_nicks.get(lnick)
+        if split is not None and \
+                time() - split > self.factory.config['netsplit_memory']:
+            del self.split_nicks[lnick]
+            split = None
+        if split is None:
+            self.factory.broadcast_message("irc.on_user_joined",
+                    user=user, channel=channel, **kwargs)
+            return
+
+        kwargs.update(user=user, channel=channel)
+        lchannel = channel.lower()
+        if lchannel not in self.netjoins:
+            self.netjoins[lchannel] = (reactor.callLater(
+                self.factory.config['storm_window'],
+                self._flush_netjoin, lchannel), [])
+        self.netjoins[lchannel][1].append(kwargs)
+        self.factory.broadcast_message("irc.on_user_joined", batched=True,
+                **kwargs)
+
+    def _flush_netjoin(self, lchannel):
+        _, joins = self.netjoins.pop(lchannel)
+        self.factory.broadcast_message("irc.on_netjoin",
+                channel=joins[0]['channel'], users=[j['user'] for j in joins],
+                joins=joins)
+
+    def irc_ACCOUNT(self, prefix, params):
+        """With account-notify, the server tells us when users in our channels
+        log in or out. An account of * means they logged out.
+
+        """
+        account = params[0] if params[0] != "*" else None
+        self.factory.broadcast_message("irc.on_account",
+                user=prefix.split("!")[0], hostmask=prefix, account=account)
 
     def userLeft(self, user, channel):
         self.factory.broadcast_message("irc.on_user_part",
                 user=user, channel=channel)
 
     def userQuit(self, user, message):
+        """Someone quit. Quits with a netsplit's quit message that come within
+        storm_window seconds of each other are also sent as one irc.on_netsplit
+        event, with the two servers in servers and the nicks in users, and
+        the single irc.on_user_quit events are marked batched.
+
+        """
+        if not NETSPLIT_QUIT.match(message):
+            self.factory.broadcast_message("irc.on_user_quit",
+                    user=user, message=message)
+            return
+
+        nick = user.split("!", 1)[0]
+        now = time()
+        if message not in self.splits:
+            # A new netsplit. Forget the users of old ones that never came
+            # back.
+            memory = self.factory.config['netsplit_memory']
+            for lnick, split in list(self.split_nicks.items()):
+                if now - split > memory:
+                    del self.split_nicks[lnick]
+            self.splits[message] = (reactor.callLater(
+                self.factory.config['storm_window'],
+                self._flush_split, message), [])
+        self.split_nicks[nick.lower()] = now
+        self.splits[message][1].append(nick)
         self.factory.broadcast_message("irc.on_user_quit",
-                user=user, message=message)
+                user=user, message=message, batched=True)
+
+    def _flush_split(self, message):
+        _, nicks = self.splits.pop(message)
+        log.msg("Netsplit {0}: {1} users lost".format(message, len(nicks)))
+        self.factory.broadcast_message("irc.on_netsplit",
+                servers=tuple(message.split()), message=message, users=nicks)
 
     def userKicked(self, kickee, channel, kicker, message):
         self.factory.broadcast_message("irc.on_user_kick",
@@ -199,7 +1342,8 @@ class IRCBot(irc.IRCClient):
     def action(self, user, channel, data):
         """User performs an action on the channel"""
         self.factory.broadcast_message("irc.on_action",
-                user=user, channel=channel, data=data)
+                user=user, channel=channel, data=data,
+                **self._account_kwargs())
 
     def topicUpdated(self, user, channel, newtopic):
         self.factory.broadcast_message("irc.on_topic_updated",
@@ -209,6 +1353,16 @@ class IRCBot(irc.IRCClient):
         self.factory.broadcast_message("irc.on_nick_change",
                 oldnick=oldnick, newnick=newnick)
 
+    def nickChanged(self, nick):
+        """Our own nick changed. This is sent out as a nick change like any
+        other, so plugins tracking channel members see it too.
+
+        """
+        oldnick = self.nickname
+        irc.IRCClient.nickChanged(self, nick)
+        self.factory.broadcast_message("irc.on_nick_change",
+                oldnick=oldnick, newnick=nick)
+
     def irc_unknown(self, prefix, command, params):
         """This hooks into all sorts of miscellaneous things the server sends
         us, including whois replies
@@ -240,17 +1394,181 @@ class IRCBot(irc.IRCClient):
         else:
             irc.IRCClient.kick(self, channel, user, reason)
 
+IRCBot.DISPATCH = dispatch_table(IRCBot)
+
+class PoolConnection(protocol.ReconnectingClientFactory):
+    """The client factory for one of the extra connections in IRCBotPlugin's
+    pool (the plugin itself is the factory for the first one). Its IRCBot
+    talks to it like it would to the plugin, and it hands everything on to
+    the plugin, saying which connection it came from.
+
+    """
+    maxDelay = 60*5
+
+    def __init__(self, plugin, index, nick):
+        self.plugin = plugin
+        self.index = index
+        self.nick = nick
+        self.client = None
+        self.disconnect_timer = None
+        self.iostats = ConnectionStats(plugin.config['stats_samples'])
+
+    @property
+    def config(self):
+        return self.plugin.config
+
+    def buildProtocol(self, addr):
+        return self.plugin.build_client(self, self.nick)
+
+    def channels(self):
+        return self.plugin.channels_for(self.index)
+
+    def accept_line(self, client, prefix, command, params):
+        return self.plugin.accept_pooled_line(self.index, client, prefix,
+                command, params)
+
+    def broadcast_message(self, eventname, **kwargs):
+        if "tags" not in kwargs:
+            kwargs['tags'] = self.client.tags if self.client else {}
+        self.plugin.broadcast_message(eventname, connection=self.index,
+                **kwargs)
+
+    def replay_events(self, channel=None):
+        self.plugin.replay_events(channel)
+
+    def replay_unjoined(self, client):
+        self.plugin.replay_unjoined(client)
+
+    def drop_events(self, channel):
+        self.plugin.drop_events(channel)
 
 class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
     """Implements a bot plugin and a twisted protocol client factory.
 
+    Lines to the server are sent through an OutboundScheduler, configured
+    with flood_burst, flood_period and max_age (see that class). Events for
+    irc.do_msg, irc.do_say and irc.do_notice may have a priority attribute
+    naming the lane to send them in, e.g. priority="bulk" for long command
+    output. Messages are coalesced (see OutboundScheduler) if the coalesce
+    option is on, except those from events with coalesce=False, which go out
+    exactly as they were sent. irc.outbound_stats returns the scheduler's
+    stats, and irc.stats those along with the I/O metrics of the connection:
+    lines and bytes in and out, send queue depth samples, reconnects,
+    time-to-rejoin and lag (see ConnectionStats).
+
+    Once registered, each connection joins its channels with as few JOIN
+    lines as fit. Plugins send the queries that sync their view of a channel
+    after joining it (MODE, WHO and the like) with irc.do_sync events, which
+    are sent sync_interval seconds apart instead of all at once. When all the
+    channels are joined and their syncs sent, an irc.on_synced event says how
+    many seconds that took after connecting.
+
+    Bursts of events are also sent as batches, for plugins that handle them
+    in one go: irc.on_mode_change_batch for MODE lines with several changes,
+    and irc.on_netsplit and irc.on_netjoin for the quits and joins of a
+    netsplit (see IRCBot.irc_MODE, userQuit and userJoined). The single
+    events are still sent, with batched=True, for the plugins that don't
+    (see BotPlugin.BATCHED_EVENTS).
+
+    irc.do_* events that come in while we're disconnected are held in a
+    ReplayQueue, configured with replay_max, replay_ttl and replay_priority,
+    and sent once we're back (or in the channel they're for).
+
+    With pool_nicks, the plugin keeps a pool of connections: this one with
+    the configured nick, and one more for each nick in pool_nicks (see
+    PoolConnection). Each has its own flood allowance. The configured
+    channels are sharded over them with a HashRing, and each connection only
+    joins its own, plus the pool_shared_channels, which all of them join.
+    Every irc.on_* event has a connection attribute with the number of the
+    connection it came from (0 for this one). Lines that several connections
+    receive, like those in shared channels or a QUIT seen by all of them, are
+    only turned into events once. irc.do_* events go out on the connection in
+    their connection attribute, if they have one, so replies come from the
+    nick that was talked to, and otherwise on the one that owns their
+    channel, or the first one if they're not for a channel.
+
     """
     maxDelay = 60*5
+    DEFAULT_CONFIG = {
+            # The server's flood allowance: how many lines can be sent at once,
+            # and how many seconds it takes for another to be allowed
+            "flood_burst": 5,
+            "flood_period": 2,
+            # Maps lanes to how many seconds a line may wait before it's not
+            # worth sending anymore
+            "max_age": {"notice": 120, "bulk": 30},
+            # Whether to merge queued messages to the same target into fewer
+            # lines, how many seconds to hold messages for more to merge with,
+            # and what to join their texts with
+            "coalesce": True,
+            "coalesce_delay": 0,
+            "coalesce_separator": " | ",
+            # How many seconds apart the quits of a netsplit and the joins
+            # after it may come to be sent as one event, and how long after a
+            # netsplit joins of the users it lost are taken for its end
+            "storm_window": 1,
+            "netsplit_memory": 600,
+            # How often to sample the send queue depth and how many samples
+            # to keep, and how often to PING the server to measure the lag
+            # (0 for never), for irc.stats
+            "stats_interval": 10,
+            "stats_samples": 360,
+            "lag_interval": 60,
+            # Seconds between the lines plugins send with irc.do_sync to sync
+            # their state of a channel after joining it
+            "sync_interval": 1,
+            # irc.do_* events that come in while we're not connected are held
+            # and replayed once we are (see ReplayQueue). At most replay_max
+            # of them, each for as many seconds as replay_ttl says for its
+            # type (5 minutes if it doesn't say, and not at all for 0). When
+            # it's full, those with the lowest replay_priority go first.
+            "replay_max": 500,
+            "replay_ttl": {
+                "irc.do_quit": 0,
+                "irc.do_whois": 30,
+                "irc.do_notice": 120,
+                "irc.do_kick": 600,
+                "irc.do_mode": 3600,
+                "irc.do_join_channel": 3600,
+                "irc.do_leave_channel": 3600,
+                "irc.do_setnick": 3600,
+                "irc.do_away": 3600,
+                "irc.do_back": 3600,
+                },
+            # Nicks for extra connections, and channels all of them join
+            "pool_nicks": [],
+            "pool_shared_channels": [],
+            "replay_priority": {
+                "irc.do_mode": 3,
+                "irc.do_kick": 3,
+                "irc.do_join_channel": 3,
+                "irc.do_leave_channel": 3,
+                "irc.do_topic": 2,
+                "irc.do_setnick": 2,
+                "irc.do_msg": 1,
+                "irc.do_say": 1,
+                "irc.do_raw": 1,
+                },
+            }
 
     def start(self):
         self.client = None
+        self.disconnect_timer = None
+        self.replay = ReplayQueue(self.config['replay_max'],
+                self.config['replay_ttl'], priority=self.config['replay_priority'])
         self.listen_for_event("irc.do_*")
-        self.connector = reactor.connectSSL(self.config['server'], self.config['port'], self, ClientContextFactory())
+
+        # The connection pool. This plugin is the factory of the first one.
+        self.index = 0
+        self.iostats = ConnectionStats(self.config['stats_samples'])
+        self.pool = [self] + [PoolConnection(self, index, nick)
+                for index, nick in enumerate(self.config['pool_nicks'], 1)]
+        self.ring = HashRing(len(self.pool))
+        # Maps lines recently received on some connection of the pool that
+        # the others may receive as well to when they were received
+        self.recent_lines = OrderedDict()
+        self.connectors = [self._connect(factory) for factory in self.pool]
+        self.connector = self.connectors[0]
 
         # Set a quit handler
         def shutdown():
@@ -266,32 +1584,124 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
 
         self.provides_request("irc.getnick")
         self.provides_request("irc.get_channel_mode_params")
+        self.provides_request("irc.supported")
+        self.provides_request("irc.outbound_stats")
+        self.provides_request("irc.stats")
+
+    def _connect(self, factory):
+        if self.config.get("ssl", True):
+            return reactor.connectSSL(self.config['server'], self.config['port'], factory, ClientContextFactory())
+        else:
+            return reactor.connectTCP(self.config['server'], self.config['port'], factory)
 
     def stop(self):
         log.msg("IRCBotPlugin stopping...")
         if self.shutdown_trigger is not None:
             reactor.removeSystemEventTrigger(self.shutdown_trigger)
-        self.stopTrying()
-        if self.client:
-            log.msg("Sending quit message")
-            self.client.quit("Daisy, daisy...")
+        for factory, connector in zip(self.pool, self.connectors):
+            factory.stopTrying()
+            if factory.client:
+                log.msg("Sending quit message")
+                factory.client.quit("Daisy, daisy...")
 
-        # The server should disconnect us after a QUIT command, but just in
-        # case, terminate the connection after 5 seconds.
-        reactor.callLater(5, self.connector.disconnect)
+            # The server should disconnect us after a QUIT command, but just
+            # in case, terminate the connection after 5 seconds.
+            factory.disconnect_timer = reactor.callLater(5,
+                    connector.disconnect)
 
     def buildProtocol(self, addr):
+        return self.build_client(self, self.config['nick'])
+
+    def build_client(self, factory, nick):
+        """Builds the protocol object for a connection of the pool"""
         p = IRCBot()
-        p.factory = self
-        p.nickname = self.config['nick']
+        p.factory = factory
+        p.nickname = nick
         p.password = self.config.get("password", None)
         return p
 
+    def owner(self, channel):
+        """The number of the connection of the pool that owns a channel"""
+        return self.ring.get(channel)
+
+    def channels_for(self, index):
+        """The channels the given connection of the pool should join"""
+        shared = self.config['pool_shared_channels']
+        lshared = set(irc_lower(channel) for channel in shared)
+        return [channel for channel in self.config['channels']
+                if irc_lower(channel) not in lshared and
+                self.owner(channel) == index] + list(shared)
+
+    def channels(self):
+        return self.channels_for(self.index)
+
+    # Commands that are about the channel in their first param, and commands
+    # every connection that shares a channel with the user receives
+    CHANNEL_COMMANDS = frozenset(["PRIVMSG", "NOTICE", "JOIN", "PART", "KICK",
+        "MODE", "TOPIC"])
+    USER_COMMANDS = frozenset(["QUIT", "NICK", "ACCOUNT", "AWAY", "CHGHOST"])
+
+    def accept_line(self, client, prefix, command, params):
+        return self.accept_pooled_line(self.index, client, prefix, command,
+                params)
+
+    def accept_pooled_line(self, index, client, prefix, command, params):
+        """Tells whether the given connection of the pool should handle a
+        line it received, or leave it to another connection that received
+        the same line.
+
+        Lines about a channel are handled by the channel's owner (or, if the
+        owner is down, the next connection on the ring that's up), and lines
+        about a user that every
+        connection in a channel with them receives are handled by the first
+        one to receive them. Lines about our own nick, and server replies, are
+        always handled.
+
+        """
+        if len(self.pool) == 1:
+            return True
+        if prefix.split("!", 1)[0] == client.nickname:
+            return True
+        if command in self.CHANNEL_COMMANDS and params and \
+                params[0][:1] in irc.CHANNEL_PREFIXES:
+            return self.ring.get(params[0], lambda node:
+                    self.pool[node].client is not None) == index
+        if command in self.USER_COMMANDS:
+            now = time()
+            while self.recent_lines and \
+                    next(iter(self.recent_lines.values())) < now - 5:
+                self.recent_lines.popitem(last=False)
+            key = (prefix, command, tuple(params))
+            if key in self.recent_lines:
+                return False
+            self.recent_lines[key] = now
+        return True
+
+    def route(self, event):
+        """Returns the factory of the connection of the pool an irc.do_*
+        event should be sent on
+
+        """
+        connection = getattr(event, "connection", None)
+        if connection is not None and 0 <= connection < len(self.pool):
+            return self.pool[connection]
+        if event.eventtype in ("irc.do_join_channel", "irc.do_leave_channel"):
+            channel = event.channel
+        else:
+            channel = ReplayQueue.channel_of(event)
+        if channel is not None:
+            return self.pool[self.owner(channel)]
+        return self
+
     def broadcast_message(self, eventname, **kwargs):
         """This method is called by the client protocol object when an event
-        comes in from the network
+        comes in from the network. The event gets a tags attribute with the
+        IRCv3 message tags of the line it came from.
         
         """
+        if "tags" not in kwargs:
+            kwargs['tags'] = self.client.tags if self.client else {}
+        kwargs.setdefault("connection", 0)
         event = Event(eventname, **kwargs)
         self.transport.send_event(event)
 
@@ -299,8 +1709,13 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
         """A command received from another plugin. We must pass it on to the client
 
         """
-        if not self.client:
-            # TODO buffer the requests if the client is not currently connected
+        # Hold the event if we can't send it yet, or if events for the same
+        # channel are still being held, so it doesn't overtake them
+        client = self.route(event).client
+        channel = ReplayQueue.channel_of(event)
+        if not client or not client._registered or (
+                channel is not None and self.replay.pending(channel)):
+            self.replay.add(event)
             return
 
         # Maps event names to (method names, arguments) that should be called
@@ -325,6 +1740,7 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
             'irc.do_setnick':       ('setNick', ('nickname',)),
             'irc.do_quit':          ('quit',    ('message',)),
             'irc.do_raw':           ('sendLine',('line',)),
+            'irc.do_sync':          ('sync',    ('line', 'channel')),
             }
 
         methodname, methodargs = events[event.eventtype]
@@ -337,15 +1753,95 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
             except AttributeError:
                 pass
 
-        method = getattr(self.client, methodname)
-        method(**kwargs)
+        method = getattr(client, methodname)
+        client.lane = getattr(event, "priority", None)
+        client.coalesce = getattr(event, "coalesce", True)
+        try:
+            method(**kwargs)
+        finally:
+            client.lane = None
+            client.coalesce = True
 
-    def on_request_irc_getnick(self):
-        return defer.succeed(self.client.nickname)
+    def replay_events(self, channel=None):
+        """Sends the events held for the given channel, now that we're in it,
+        or with None, the ones held for the connection, now that we're
+        registered
+
+        """
+        events = self.replay.take(channel)
+        if events:
+            log.msg("Replaying {0} held events{1}".format(len(events),
+                " for " + channel if channel else ""))
+        for event in events:
+            self.received_event(event)
+
+    def replay_unjoined(self, client):
+        """Sends the events held for the channels the given client, which
+        just registered, is routed to but isn't joining. They'd otherwise
+        wait for a join that isn't coming.
+
+        """
+        for channel in self.replay.channels():
+            if self.pool[self.owner(channel)].client is client and \
+                    channel not in client.joining:
+                self.replay_events(channel)
+
+    def drop_events(self, channel):
+        """Drops the events held for a channel we couldn't join"""
+        dropped = self.replay.drop(channel)
+        if dropped:
+            log.msg("Dropped {0} held events for {1}".format(dropped, channel))
+
+    def on_request_irc_getnick(self, channel=None, connection=None):
+        """Returns our nick on the connection of the pool that owns the given
+        channel, or on the given connection, or on the first one. Returns None
+        if that connection is down.
+
+        """
+        if connection is not None:
+            factory = self.pool[connection]
+        elif channel is not None and channel[:1] in irc.CHANNEL_PREFIXES:
+            factory = self.pool[self.owner(channel)]
+        else:
+            factory = self
+        if factory.client is None:
+            return defer.succeed(None)
+        return defer.succeed(factory.client.nickname)
 
     def on_request_irc_get_channel_mode_params(self):
         return self.client.getChannelModeParams()
 
+    def on_request_irc_supported(self, feature, default=None):
+        """Returns the value of a feature the server advertised in its
+        RPL_ISUPPORT (005) lines, or default if it didn't advertise it.
+        Features given without a value, such as WHOX, have a value of ('',)
+
+        """
+        if not self.client:
+            return default
+        return self.client.supported.getFeature(feature, default)
+
+    def on_request_irc_outbound_stats(self, connection=0):
+        """Returns the stats of the OutboundScheduler of the given connection
+        of the pool, or None if it's not connected
+
+        """
+        client = self.pool[connection].client
+        if not client:
+            return None
+        return client.scheduler.stats()
+
+    def on_request_irc_stats(self, connection=0):
+        """Returns the I/O metrics of the given connection of the pool (see
+        ConnectionStats), with whether it's connected, and the stats of its
+        OutboundScheduler in outbound (None if it's not connected)
+
+        """
+        factory = self.pool[connection]
+        stats = factory.iostats.as_dict()
+        stats['connected'] = factory.client is not None
+        stats['outbound'] = self.on_request_irc_outbound_stats(connection)
+        return stats
 
 class IRCController(CommandPluginSuperclass):
     """This plugin provides a few administrative tasks in conjunction with the
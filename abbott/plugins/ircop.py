@@ -1,13 +1,20 @@
 import glob
 from collections import defaultdict
+import errno
+import math
 import time
+import os
 import os.path
 
-from twisted.python import log
-from twisted.internet import defer
+from zope.interface import implementer
+
+from twisted.python import failure, log
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import IWriteDescriptor
 
 from ..transport import Event
 from ..pluginbase import BotPlugin, EventWatcher, non_reentrant
+from ..hostmask import mask_key
 
 """
 IRC OP-related plugins. This is meant to replace the old admin.* plugins with a
@@ -51,33 +58,194 @@ class OpFailed(Exception):
     """
     pass
 
+# The longest line an IRC server accepts, not counting the trailing CRLF
+MAX_LINE = 510
+
+# The usual list and member modes, for servers that don't tell us theirs
+PER_TARGET_MODES = "beIqohv"
+
+def plan_modes(channel, changes, max_modes=3, maxlen=MAX_LINE,
+        per_target=PER_TARGET_MODES, is_noop=None):
+    """Packs a list of mode changes into as few MODE lines as possible.
+
+    changes is a list of (mode, param) tuples in the order they were
+    requested, where mode is a sign and a mode letter such as "+v", and param
+    is the parameter or None.
+
+    max_modes is the most mode changes the server accepts in one line (the
+    MODES ISUPPORT token), or None for no limit. Lines are also kept within
+    maxlen bytes.
+
+    per_target is a string of the mode letters that apply to their parameter
+    rather than to the channel as a whole, that is the list modes such as b
+    and the member modes such as v. Changes to the same thing cancel out: of
+    +v nick and -v nick, only the one requested last is kept. For other modes
+    only the last change of each letter is kept.
+
+    is_noop, if given, is a function taking a mode and a param which returns
+    True if the change wouldn't change anything in the channel. Such changes
+    are dropped.
+
+    Returns a list of lines, without the trailing CRLF, to send to the server.
+    The order of the requested changes is preserved.
+
+    """
+    # Keep only the last change to each thing
+    last = {}
+    for i, (mode, param) in enumerate(changes):
+        if mode[1] in per_target:
+            key = (mode[1], (param or "").lower())
+        else:
+            key = mode[1]
+        last[key] = i
+    keep = sorted(last.values())
+
+    lines = []
+    modestr, params, count = "", [], 0
+    for i in keep:
+        mode, param = changes[i]
+        if is_noop is not None and is_noop(mode, param):
+            continue
+
+        # Only write the sign if it's different from the previous change's
+        if not modestr:
+            sign = None
+        elif modestr.rfind("+") > modestr.rfind("-"):
+            sign = "+"
+        else:
+            sign = "-"
+        newmodestr = modestr + (mode[1] if mode[0] == sign else mode)
+        newparams = params + [param] if param else params
+        line = " ".join(["MODE", channel, newmodestr] + newparams)
+
+        if count and ((max_modes and count >= max_modes) or
+                len(line.encode("UTF-8")) > maxlen):
+            # Doesn't fit. Start a new line.
+            lines.append(" ".join(["MODE", channel, modestr] + params))
+            newmodestr = mode
+            newparams = [param] if param else []
+            count = 0
+
+        modestr, params = newmodestr, newparams
+        count += 1
+
+    if count:
+        lines.append(" ".join(["MODE", channel, modestr] + params))
+    return lines
+
+@implementer(IWriteDescriptor)
+class _FifoWriter(object):
+    """Writes to a FIFO without blocking the reactor. Data is queued and
+    written out in as few writes as the pipe has room for whenever it's
+    writable. Opening fails with ENXIO if nothing has the FIFO open for
+    reading.
+
+    on_lost is called with the writer and the reason once the pipe is closed
+    or broken.
+
+    """
+    def __init__(self, path, on_lost):
+        self.fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        self.on_lost = on_lost
+        self.buffer = b""
+        self.writing = False
+
+    def fileno(self):
+        return self.fd
+
+    def logPrefix(self):
+        return "FifoWriter"
+
+    def write(self, data):
+        self.buffer += data
+        if not self.writing:
+            self.writing = True
+            reactor.addWriter(self)
+
+    def doWrite(self):
+        try:
+            written = os.write(self.fd, self.buffer)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # Pipe's full. Try again when it's writable
+                return None
+            return e
+        self.buffer = self.buffer[written:]
+        if not self.buffer:
+            self.writing = False
+            reactor.removeWriter(self)
+
+    def connectionLost(self, reason):
+        if self.fd == -1:
+            return
+        reactor.removeWriter(self)
+        self.writing = False
+        os.close(self.fd)
+        self.fd = -1
+        self.on_lost(self, reason)
+
 class WeechatConnector(BotPlugin):
     """Listens for requests of the form connector.weechat.X where X is one of:
     op, deop, quiet, unquiet, voice, devoice. Each request takes a channel name
     and nick as parameters. Sends the request to Chanserv via a local weechat
     instance.
 
+    The FIFO is found and opened once and kept open. If weechat isn't running
+    or stops reading, requests fail with OpFailed, and the FIFO is looked for
+    again on the next one.
+
     """
-    DEFAULT_CONFIG = {"weechat_server": "irc.server.freenode"}
+    DEFAULT_CONFIG = {
+            "weechat_server": "irc.server.freenode",
+            "fifo": "~/.weechat/weechat_fifo_*",
+            # How many bytes of commands we'll queue for weechat before
+            # deciding it's not keeping up
+            "max_queued": 4096,
+            }
     def start(self):
         super(WeechatConnector, self).start()
 
+        self.writer = None
+
         for operation in ("op", "deop", "quiet", "unquiet", "voice", "devoice", "topic"):
             self.provides_request("connector.weechat.{0}".format(operation))
 
+    def stop(self):
+        if self.writer is not None:
+            self.writer.connectionLost(None)
+        super(WeechatConnector, self).stop()
+
+    def _get_writer(self):
+        if self.writer is None:
+            paths = glob.glob(os.path.expanduser(self.config['fifo']))
+            if not paths:
+                raise OpFailed("I can't find weechat's FIFO")
+            try:
+                self.writer = _FifoWriter(paths[0], self._writer_lost)
+            except OSError as e:
+                log.msg("Could not open weechat FIFO {0}: {1}".format(paths[0], e))
+                raise OpFailed("weechat isn't running")
+        return self.writer
+
+    def _writer_lost(self, writer, reason):
+        log.msg("Weechat FIFO closed: {0}".format(reason))
+        if self.writer is writer:
+            self.writer = None
+
     def incoming_request(self, reqname, channel, nick):
         operation = reqname.split(".")[-1].upper()
 
-        path = glob.glob(os.path.expanduser("~/.weechat/weechat_fifo_*"))[0]
+        writer = self._get_writer()
+        if len(writer.buffer) >= self.config['max_queued']:
+            raise OpFailed("weechat isn't keeping up")
 
         log.msg("Weechat connector sending command {0} {1} {2}".format(operation, channel, nick))
-        with open(path, 'w') as out:
-            out.write("{weechat_server} */msg ChanServ {op} {channel} {nick}\n".format(
+        writer.write("{weechat_server} */msg ChanServ {op} {channel} {nick}\n".format(
                 weechat_server=self.config['weechat_server'],
                 op=operation,
                 channel=channel,
                 nick=nick,
-                ))
+                ).encode("UTF-8"))
 
 class ChanservConnector(BotPlugin):
     """Listens for requests of the form connector.chanserv.X where X is one of:
@@ -86,22 +254,83 @@ class ChanservConnector(BotPlugin):
     the bot is logged in and identified and has permission to perform the
     request.
 
+    Requests for the same channel and operation that arrive within the
+    configured window are sent as one command with several nicks, e.g.
+    "VOICE #channel nick1 nick2", which ChanServ (Atheme and Anope) accepts.
+    Each request's deferred fires when the command with its nick was sent.
+    Topic requests have a single parameter and are sent right away.
+
     """
+    DEFAULT_CONFIG = {
+            # How long to gather requests for one command, in seconds
+            "window": 0.1,
+            }
+    OPERATIONS = ("op", "deop", "quiet", "unquiet", "voice", "devoice", "topic")
+
     def start(self):
         super(ChanservConnector, self).start()
 
-        for operation in ("op", "deop", "quiet", "unquiet", "voice", "devoice", "topic"):
+        # Maps (channel, operation) to a list of (nick, deferred) waiting to
+        # be sent, and to the DelayedCall that sends them
+        self.pending = {}
+        self.timers = {}
+
+        for operation in self.OPERATIONS:
             self.provides_request("connector.chanserv.{0}".format(operation))
 
+    def stop(self):
+        # Don't lose anything that was asked for
+        for key in list(self.pending):
+            self._flush(key)
+        super(ChanservConnector, self).stop()
+
     def incoming_request(self, reqname, channel, nick):
         operation = reqname.split(".")[-1].upper()
 
-        self.transport.send_event(Event("irc.do_msg",
-            user="ChanServ",
-            message="{op} {channel} {nick}".format(
+        if operation == "TOPIC":
+            self._send(operation, channel, [nick])
+            return
+
+        key = (channel, operation)
+        d = defer.Deferred()
+        self.pending.setdefault(key, []).append((nick, d))
+        timer = self.timers.get(key)
+        if timer is None or not timer.active():
+            self.timers[key] = reactor.callLater(self.config['window'],
+                    self._flush, key)
+        return d
+
+    def _flush(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        channel, operation = key
+
+        # Pack as many nicks as fit on a line into each command
+        maxlen = MAX_LINE - len("PRIVMSG ChanServ :")
+        base = len(operation) + 1 + len(channel)
+        batch, length = [], base
+        for nick, d in self.pending.pop(key, []):
+            if batch and length + 1 + len(nick) > maxlen:
+                self._send(operation, channel, [n for n, _ in batch])
+                for _, waiting in batch:
+                    waiting.callback(None)
+                batch, length = [], base
+            batch.append((nick, d))
+            length += 1 + len(nick)
+        if batch:
+            self._send(operation, channel, [n for n, _ in batch])
+            for _, waiting in batch:
+                waiting.callback(None)
+
+    def _send(self, operation, channel, nicks):
+        # Sent raw, since irc.do_msg would split a full line in its guess at
+        # how long our hostmask might be
+        self.transport.send_event(Event("irc.do_raw",
+            line="PRIVMSG ChanServ :{op} {channel} {nicks}".format(
                 op=operation,
                 channel=channel,
-                nick=nick),
+                nicks=" ".join(nicks)),
             ))
 
 class OpProvider(EventWatcher, BotPlugin):
@@ -111,6 +340,10 @@ class OpProvider(EventWatcher, BotPlugin):
     All take a first parameter: channel. All except topic take a second
     parameter: a hostmask or nick.
 
+    Also provides ircop.list, which takes a channel and a list mode letter (b
+    by default) and returns the entries in that list as (mask, setter, time)
+    tuples. Ban and quiet requests that wouldn't change the list are skipped.
+
     Also provides ircop.become_op which takes two parameters: a channel name
     and a duration, in seconds. When called, the bot will attempt to acquire op
     status in the given channel and  hold it for (at least) the given duration.
@@ -120,12 +353,16 @@ class OpProvider(EventWatcher, BotPlugin):
     required the bot gain OP but OP could not be acquired.
 
     The plugin will automatically deop itself after performing operations if
-    the config defines a way to gain OP.
+    the config defines a way to gain OP. If requests keep coming in faster
+    than op can be re-acquired, it keeps op a while longer instead, and the
+    time it waits to batch requests together grows with their rate. See
+    _batch_window() and _predicted_hold().
 
     Requests are internally buffered and batched so that several simultaneous
     requests will all be submitted with one OP+DEOP cycle. For this to work,
     callers should submit all requests before waiting for any of them to
-    callback/errback.
+    callback/errback. The *_many requests (e.g. ircop.voice_many) do this for
+    you: they take a list of targets and return one deferred.
 
     (If you wait for each submitted operation, then you end up waiting for each
     one to be completely processed before the next one, forcing each operation
@@ -136,7 +373,18 @@ class OpProvider(EventWatcher, BotPlugin):
 
     """
     REQUIRES = ["ircutil.HasOp", "ircutil.ChanMode"]
-    DEFAULT_CONFIG = {"opmethod": dict()}
+    DEFAULT_CONFIG = {
+            "opmethod": dict(),
+            # Bounds for how long to wait for more requests before processing
+            # the buffers, in seconds
+            "min_window": 0.2,
+            "max_window": 2,
+            # The longest we'll keep op because we expect more requests, in
+            # seconds
+            "max_hold": 60,
+            # Over how many seconds the request rate is averaged
+            "rate_period": 30,
+            }
 
     ### Definition of various requests provided by this plugin
     # Connector requests are requests that can be performed by a connector
@@ -150,6 +398,15 @@ class OpProvider(EventWatcher, BotPlugin):
     # ourself; they don't have a connector implementation. These are all
     # implemented by a method of the form _do_{name}
     OTHER_REQS = frozenset(['kick', 'become_op', 'mode', 'ban', 'unban'])
+    # The list modes the chanmode plugin keeps the lists of. Setting a mask
+    # that's already in one, or removing one that isn't, is skipped.
+    LIST_MODES = "bqeI"
+    # Bulk versions of the above, named {name}_many. They take a list of
+    # targets in place of the single target (for mode_many, a list of (mode,
+    # param) tuples), submit them all at once and fire with a dict of results
+    # per target. Implemented by _do_many
+    MANY_REQS = frozenset(name + "_many" for name in
+            (CONNECTOR_REQS | OTHER_REQS) - set(['topic', 'become_op']))
 
     def start(self):
         super(OpProvider, self).start()
@@ -158,32 +415,72 @@ class OpProvider(EventWatcher, BotPlugin):
         # Used to keep track of op requests from the become_op request call.
         self.op_until = defaultdict(float)
 
-        # A unix timestamp for when we should process the buffers. Set by
-        # _set_buffer_processor_timer()
-        self.buffer_timer = defaultdict(float)
+        # Per-channel DelayedCalls. buffer_timers process the buffers, set by
+        # _set_buffer_processor_timer(). deop_timers deop us once op_until is
+        # reached, set by _do_become_op(). Each is moved in place with reset()
+        # rather than replaced.
+        self.buffer_timers = {}
+        self.deop_timers = {}
+        # When the first item went into each channel's buffers since they
+        # were last processed. A steady stream of requests pushes the buffer
+        # timer back, but never past max_window after this.
+        self.first_buffered = {}
+        # Saves the config once after a run of joins, set by
+        # on_event_irc_on_join()
+        self.save_timer = None
+
+        # When we got op in each channel we have it in
+        self.op_since = {}
+
+        # Per-channel moving averages of how long it takes to get op through
+        # a connector, and of the rate of requests as (rate, time of last
+        # update) tuples. These decide how long to wait for requests to batch
+        # and whether to keep op after a batch.
+        self.op_latency = {}
+        self.request_rate = {}
+
+        # Channels where we're keeping op because more requests are expected,
+        # and until when
+        self.hold_until = defaultdict(float)
+        self.holding = set()
+
+        # Counters for the ircop.stats request
+        self.stats = defaultdict(int)
 
         # This plugin keeps three internel buffers per channel, stored in the
         # following three attribute variables. Each is a dict mapping channel
-        # names to a set of tuples.
-        # mode_buffer sets contain (mode, argument, deferred)
+        # names to a set of tuples, except for mode_buffer, which holds a list
+        # since the order of mode changes matters.
+        # mode_buffer lists contain (mode, argument, deferred)
         # event_buffer sets contain (Event, deferred)
         # connector_buffer sets contain (operation_name, param, deferred)
         # The typical workflow is for handler methods to add an item to one or
         # more of the buffers and then call _set_buffer_processor_timer(),
         # which will set a timer to process the buffer after a brief delay.
-        self.mode_buffer = defaultdict(set)
+        self.mode_buffer = defaultdict(list)
         self.event_buffer = defaultdict(set)
         self.connector_buffer = defaultdict(set)
 
         # Register the requests we handle
-        for operation in self.CONNECTOR_REQS | self.OTHER_REQS:
+        for operation in self.CONNECTOR_REQS | self.OTHER_REQS | self.MANY_REQS:
             self.provides_request("ircop.{0}".format(operation))
+        self.provides_request("ircop.stats")
+        self.provides_request("ircop.list")
 
         # Events we listen for
         self.listen_for_event("ircutil.hasop.acquired")
         self.listen_for_event("ircutil.hasop.lost")
         self.listen_for_event("irc.on_join")
 
+    def stop(self):
+        for timer in list(self.buffer_timers.values()) + list(self.deop_timers.values()):
+            if timer.active():
+                timer.cancel()
+        if self.save_timer is not None and self.save_timer.active():
+            self.save_timer.cancel()
+            self.config.save()
+        super(OpProvider, self).stop()
+
     def reload(self):
         super(OpProvider, self).reload()
         
@@ -201,12 +498,46 @@ class OpProvider(EventWatcher, BotPlugin):
         if undefined_reqs:
             for x in undefined_reqs:
                 self.config["opmethod"][channel][x] = None
-            self.config.save()
+            # We join all our channels at once when we connect. Save once
+            # for all of them.
+            if self.save_timer is None or not self.save_timer.active():
+                self.save_timer = reactor.callLater(1, self.config.save)
+
+    def on_event_ircutil_hasop_acquired(self, event):
+        self.op_since[event.channel] = time.time()
+
+    def on_event_ircutil_hasop_lost(self, event):
+        channel = event.channel
+        since = self.op_since.pop(channel, None)
+        if since is not None:
+            length = time.time() - since
+            self.stats['op_sessions'] += 1
+            self.stats['op_seconds'] += length
+            self.stats['longest_op_session'] = max(
+                    self.stats['longest_op_session'], length)
+
+        self.holding.discard(channel)
+        timer = self.deop_timers.pop(channel, None)
+        if timer is not None and timer.active():
+            # Lost op by something else? Manual intervention? okay fine
+            # cancel this
+            log.msg("Op cancelled before timer. Did you do that?")
+            timer.cancel()
+            self.op_until[channel] = time.time()
 
     def incoming_request(self, reqname, *args, **kwargs):
         # Request dispatch
         # Choose the appropriate handler here.
         reqname = reqname.split(".")[-1]
+        if reqname == "stats":
+            return self._do_stats()
+        if reqname == "list":
+            return self._do_list(*args, **kwargs)
+        if reqname in self.MANY_REQS:
+            return self._do_many(reqname[:-len("_many")], *args, **kwargs)
+        return self._dispatch(reqname, *args, **kwargs)
+
+    def _dispatch(self, reqname, *args, **kwargs):
         if reqname in self.CONNECTOR_REQS:
             return self._do_connector_operation(reqname, *args, **kwargs)
         elif reqname in self.OTHER_REQS:
@@ -232,13 +563,15 @@ class OpProvider(EventWatcher, BotPlugin):
         # watcher is active. Actually I don't think a race condition is even
         # possible, but it doesn't hurt to do this anyways. (notice how we
         # don't yield-wait for this until after)
-        op_waiter = self.wait_for(Event("ircutil.hasop.acquired"), timeout=30)
+        op_waiter = self.wait_for(Event("ircutil.hasop.acquired", channel=channel),
+                timeout=30)
+        requested = time.time()
 
         connector = self.config["opmethod"][channel].get("op")
         if not connector:
             raise OpFailed("I have no way to acquire op in {0}".format(channel))
 
-        nick = (yield self.transport.issue_request("irc.getnick"))
+        nick = (yield self.transport.issue_request("irc.getnick", channel))
 
         log.msg("We need op. Asking the {0} connector".format(connector))
         try:
@@ -255,34 +588,79 @@ class OpProvider(EventWatcher, BotPlugin):
         if not (yield op_waiter):
             raise OpFailed("Timeout waiting for OP. Do I have the correct permission with e.g. Chanserv?")
 
-    @non_reentrant(channel=1)
-    @defer.inlineCallbacks
-    def _deop_later(self, channel):
-        """Waits until the current time reaches the timestamp stored in
-        self.op_until, and then issues a deop request
+        latency = time.time() - requested
+        if channel in self.op_latency:
+            latency = 0.7 * self.op_latency[channel] + 0.3 * latency
+        self.op_latency[channel] = latency
+        self.stats['op_cycles'] += 1
 
-        This should be called after setting self.op_until[channel] to some
-        timestamp in the future. Right now it is only called from
-        _do_become_op().
+    def _get_request_rate(self, channel, now=None):
+        """Returns the recent rate of requests in the channel, in requests
+        per second
 
-        Returns a deferred that fires when we deop. but it doesn't make much
-        sense to wait for it. at least not in the context of _do_become_op()       
+        """
+        if now is None:
+            now = time.time()
+        rate, updated = self.request_rate.get(channel, (0, now))
+        return rate * math.exp((updated - now) / self.config['rate_period'])
+
+    def _note_request(self, channel):
+        now = time.time()
+        self.request_rate[channel] = (
+                self._get_request_rate(channel, now) + 1.0 / self.config['rate_period'],
+                now)
+
+    def _batch_window(self, channel):
+        """How long to wait for more requests before processing the buffers.
+        If requests are coming in quickly, wait long enough that the next one
+        will probably make it into this batch, up to max_window. Otherwise
+        don't wait any longer than needed.
 
         """
-        while self.op_until[channel] - time.time() > 0:
-            if (yield self.wait_for(
-                    Event("irc.hasop.lost", channel=channel),
-                    timeout=self.op_until[channel] - time.time())
-                    ):
-                # Lost op by something else? Manual intervention? okay fine
-                # cancel this
-                log.msg("Op cancelled before timer. Did you do that?")
-                self.op_until[channel] = time.time()
-                return
+        rate = self._get_request_rate(channel)
+        if not rate:
+            return self.config['min_window']
+        return min(self.config['max_window'],
+                max(self.config['min_window'], 2.0 / rate))
+
+    def _predicted_hold(self, channel):
+        """How long to keep op after processing a batch. If at the current
+        request rate we expect another request before we could get op back
+        through a connector, keep op long enough for a few more requests.
+        Otherwise, returns 0 to deop right away.
+
+        """
+        rate = self._get_request_rate(channel)
+        latency = self.op_latency.get(channel)
+        if not rate or latency is None or rate * latency < 1:
+            return 0
+        return min(self.config['max_hold'], 3.0 / rate)
 
+    def _deop_later(self, channel):
+        """Sets the deop timer for the channel to fire when the current time
+        reaches the timestamp stored in self.op_until, at which point we issue
+        a deop request. If the timer is already running it is moved.
+
+        This should be called after setting self.op_until[channel] or
+        self.hold_until[channel] to some timestamp in the future. It is called
+        from _do_become_op() and _process_buffer().
+
+        """
+        delay = max(0, max(self.op_until[channel], self.hold_until[channel]) - time.time())
+        timer = self.deop_timers.get(channel)
+        if timer is not None and timer.active():
+            timer.reset(delay)
+        else:
+            self.deop_timers[channel] = reactor.callLater(delay,
+                    self._deop_timer_fired, channel)
+
+    @defer.inlineCallbacks
+    def _deop_timer_fired(self, channel):
+        del self.deop_timers[channel]
+        self.holding.discard(channel)
         log.msg("op_until reached: issuing a -o mode request in {0}".format(channel))
         yield self._do_mode(channel, "-o",
-                (yield self.transport.issue_request("irc.getnick")),
+                (yield self.transport.issue_request("irc.getnick", channel)),
                 )
 
     def _set_buffer_processor_timer(self, channel):
@@ -302,35 +680,65 @@ class OpProvider(EventWatcher, BotPlugin):
         This method returns no value, and returns immediately.
 
         """
-        # The time to wait here pretty much doesn't matter, because as a
-        # minimum we must wait for chanserv to respond and op us, which
-        # typically takes around 2 seconds, and could be as many as 20.
+        # The time to wait here pretty much doesn't matter if we need op,
+        # because as a minimum we must wait for chanserv to respond and op us,
+        # which typically takes around 2 seconds, and could be as many as 20.
         # It should still be small, however, so that requests when we're
         # already OP go through quickly, but still leaves enough time to yield
-        # to other code that may want to submit more requests
-        self.buffer_timer[channel] = time.time() + 0.2
-        self._wait_buffer_processor_timer(channel)
+        # to other code that may want to submit more requests. When requests
+        # are streaming in, it's widened to catch more of them per batch. See
+        # _batch_window(). A stream that never lets up still gets processed
+        # max_window after the first request in the buffers.
+        self._note_request(channel)
+        self._arm_buffer_timer(channel)
+
+    def _arm_buffer_timer(self, channel):
+        now = time.time()
+        timer = self.buffer_timers.get(channel)
+        if timer is None or not timer.active():
+            self.first_buffered[channel] = now
+        delay = min(self.first_buffered[channel] + self.config['max_window'],
+                now + self._batch_window(channel)) - now
+        if timer is not None and timer.active():
+            timer.reset(max(delay, 0))
+        else:
+            self.buffer_timers[channel] = reactor.callLater(delay,
+                    self._buffer_timer_fired, channel)
 
-    @non_reentrant(channel=1)
-    @defer.inlineCallbacks
-    def _wait_buffer_processor_timer(self, channel):
-        """Called only by _set_buffer_processor_timer() to wait for the
-        buffer_timer to expire, and then call _process_buffer(). This is
-        implemented as a separate method with inlineCallbacks so that
-        _set_buffer_processor_timer() can return while this continues to wait
-        asynchronously.
-        
-        """
-        while self.buffer_timer[channel] - time.time() > 0:
-            yield self.wait_for(timeout=self.buffer_timer[channel] - time.time())
+    def _buffered(self, channel):
+        return (len(self.mode_buffer[channel]) +
+                len(self.event_buffer[channel]) +
+                len(self.connector_buffer[channel]))
+
+    def _buffer_timer_fired(self, channel):
+        del self.buffer_timers[channel]
+        del self.first_buffered[channel]
+
+        batch = self._buffered(channel)
+        self.stats['batches'] += 1
+        self.stats['batched_requests'] += batch
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], batch)
 
-        self._process_buffer(channel)
+        d = self._process_buffer(channel)
+        d.addBoth(self._processed, channel)
+
+    def _processed(self, result, channel):
+        """Called when a run of _process_buffer() is done. If this timer fired
+        while it was waiting on something, its call was folded into that run
+        (see non_reentrant), which may have emptied the buffers before the
+        requests behind this timer came in. Process those now.
+
+        """
+        timer = self.buffer_timers.get(channel)
+        if self._buffered(channel) and (timer is None or not timer.active()):
+            self._arm_buffer_timer(channel)
+        return result
 
     @non_reentrant(channel=1)
     @defer.inlineCallbacks
     def _process_buffer(self, channel):
         """Processes the buffers right now. This is only called from
-        _wait_buffer_processor_timer(), and should not be called directly by
+        _buffer_timer_fired(), and should not be called directly by
         handlers. (handlers should call _set_buffer_processor_timer() unless
         they have a reason to process the buffer *right this instant*)
 
@@ -359,22 +767,8 @@ class OpProvider(EventWatcher, BotPlugin):
                 ):
             # Send all connector items to their connector plugins and callback
             # the deferreds.
-            for operation, param, d in self.connector_buffer.pop(channel, set()):
-                try:
-                    yield self.transport.issue_request(
-                            "connector.{0}.{1}".format(
-                                self.config['opmethod'][channel][operation],
-                                operation),
-                            channel,
-                            param,
-                            )
-                except NotImplementedError:
-                    log.msg("Error: Connector {0} is not loaded, does not exist, or does not provide '{1}'".format(
-                        self.config['opmethod'][channel][operation],
-                        operation))
-                    d.errback(OpFailed("I am not configured correctly to do {1} on {0}".format(channel, operation)))
-                else:
-                    d.callback(None)
+            yield self._send_to_connectors(channel,
+                    self.connector_buffer.pop(channel, set()))
             return
 
         # Acquire op here. We'll need it. (if we already have it, this will
@@ -385,26 +779,12 @@ class OpProvider(EventWatcher, BotPlugin):
             # We need OP but couldn't get it. Send an errback to all items in
             # the mode buffer and event buffer. Send all connector buffer items
             # to their connectors (because we can still do them).
-            for mode, arg, d in self.mode_buffer.pop(channel, set()):
+            for mode, arg, d in self.mode_buffer.pop(channel, []):
                 d.errback(e)
             for event, d in self.event_buffer.pop(channel, set()):
                 d.errback(e)
-            for operation, param, d in self.connector_buffer.pop(channel, set()):
-                try:
-                    yield self.transport.issue_request(
-                            "connector.{0}.{1}".format(
-                                self.config['opmethod'][channel][operation],
-                                operation),
-                            channel,
-                            param,
-                            )
-                except NotImplementedError:
-                    log.msg("Error: Connector {0} is not loaded, does not exist, or does not provide '{1}'".format(
-                        self.config['opmethod'][channel][operation],
-                        operation))
-                    d.errback(OpFailed("I am not configured correctly to do {1} on {0}".format(channel, operation)))
-                else:
-                    d.callback(None)
+            yield self._send_to_connectors(channel,
+                    self.connector_buffer.pop(channel, set()))
             return
 
         # At this point we're doing everything ourself as OP. Convert the
@@ -420,12 +800,11 @@ class OpProvider(EventWatcher, BotPlugin):
 
         # Now process the mode buffer. We make an ordered list so that we may
         # put a deop request at the end.
-        modelist = list(self.mode_buffer[channel])
-        self.mode_buffer[channel].clear()
+        modelist = self.mode_buffer.pop(channel, [])
 
         # If there is a self-deop mode request in here already, re-order it to
         # be last
-        mynick = (yield self.transport.issue_request("irc.getnick"))
+        mynick = (yield self.transport.issue_request("irc.getnick", channel))
         is_self_deop = lambda x: x[0] == "-o" and x[1] == mynick
         modelist.sort(key=is_self_deop)
 
@@ -441,56 +820,183 @@ class OpProvider(EventWatcher, BotPlugin):
             modelist = [m for m in modelist if not is_self_op(m)]
 
 
+        # If we still had op because we kept it for more requests, that's an
+        # op cycle we didn't have to do
+        if already_opped and channel in self.holding:
+            self.stats['cycles_saved'] += 1
+
         # Check if we should insert a deop request to the end of the mode list
         if (
                 # if there's not already one...
                 (not modelist or not is_self_deop(modelist[-1]))
                 # ... and if a connector is defined for OP
                 and (self.config["opmethod"][channel].get("op"))
-                # ... and we're not in "hold op" mode
-                and (self.op_until[channel] < time.time())
                 # ... and only if we had to acquire OP ourself to fulfill this
-                # request. (don't relinquish if someone gave it to us
-                # explicitly)
-                and (not already_opped)
+                # request, or are only keeping it for more requests. (don't
+                # relinquish if someone gave it to us explicitly)
+                and (not already_opped or channel in self.holding)
                 ):
-            modelist.append(("-o", mynick, defer.Deferred()))
-
-        # Loop through all the mode requests and combine them to submit them to
-        # the server in batch.
-        modeline = ""
-        params = []
-        for i, modereq in enumerate(modelist):
+            hold = self._predicted_hold(channel)
+            if hold:
+                # More requests are probably coming. Keep op for them.
+                self.holding.add(channel)
+                self.hold_until[channel] = time.time() + hold
+                self._deop_later(channel)
+            # ... and we're not in "hold op" mode
+            elif self.op_until[channel] < time.time():
+                self.holding.discard(channel)
+                timer = self.deop_timers.pop(channel, None)
+                if timer is not None and timer.active():
+                    timer.cancel()
+                modelist.append(("-o", mynick, defer.Deferred()))
+
+        # Combine the mode requests into as few lines as the server allows
+        # and send them. Send them ourselves as a do_raw because do_mode can
+        # only set or unset one thing at a time.
+        valid = []
+        for modereq in modelist:
             if len(modereq[0]) == 1:
-                modeline += "+"+modereq[0]
+                valid.append(("+"+modereq[0], modereq[1]))
             elif len(modereq[0]) == 2:
-                modeline += modereq[0]
+                valid.append(modereq[:2])
             else:
                 log.msg("Warning: Invalid mode request in buffer: {0!r}. Ignoring.".format(modereq))
-                continue
 
-            if modereq[1]:
-                params.append(modereq[1])
-
-            # If this was the last of the buffer or we've accumulated 3
-            # requests, send them to the server. The length below is 6 because
-            # there are 2 chars per mode request, the + or -, and the letter.
-            if i == len(modelist)-1 or len(modeline) >= 6:
-                # Send the mode line ourselves as a do_raw because do_mode can
-                # only set or unset one thing at a time.
-                log.msg("Sending mode requests {0} {1}".format(modeline, params))
-                self.transport.send_event(Event("irc.do_raw",
-                    line="MODE {channel} {modeline} {params}".format(
-                        channel=channel,
-                        modeline=modeline,
-                        params=" ".join(params),
-                        )))
-                modeline = ""
-                params = []
+        for line in (yield self._plan_modes(channel, valid, mynick)):
+            log.msg("Sending mode requests {0}".format(line))
+            self.transport.send_event(Event("irc.do_raw", line=line))
         for _,_,d in modelist:
             d.callback(None)
         log.msg("buffers emptied for {0}".format(channel))
 
+    def _send_to_connectors(self, channel, items):
+        """Sends (operation, param, deferred) items from the connector buffer
+        to their connector plugins and fires each deferred when its
+        connector is done with it. All items are submitted before waiting on
+        any of them so a connector can combine them.
+
+        Returns a deferred that fires once all are done.
+
+        """
+        def done(_, d):
+            d.callback(None)
+        def failed(f, operation, d):
+            if not f.check(NotImplementedError):
+                d.errback(f)
+                return
+            log.msg("Error: Connector {0} is not loaded, does not exist, or does not provide '{1}'".format(
+                self.config['opmethod'][channel][operation],
+                operation))
+            d.errback(OpFailed("I am not configured correctly to do {1} on {0}".format(channel, operation)))
+
+        ds = []
+        for operation, param, d in items:
+            req = self.transport.issue_request(
+                    "connector.{0}.{1}".format(
+                        self.config['opmethod'][channel][operation],
+                        operation),
+                    channel,
+                    param,
+                    )
+            req.addCallbacks(done, failed, callbackArgs=(d,),
+                    errbackArgs=(operation, d))
+            ds.append(req)
+        return defer.DeferredList(ds)
+
+    @defer.inlineCallbacks
+    def _plan_modes(self, channel, changes, mynick):
+        """Calls plan_modes() for the given changes with the limits the server
+        advertised, leaving out changes that our view of the channel says
+        wouldn't do anything. Returns a deferred that fires with the lines to
+        send.
+
+        """
+        supported = lambda feature: self.transport.issue_request(
+                "irc.supported", feature)
+        max_modes = (yield supported("MODES"))
+        chanmodes = (yield supported("CHANMODES")) or {}
+        prefixes = (yield supported("PREFIX")) or {}
+        per_target = chanmodes.get("addressModes", "") + "".join(prefixes)
+        takes_param = chanmodes.get("param", "") + chanmodes.get("setParam", "")
+
+        # Other users see the line prefixed with our nick!user@host, and that
+        # has to fit too. If we don't know our user and host, assume they're
+        # the longest usual lengths, 10 and 63.
+        try:
+            myhostmask = (yield self.transport.issue_request("irc.hostmask", mynick))
+        except NotImplementedError:
+            myhostmask = None
+        maxlen = MAX_LINE - len(":{0} ".format(
+            myhostmask or "{0}!{1}@{2}".format(mynick, "u"*10, "h"*63)))
+
+        # What we know about the channel right now
+        try:
+            members = (yield self.transport.issue_request("irc.members", channel))
+        except Exception:
+            members = {}
+        members = dict((nick.lower(), modes) for nick, (modes, _) in members.items())
+        try:
+            modestr, modeparams = (yield self.transport.issue_request("irc.chanmode", channel))
+        except Exception:
+            current = None
+        else:
+            current = {}
+            modeparams = iter(modeparams)
+            for letter in modestr.lstrip("+"):
+                current[letter] = next(modeparams, None) if letter in takes_param else None
+
+        lists = {}
+        for letter in set(mode[1] for mode, _ in changes):
+            if letter in chanmodes.get("addressModes", ""):
+                lists[letter] = (yield self._get_list(channel, letter))
+
+        def is_noop(mode, param):
+            sign, letter = mode
+            if letter in prefixes:
+                if param is None or param.lower() not in members:
+                    return False
+                return (letter in members[param.lower()]) == (sign == "+")
+            if letter in lists:
+                if param is None or lists[letter] is None:
+                    return False
+                return (mask_key(param) in lists[letter]) == (sign == "+")
+            if letter in per_target or current is None:
+                return False
+            if sign == "-":
+                return letter not in current
+            return letter in current and current[letter] == param
+
+        defer.returnValue(plan_modes(channel, changes, max_modes, maxlen,
+            per_target or PER_TARGET_MODES, is_noop))
+
+    @defer.inlineCallbacks
+    def _get_list(self, channel, letter):
+        """Returns a deferred that fires with the set of lowercased masks in
+        the given list mode of the channel, or None if we can't know it
+
+        """
+        try:
+            entries = (yield self.transport.issue_request("irc.chanlist",
+                channel, letter))
+        except Exception:
+            defer.returnValue(None)
+        defer.returnValue(set(mask_key(mask) for mask, _, _ in entries))
+
+    @defer.inlineCallbacks
+    def _is_redundant(self, channel, mode, param):
+        """Returns a deferred that fires with True if mode is a list mode
+        change that wouldn't change the list: setting a mask that's already
+        in it or removing one that isn't
+
+        """
+        if not param or mode[1] not in self.LIST_MODES:
+            defer.returnValue(False)
+        masks = (yield self._get_list(channel, mode[1]))
+        if masks is None:
+            defer.returnValue(False)
+        defer.returnValue(
+                (mask_key(param) in masks) == (mode[0] == "+"))
+
     def _convert_connector(self, operation, channel, target, d):
         """Called when a connector request cannot or will not be fulfilled by
         the connector plugin. This method adds an item to the event buffer or
@@ -509,7 +1015,7 @@ class OpProvider(EventWatcher, BotPlugin):
                  "unquiet": "-q",
                  }
         if operation in modes:
-            self.mode_buffer[channel].add((modes[operation], target, d))
+            self.mode_buffer[channel].append((modes[operation], target, d))
 
         elif operation == "topic":
             self.event_buffer[channel].add((
@@ -544,6 +1050,12 @@ class OpProvider(EventWatcher, BotPlugin):
                 topic=target,))
             return
 
+        # Don't bother with list changes that wouldn't change the list
+        if operation in ("quiet", "unquiet") and (yield self._is_redundant(
+                channel, "+q" if operation == "quiet" else "-q", target)):
+            self.stats['redundant'] += 1
+            return
+
         # If a connector is not defined, we can convert it right away. This
         # lets us make the assumption in _process_buffer() that all connector
         # operations in the connector_buffer are defined and we don't need to
@@ -598,24 +1110,19 @@ class OpProvider(EventWatcher, BotPlugin):
         issue more than one request.
 
         """
-        # First do some error checking. The add list and remove list are the
-        # channel modes that take parameters when being added and removed,
-        # respectively.
-        add_params, rem_params = (yield self.transport.issue_request("irc.get_channel_mode_params"))
-        if len(mode) != 2 or mode[0] not in ("+","-"):
-            raise ValueError("Invalid mode string")
-        if mode[0] == "+":
-            chklist = add_params
-        else:
-            chklist = rem_params
-        if mode[1] in chklist and not param:
-            raise ValueError("You must specify a parameter with {0}".format(mode))
-        elif mode[1] not in chklist and param:
-            raise ValueError("Mode {0} does not take a parameter".format(mode))
+        # First do some error checking
+        self._check_mode((yield self.transport.issue_request(
+            "irc.get_channel_mode_params")), mode, param)
+
+        # Skip list changes that wouldn't change the list, so we don't get op
+        # just to do nothing
+        if (yield self._is_redundant(channel, mode, param)):
+            self.stats['redundant'] += 1
+            return
 
         # Add the mode request(s) to the buffer
         d = defer.Deferred()
-        self.mode_buffer[channel].add((mode, param, d))
+        self.mode_buffer[channel].append((mode, param, d))
 
         # Tell the plugin to process the buffer and go ahead and submit an OP
         # request immediately since we know we'll need it for this. Silence
@@ -625,6 +1132,24 @@ class OpProvider(EventWatcher, BotPlugin):
         self._wait_for_op(channel).addErrback(lambda f: f.trap(OpFailed))
         yield d
 
+    @staticmethod
+    def _check_mode(mode_params, mode, param):
+        """Raises a ValueError if the given mode change isn't valid, given the
+        (add, remove) lists of the channel modes that take parameters
+
+        """
+        add_params, rem_params = mode_params
+        if len(mode) != 2 or mode[0] not in ("+","-"):
+            raise ValueError("Invalid mode string")
+        if mode[0] == "+":
+            chklist = add_params
+        else:
+            chklist = rem_params
+        if mode[1] in chklist and not param:
+            raise ValueError("You must specify a parameter with {0}".format(mode))
+        elif mode[1] not in chklist and param:
+            raise ValueError("Mode {0} does not take a parameter".format(mode))
+
     @defer.inlineCallbacks
     def _do_become_op(self, channel, duration):
         """Tells the bot to hold op for the given duration, in seconds. The bot
@@ -638,6 +1163,135 @@ class OpProvider(EventWatcher, BotPlugin):
         self.op_until[channel] = max(self.op_until[channel], time.time()+duration)
         self._deop_later(channel)
 
+    def _do_stats(self):
+        """Returns a dict of counters: how many batches the buffers were
+        processed in and how many requests they held, and how many times and
+        for how long we held op. Sessions still going aren't counted.
+
+        Also: op_cycles, how many times we had to ask a connector for op;
+        cycles_saved, how many batches were done with op we had kept for
+        them; redundant, how many list changes were skipped because the list
+        already had (or didn't have) the mask; and per-channel op latency and
+        request rate averages.
+
+        """
+        stats = dict(self.stats)
+        for count, total, mean in (
+                ('batches', 'batched_requests', 'mean_batch'),
+                ('op_sessions', 'op_seconds', 'mean_op_session'),
+                ):
+            stats[mean] = stats[total] / float(stats[count]) if stats.get(count) else 0
+        stats['opped_channels'] = len(self.op_since)
+        stats['op_latency'] = dict(self.op_latency)
+        stats['request_rate'] = dict((channel, self._get_request_rate(channel))
+                for channel in self.request_rate)
+        return stats
+
+    # The list mode change each *_many operation makes to its target, for the
+    # redundancy check
+    MANY_LIST_MODES = {"quiet": "+q", "unquiet": "-q", "ban": "+b",
+            "unban": "-b"}
+
+    @defer.inlineCallbacks
+    def _do_many(self, operation, channel, targets, *args, **kwargs):
+        """Implements the *_many requests. Checks the given operation for each
+        target, then adds all of them to the channel's buffers in one go and
+        sets the buffer timer once, so they all go into the same batch. Any
+        further arguments (e.g. the kick reason) are passed along for each
+        target.
+
+        Returns a deferred that fires once the buffers holding them have been
+        processed with a dict mapping each target to None if it succeeded or
+        the Failure if it didn't. It never errbacks itself. For mode_many, the
+        targets are (mode, param) tuples and are the keys of the dict.
+
+        """
+        if operation == "mode":
+            targets = [tuple(t) if isinstance(t, (tuple, list)) else (t, None)
+                    for t in targets]
+        else:
+            targets = list(targets)
+        results = dict((target, None) for target in targets)
+
+        # First the checks, which may have to wait on other plugins. Targets
+        # that fail them or have nothing to do are left out of the batch.
+        if operation == "mode":
+            mode_params = (yield self.transport.issue_request(
+                "irc.get_channel_mode_params"))
+            for target in targets:
+                try:
+                    self._check_mode(mode_params, *target)
+                except (ValueError, TypeError):
+                    results[target] = failure.Failure()
+            changes = [(target, target) for target in targets
+                    if results[target] is None]
+        elif operation in self.MANY_LIST_MODES:
+            changes = [(target, (self.MANY_LIST_MODES[operation], target))
+                    for target in targets]
+        else:
+            changes = []
+        redundant = (yield defer.gatherResults([
+            self._is_redundant(channel, mode, param)
+            for _, (mode, param) in changes]))
+        skip = set(target for (target, _), is_redundant
+                in zip(changes, redundant) if is_redundant)
+        self.stats['redundant'] += len(skip)
+
+        # Then everything goes into the buffers in one pass
+        ds = []
+        need_op = False
+        for target in targets:
+            if results[target] is not None or target in skip:
+                continue
+            d = defer.Deferred()
+            need_op = self._buffer(operation, channel, target, d,
+                    *args, **kwargs) or need_op
+            self._note_request(channel)
+            ds.append((target, d))
+        if not ds:
+            defer.returnValue(results)
+        self._arm_buffer_timer(channel)
+        if need_op:
+            self._wait_for_op(channel).addErrback(lambda f: f.trap(OpFailed))
+
+        outcomes = (yield defer.DeferredList([d for _, d in ds],
+            consumeErrors=True))
+        for (target, _), (success, result) in zip(ds, outcomes):
+            results[target] = None if success else result
+        defer.returnValue(results)
+
+    def _buffer(self, operation, channel, target, d, reason=None):
+        """Adds one target of a *_many request to the appropriate buffer, to
+        fire d once it's done. Returns whether it will need op.
+
+        """
+        if operation == "mode":
+            self.mode_buffer[channel].append(target + (d,))
+            return True
+        if operation in ("ban", "unban"):
+            self.mode_buffer[channel].append(
+                    (self.MANY_LIST_MODES[operation], target, d))
+            return True
+        if operation == "kick":
+            self.event_buffer[channel].add((Event("irc.do_kick",
+                channel=channel, user=target, reason=reason), d))
+            return True
+        if not self.config['opmethod'][channel].get(operation, None):
+            self._convert_connector(operation, channel, target, d)
+            return True
+        self.connector_buffer[channel].add((operation, target, d))
+        return False
+
+    def _do_list(self, channel, letter="b", hostmask=None, account=None):
+        """Returns a deferred that fires with the entries of a list mode of a
+        channel (b, q, e or I), as (mask, setter, time) tuples. setter and
+        time are None if the server didn't say. If a hostmask is given, only
+        the entries matching that user are returned.
+
+        """
+        return self.transport.issue_request("irc.chanlist", channel, letter,
+                hostmask, account)
+
     def _do_ban(self, channel, target):
         """A shorthand for submitting a mode request for +b"""
         return self._do_mode(channel, "+b", param=target)
@@ -1,13 +1,15 @@
 import re
-from collections import defaultdict
+import time
+from collections import defaultdict, deque, OrderedDict
 
-from twisted.internet import reactor
+from twisted.internet import task
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 from ..command import CommandPluginSuperclass
 from ..transport import Event
 from ..pluginbase import BotPlugin, EventWatcher, non_reentrant
+from ..hostmask import normalize_mask, mask_key, irc_lower, MaskIndex, UserIndex
 
 """
 
@@ -22,27 +24,91 @@ class WhoisTimedout(WhoisError):
     pass
 class NoSuchNick(WhoisError):
     pass
+class WhoisShed(WhoisError):
+    """Raised when there are too many whois requests waiting to accept
+    another one
+
+    """
+    pass
+class AccountUnknown(Exception):
+    """Raised by the irc.account request when there is no up to date account
+    information for a user
+
+    """
+    pass
+
+class _WhoisRequest(object):
+    """A whois for one nick, shared by everyone who asked for it while it was
+    queued or in flight
+
+    """
+    def __init__(self, nick, priority, deadline):
+        self.nick = nick
+        self.priority = priority
+        # How long it may wait in the queue, and once sent, how long for the
+        # reply
+        self.deadline = deadline
+        self.deferreds = []
+        # Maps the reply command to its parameters, as described in IRCWhois
+        self.info = {}
+        self.sent = False
 
 class IRCWhois(CommandPluginSuperclass):
     """Provides a request:
 
     irc.whois
 
-    takes one argument: the nickname
+    takes one argument: the nickname, and optionally a priority keyword
+    argument, one of "op", "normal" (the default) or "low".
     deferred fires with a dictionary of information returned from the server.
+    The dictionary maps the reply command to its parameters, minus our own
+    nick. The command is either a symbolic representation like RPL_WHOISUSER
+    or for unknown commands a string number like "330"
 
     deferreds returned may also errback with one of the following exceptions:
     WhoisTimedout
     NoSuchNick
+    WhoisShed
+
+    Up to max_inflight whoises are sent to the server at once, the rest wait
+    in a queue. Replies are matched up to their whois by the nick they're
+    about. Asking about a nick that is already queued or in flight doesn't
+    send another whois, and results are cached for cache_ttl seconds.
+
+    Since anyone can make us whois them just by trying a command, whoises are
+    also rate limited by a token bucket that holds up to burst tokens and
+    refills at rate tokens per second. Waiting requests are sent in priority
+    order, so whoises for op actions go ahead of permission checks. If more
+    than max_queued[priority] requests of a priority are waiting, new ones
+    fail right away with WhoisShed. Requests that wait in the queue for more
+    than max_queue_wait seconds fail with WhoisShed too. The timeout for the
+    server's reply starts when the whois is sent.
+
+    Also provides irc.whois_stats, which returns a dictionary of queue depths
+    and counters.
 
     """
+    PRIORITIES = ("op", "normal", "low")
+
+    DEFAULT_CONFIG = {
+            "max_inflight": 4,
+            "timeout": 10,
+            "max_queue_wait": 30,
+            "cache_ttl": 30,
+            "rate": 1,
+            "burst": 5,
+            "max_queued": {"op": 50, "normal": 20, "low": 5},
+            }
 
     def start(self):
         super(IRCWhois, self).start()
 
         self.provides_request("irc.whois")
+        self.provides_request("irc.whois_stats")
 
         self.listen_for_event("irc.on_unknown")
+        self.listen_for_event("irc.on_nick_change")
+        self.listen_for_event("irc.on_user_quit")
 
         self.install_command(
                 cmdname="whois",
@@ -53,69 +119,199 @@ class IRCWhois(CommandPluginSuperclass):
                 permission="irc.whois",
                 )
 
-        # nick of the current whois that is coming in on the wire right this
-        # moment
-        self.currentwhois = None
-        # Maps the command to the parameters. command is a string and is either
-        # a symbolic representation like RPL_WHOISUSER or for unknown commands
-        # a string number like "330"
-        self.currentinfo = {}
+        self.install_command(
+                cmdname="whoisstats",
+                callback=self.do_whois_stats,
+                helptext="Shows whois queue depths and how many whoises were sent, cached or shed",
+                permission="irc.whois",
+                )
+
+        # Maps lowercased nicks to their _WhoisRequest, queued or in flight
+        self.requests = {}
+        # Maps priorities to the lowercased nicks of requests of that priority
+        # that haven't been sent yet
+        self.queues = dict((p, deque()) for p in self.PRIORITIES)
+        # Number of requests sent that we're waiting on replies for
+        self.inflight = 0
+
+        # The token bucket
+        self.tokens = float(self.config['burst'])
+        self.last_refill = time.time()
+
+        # Maps lowercased nicks to (expiry time, info) tuples
+        self.cache = {}
+
+        # Counters for irc.whois_stats
+        self.stats = defaultdict(int)
+
+        # Sends requests waiting on the token bucket and times out requests.
+        # Only runs while there are requests.
+        self.sweeper = task.LoopingCall(self._sweep)
+
+    def stop(self):
+        if self.sweeper.running:
+            self.sweeper.stop()
+        requests = list(self.requests.values())
+        self.requests.clear()
+        for queue in self.queues.values():
+            queue.clear()
+        for request in requests:
+            for d in request.deferreds:
+                d.errback(WhoisError("Whois plugin stopped"))
+        super(IRCWhois, self).stop()
+
+    def on_request_irc_whois(self, nick, priority="normal"):
+        if priority not in self.queues:
+            raise ValueError("Unknown whois priority %r" % (priority,))
+        lnick = nick.lower()
+        now = time.time()
+
+        cached = self.cache.get(lnick)
+        if cached is not None:
+            if cached[0] > now:
+                self.stats['cache_hits'] += 1
+                return dict(cached[1])
+            del self.cache[lnick]
+
+        request = self.requests.get(lnick)
+        if request is None:
+            if len(self.queues[priority]) >= self.config['max_queued'][priority]:
+                self.stats['shed_' + priority] += 1
+                raise WhoisShed("Too many whois requests waiting")
+            request = _WhoisRequest(nick, priority,
+                    now + self.config['max_queue_wait'])
+            self.requests[lnick] = request
+            self.queues[priority].append(lnick)
+            if not self.sweeper.running:
+                self.sweeper.start(0.5, now=False)
+        else:
+            self.stats['coalesced'] += 1
+            if (not request.sent and self.PRIORITIES.index(priority) <
+                    self.PRIORITIES.index(request.priority)):
+                # Someone more important wants this one too
+                self.queues[request.priority].remove(lnick)
+                self.queues[priority].append(lnick)
+                request.priority = priority
+
+        d = defer.Deferred()
+        request.deferreds.append(d)
+        self._send_queued()
+        return d
+
+    def _take_token(self):
+        now = time.time()
+        self.tokens = min(self.config['burst'],
+                self.tokens + (now - self.last_refill) * self.config['rate'])
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def _send_queued(self):
+        for priority in self.PRIORITIES:
+            queue = self.queues[priority]
+            while queue and self.inflight < self.config['max_inflight']:
+                if not self._take_token():
+                    return
+                request = self.requests[queue.popleft()]
+                request.sent = True
+                request.deadline = time.time() + self.config['timeout']
+                self.inflight += 1
+                self.stats['sent'] += 1
+                self.transport.send_event(Event("irc.do_whois",
+                    nickname=request.nick,
+                    ))
+
+    def _finish(self, request, result):
+        """Removes the request and fires everyone waiting on it with result,
+        which is either the info dict or an exception
+
+        """
+        lnick = request.nick.lower()
+        if self.requests.get(lnick) is not request:
+            return
+        del self.requests[lnick]
+        if request.sent:
+            self.inflight -= 1
+        else:
+            self.queues[request.priority].remove(lnick)
 
-        # Map of nicks to deferred callbacks
-        self.pendingwhoises = defaultdict(set)
+        if isinstance(result, Exception):
+            for d in request.deferreds:
+                d.errback(result)
+        else:
+            self.cache[lnick] = (time.time() + self.config['cache_ttl'], result)
+            for d in request.deferreds:
+                d.callback(dict(result))
+
+        if not self.requests and self.sweeper.running:
+            self.sweeper.stop()
+        self._send_queued()
+
+    def _sweep(self):
+        now = time.time()
+        for request in list(self.requests.values()):
+            if request.deadline > now:
+                continue
+            if request.sent:
+                self.stats['timeouts'] += 1
+                self._finish(request, WhoisTimedout("No whois response from server"))
+            else:
+                self.stats['shed_' + request.priority] += 1
+                self._finish(request, WhoisShed("Waited too long to send the whois"))
+        for lnick, (expires, _) in list(self.cache.items()):
+            if expires <= now:
+                del self.cache[lnick]
+        self._send_queued()
+
+    def on_request_irc_whois_stats(self):
+        stats = dict(self.stats)
+        for priority, queue in self.queues.items():
+            stats['queued_' + priority] = len(queue)
+        stats['inflight'] = self.inflight
+        stats['tokens'] = self.tokens
+        return stats
 
     def on_event_irc_on_unknown(self, event):
-        """Here's how this works. When we get a RPL_WHOISUSER, we assume all
-        the unknown category of lines from the server are about that user until
-        we get an RPL_ENDOFWHOIS
+        """All whois replies have the nick they're about as their second
+        parameter, which is how we tell apart replies for whoises that are in
+        flight at the same time. A reply starts with RPL_WHOISUSER and ends
+        with RPL_ENDOFWHOIS, or is just ERR_NOSUCHNICK.
 
         """
         command = event.command
         params = event.params
-        if command == "RPL_WHOISUSER":
-            # Start a new one
-            if self.currentwhois:
-                log.msg("Error: Got a RPL_WHOISUSER but we're already in a whois!")
-            nick = params[1]
-            self.currentwhois = nick
-            self.currentinfo = {command: params[1:]}
-
-        elif command == "RPL_ENDOFWHOIS":
-            if not self.currentwhois or not self.pendingwhoises[self.currentwhois]:
-                return
-
-            for callback in self.pendingwhoises.pop(self.currentwhois):
-                callback.callback(dict(self.currentinfo))
+        if len(params) < 2:
+            return
+        request = self.requests.get(params[1].lower())
+        if request is None or not request.sent:
+            return
 
-            self.currentwhois = None
+        if command == "RPL_WHOISUSER":
+            request.info = {command: params[1:]}
 
         elif command == "ERR_NOSUCHNICK":
-            nick = params[1]
-            for callback in self.pendingwhoises.pop(nick):
-                callback.errback(NoSuchNick(params[2]))
+            self._finish(request, NoSuchNick(params[-1]))
 
-        else:
-            self.currentinfo[command] = params[1:]
+        elif not request.info:
+            # Not a reply to our whois. This may be the RPL_ENDOFWHOIS that
+            # servers send after ERR_NOSUCHNICK for an earlier whois of this
+            # nick, or something else entirely.
+            return
 
-    def on_request_irc_whois(self, nick):
-        d = defer.Deferred()
-        self.pendingwhoises[nick].add(d)
+        elif command == "RPL_ENDOFWHOIS":
+            self._finish(request, request.info)
 
-        event = Event("irc.do_whois",
-                nickname=nick,
-                )
-        self.transport.send_event(event)
+        else:
+            request.info[command] = params[1:]
 
-        def timeout():
-            d.errback(WhoisTimedout("No whois response from server"))
-            self.pendingwhoises[nick].remove(d)
-        timer = reactor.callLater(10, timeout)
-        def canceltimer(info):
-            timer.cancel()
-            return info
-        d.addBoth(canceltimer)
+    def on_event_irc_on_nick_change(self, event):
+        self.cache.pop(event.oldnick.lower(), None)
+        self.cache.pop(event.newnick.lower(), None)
 
-        return d
+    def on_event_irc_on_user_quit(self, event):
+        self.cache.pop(event.user.split("!",1)[0].lower(), None)
 
     @defer.inlineCallbacks
     def do_whois(self, event, match):
@@ -129,6 +325,9 @@ class IRCWhois(CommandPluginSuperclass):
         except NoSuchNick:
             event.reply("Server said: no such nick")
             return
+        except WhoisShed:
+            event.reply("Too many whoises waiting already. Try again later.")
+            return
         if "330" in info:
             event.reply("{nick}!{username}@{host} {2} {1}".format(*info["330"],
                 nick=info["RPL_WHOISUSER"][0],
@@ -145,14 +344,76 @@ class IRCWhois(CommandPluginSuperclass):
         #for command, params in info.iteritems():
         #    event.reply("%s: %s" % (command, params))
 
+    @defer.inlineCallbacks
+    def do_whois_stats(self, event, match):
+        stats = (yield self.transport.issue_request("irc.whois_stats"))
+        event.reply("Queued: {0} op, {1} normal, {2} low. In flight: {3}. "
+                "Sent {4}, cache hits {5}, coalesced {6}, timed out {7}. "
+                "Shed: {8} op, {9} normal, {10} low.".format(
+                    stats['queued_op'], stats['queued_normal'], stats['queued_low'],
+                    stats['inflight'], stats.get('sent', 0),
+                    stats.get('cache_hits', 0), stats.get('coalesced', 0),
+                    stats.get('timeouts', 0), stats.get('shed_op', 0),
+                    stats.get('shed_normal', 0), stats.get('shed_low', 0),
+                    ))
+
+class _Member(object):
+    """A user in a channel we're in"""
+    def __init__(self, nick, modes=(), hostmask=None):
+        self.nick = nick
+        # The prefix modes (o, v, ...) the user has in the channel
+        self.modes = set(modes)
+        self.hostmask = hostmask
+
 class Names(CommandPluginSuperclass):
-    """Provides a NAMES request for other plugins and a !names command"""
+    """Keeps track of who is in each channel we're in and what prefix modes
+    (op, voice, ...) they have. The member list is filled in from the NAMES
+    reply the server sends when we join, and kept up to date from joins,
+    parts, quits, kicks, nick changes and mode changes from then on.
+
+    Provides requests:
+
+    irc.names
+
+    takes one argument: the channel. The deferred fires with a list of the
+    nicks in that channel, each prefixed with the symbol of their highest
+    prefix mode, like a NAMES reply: ["@op", "+voiced", "someone"]. For
+    channels we're in this is answered from memory, otherwise a NAMES is sent.
+
+    irc.members
+
+    takes one argument: the channel, which we must be in. The deferred fires
+    with a dictionary mapping nicks to (modes, hostmask) tuples. modes is a
+    string of prefix mode letters such as "ov", and hostmask is None unless
+    known.
+
+    If resync_interval is set, the member lists are refreshed with a NAMES
+    every that many seconds, in case we've missed something.
+
+    Mode changes are handled a MODE line at a time, from
+    irc.on_mode_change_batch, and the quits and joins of a netsplit from
+    irc.on_netsplit and irc.on_netjoin. The server's modes for the users
+    coming back, which arrive right after their joins, come in the netjoin.
+
+    """
+    DEFAULT_CONFIG = {
+            "resync_interval": 0,
+            }
+    BATCHED_EVENTS = ("irc.on_mode_change", "irc.on_user_quit",
+            "irc.on_user_joined")
+
     def start(self):
         super(Names, self).start()
 
         self.provides_request("irc.names")
+        self.provides_request("irc.members")
 
-        self.listen_for_event("irc.on_unknown")
+        for event in ("irc.on_unknown", "irc.on_join", "irc.on_part",
+                "irc.on_user_joined", "irc.on_user_part", "irc.on_user_kick",
+                "irc.on_user_quit", "irc.on_nick_change",
+                "irc.on_mode_change", "irc.on_mode_change_batch",
+                "irc.on_netsplit", "irc.on_netjoin", "irc.on_privmsg"):
+            self.listen_for_event(event)
 
         #self.install_command(
         #        cmdname="names",
@@ -163,39 +424,250 @@ class Names(CommandPluginSuperclass):
         #        permission="irc.names",
         #        )
 
-        self.currentinfo = []
+        # Maps lowercased channel names to dicts mapping lowercased nicks to
+        # _Member objects. Channels are only in here once the member list is
+        # complete.
+        self.channels = {}
+
+        # Lowercased names of channels we're in, whether or not we have the
+        # member list yet
+        self.joined = set()
+
+        # Maps lowercased channel names to the RPL_NAMREPLY entries received
+        # so far for a NAMES that is coming in
+        self.namreplies = defaultdict(list)
+
+        # Maps lowercased channel names to deferreds waiting on a NAMES reply
         self.pending = defaultdict(set)
 
+        self.resync_timer = None
+        if self.config['resync_interval']:
+            self.resync_timer = task.LoopingCall(self._resync)
+            self.resync_timer.start(self.config['resync_interval'], now=False)
+
+    def stop(self):
+        if self.resync_timer is not None and self.resync_timer.running:
+            self.resync_timer.stop()
+        super(Names, self).stop()
+
+    def _resync(self):
+        for channel in self.joined:
+            self.transport.send_event(Event("irc.do_raw",
+                    line="NAMES " + channel))
+
     @defer.inlineCallbacks
-    def on_request_irc_names(self, channel):
-        self.transport.send_event(Event("irc.do_raw",
-                line="NAMES " + channel))
-        log.msg("NAMES line sent for channel %s. Awaiting reply..." % channel)
+    def _prefixes(self):
+        """Returns a dict mapping prefix mode letters to (symbol, rank) tuples,
+        where the lowest rank is the most powerful mode
+
+        """
+        try:
+            prefixes = (yield self.transport.issue_request("irc.supported", "PREFIX"))
+        except NotImplementedError:
+            prefixes = None
+        defer.returnValue(prefixes or {'o': ('@', 0), 'v': ('+', 1)})
+
+    @defer.inlineCallbacks
+    def _wait_for_names(self, channel, timeout=5):
+        """Returns a deferred that fires once we have the member list of
+        channel, sending a NAMES if one isn't already on its way. Errbacks if
+        the server hasn't answered within timeout seconds.
+
+        """
+        lchannel = channel.lower()
+        if not self.pending[lchannel] and lchannel not in self.joined:
+            self.transport.send_event(Event("irc.do_raw",
+                    line="NAMES " + channel))
+            log.msg("NAMES line sent for channel %s. Awaiting reply..." % channel)
 
         d = defer.Deferred()
-        self.pending[channel].add(d)
+        self.pending[lchannel].add(d)
 
-        names = (yield d)
+        def timesup():
+            waiting = self.pending.get(lchannel, set())
+            waiting.discard(d)
+            if not waiting:
+                self.pending.pop(lchannel, None)
+            d.errback(Exception("no response from server"))
+        timer = reactor.callLater(timeout, timesup)
 
+        try:
+            members = (yield d)
+        finally:
+            if timer.active():
+                timer.cancel()
+        defer.returnValue(members)
+
+    @defer.inlineCallbacks
+    def on_request_irc_names(self, channel):
+        members = self.channels.get(channel.lower())
+        if members is None:
+            members = (yield self._wait_for_names(channel))
+
+        prefixes = (yield self._prefixes())
+        names = []
+        for member in members.values():
+            ranked = sorted((prefixes[m][1], prefixes[m][0])
+                    for m in member.modes if m in prefixes)
+            names.append((ranked[0][1] if ranked else "") + member.nick)
         defer.returnValue(names)
 
+    @defer.inlineCallbacks
+    def on_request_irc_members(self, channel):
+        members = self.channels.get(channel.lower())
+        if members is None:
+            if channel.lower() not in self.joined:
+                raise ValueError("I'm not in {0}".format(channel))
+            members = (yield self._wait_for_names(channel))
+        defer.returnValue(dict((m.nick, ("".join(sorted(m.modes)), m.hostmask))
+                for m in members.values()))
+
+    @defer.inlineCallbacks
     def on_event_irc_on_unknown(self, event):
         command = event.command
 
         if command == "RPL_NAMREPLY":
             channel = event.params[2]
-            names = event.params[3]
-            self.currentinfo.append(names)
+            self.namreplies[channel.lower()].extend(event.params[3].split())
 
         elif command == "RPL_ENDOFNAMES":
             channel = event.params[1]
-            names = " ".join(self.currentinfo)
-            name_list = names.split()
-            self.currentinfo = []
-            if channel in self.pending:
-                for d in self.pending.pop(channel):
-                    d.callback(name_list)
+            lchannel = channel.lower()
+            entries = self.namreplies.pop(lchannel, [])
+
+            # Entries have one or more (with multi-prefix) prefix symbols, and
+            # are nick!user@host with userhost-in-names
+            prefixes = (yield self._prefixes())
+            symbols = dict((symbol, mode) for mode, (symbol, _) in prefixes.items())
+            members = {}
+            for entry in entries:
+                modes = set()
+                while entry and entry[0] in symbols:
+                    modes.add(symbols[entry[0]])
+                    entry = entry[1:]
+                if "!" in entry:
+                    nick, hostmask = entry.split("!",1)[0], entry
+                else:
+                    nick, hostmask = entry, None
+                members[nick.lower()] = _Member(nick, modes, hostmask)
+
+            try:
+                mynick = (yield self.transport.issue_request("irc.getnick", lchannel))
+            except Exception:
+                mynick = None
+            if mynick is not None and mynick.lower() in members:
+                # In case we were loaded after joining
+                self.joined.add(lchannel)
+
+            if lchannel in self.joined:
+                old = self.channels.get(lchannel, {})
+                for lnick, member in members.items():
+                    if member.hostmask is None and lnick in old:
+                        member.hostmask = old[lnick].hostmask
+                self.channels[lchannel] = members
+
+            for d in self.pending.pop(lchannel, []):
+                d.callback(members)
 
+    def on_event_irc_on_join(self, event):
+        """We joined a channel. The server sends us a NAMES reply for it"""
+        lchannel = event.channel.lower()
+        self.joined.add(lchannel)
+        self.channels.pop(lchannel, None)
+
+    def on_event_irc_on_part(self, event):
+        lchannel = event.channel.lower()
+        self.joined.discard(lchannel)
+        self.channels.pop(lchannel, None)
+
+    def on_event_irc_on_user_joined(self, event):
+        members = self.channels.get(event.channel.lower())
+        if members is not None:
+            members[event.user.lower()] = _Member(event.user,
+                    hostmask=getattr(event, "hostmask", None))
+
+    @defer.inlineCallbacks
+    def on_event_irc_on_netjoin(self, event):
+        members = self.channels.get(event.channel.lower())
+        if members is None:
+            return
+        prefixes = (yield self._prefixes())
+        for join in event.joins:
+            member = _Member(join['user'], hostmask=join.get("hostmask"))
+            for set, mode in join.get("modes", ()):
+                if mode not in prefixes:
+                    continue
+                if set:
+                    member.modes.add(mode)
+                else:
+                    member.modes.discard(mode)
+            members[join['user'].lower()] = member
+
+    def on_event_irc_on_user_part(self, event):
+        members = self.channels.get(event.channel.lower())
+        if members is not None:
+            members.pop(event.user.split("!",1)[0].lower(), None)
+
+    def on_event_irc_on_user_kick(self, event):
+        lchannel = event.channel.lower()
+        members = self.channels.get(lchannel)
+        if members is not None:
+            members.pop(event.kickee.lower(), None)
+
+    def on_event_irc_on_user_quit(self, event):
+        lnick = event.user.split("!",1)[0].lower()
+        for members in self.channels.values():
+            members.pop(lnick, None)
+
+    def on_event_irc_on_netsplit(self, event):
+        lnicks = [nick.lower() for nick in event.users]
+        for members in self.channels.values():
+            for lnick in lnicks:
+                members.pop(lnick, None)
+
+    def on_event_irc_on_nick_change(self, event):
+        oldnick = event.oldnick.lower()
+        for members in self.channels.values():
+            member = members.pop(oldnick, None)
+            if member is not None:
+                member.nick = event.newnick
+                if member.hostmask is not None:
+                    member.hostmask = event.newnick + "!" + \
+                            member.hostmask.split("!",1)[1]
+                members[event.newnick.lower()] = member
+
+    def on_event_irc_on_mode_change(self, event):
+        return self._change_modes(event.channel,
+                [(event.set, event.mode, event.arg)])
+
+    def on_event_irc_on_mode_change_batch(self, event):
+        return self._change_modes(event.channel, event.changes)
+
+    @defer.inlineCallbacks
+    def _change_modes(self, channel, changes):
+        members = self.channels.get(channel.lower())
+        if members is None:
+            return
+        prefixes = (yield self._prefixes())
+        for set, mode, arg in changes:
+            if arg is None or mode not in prefixes:
+                continue
+            member = members.get(arg.lower())
+            if member is None:
+                continue
+            if set:
+                member.modes.add(mode)
+            else:
+                member.modes.discard(mode)
+
+    def on_event_irc_on_privmsg(self, event):
+        """Fill in hostmasks we don't know from messages"""
+        members = self.channels.get(event.channel.lower())
+        if members is None or "!" not in event.user:
+            return
+        member = members.get(event.user.split("!",1)[0].lower())
+        if member is not None:
+            member.hostmask = event.user
 
     @defer.inlineCallbacks
     def do_names(self, event, match):
@@ -213,6 +685,279 @@ class Names(CommandPluginSuperclass):
         event.reply("NAMES info for {0}: {1}".format(channel, info))
 
         
+class AccountTracker(BotPlugin):
+    """Keeps track of the users in our channels: their hostmasks, and which
+    account each one is logged in as, using the IRCv3 account-notify,
+    extended-join and account-tag capabilities. This lets the auth plugin
+    identify users without doing a whois.
+
+    When we join a channel and the server supports WHOX, a single
+    WHO #channel %tcnuhaf is sent to learn the hostmask and account of every
+    member in one round trip. The results are also sent out in an
+    ircutil.on_accounts_resolved event, with an attribute `users` mapping
+    hostmasks to account names (or None for users that are not logged in).
+
+    Provides requests:
+
+    irc.account
+
+    takes one argument: a nick or a hostmask. The deferred fires with the
+    account name the user is logged in with, or None if they are known to not
+    be logged in. If there is no reliable information about the user, it
+    errbacks with AccountUnknown.
+
+    irc.hostmask
+
+    takes one argument: a nick. The deferred fires with the nick!user@host of
+    that user if they share a channel with us, or None if we don't know.
+
+    irc.match_users
+
+    takes a mask (a nick!user@host glob or an $a extban) and optionally a
+    channel, and fires with the hostmasks of the users we know of (in that
+    channel) that the mask matches. Users are kept in a hostmask.UserIndex,
+    so masks on a host or domain don't have to be checked against everyone.
+
+    Account information is only kept while the server has acknowledged
+    account-notify, since without it we'd never learn that someone logged out.
+    Users are forgotten once they are no longer in any channel with us, for
+    the same reason. The quits and joins of a netsplit are taken from
+    irc.on_netsplit and irc.on_netjoin.
+
+    """
+    BATCHED_EVENTS = ("irc.on_user_quit", "irc.on_user_joined")
+
+    # Query token for our WHOX requests, so we can tell our replies apart
+    # from those to a WHO someone else sent with irc.do_raw
+    WHOX_TOKEN = "147"
+
+    def start(self):
+        super(AccountTracker, self).start()
+
+        self.provides_request("irc.account")
+        self.provides_request("irc.hostmask")
+        self.provides_request("irc.match_users")
+
+        for event in ("irc.on_cap_ack", "irc.on_cap_del", "irc.on_join",
+                "irc.on_part", "irc.on_user_joined", "irc.on_user_part",
+                "irc.on_user_kick", "irc.on_user_quit", "irc.on_nick_change",
+                "irc.on_netsplit", "irc.on_netjoin", "irc.on_account",
+                "irc.on_privmsg", "irc.on_notice", "irc.on_action",
+                "irc.on_unknown"):
+            self.listen_for_event(event)
+
+        # Whether the server is keeping us informed of account changes
+        self.enabled = False
+
+        # Maps lowercased nicks to account names, or None for users that are
+        # not logged in
+        self.accounts = {}
+
+        # Maps lowercased nicks to their nick!user@host, and has an index of
+        # those hostmasks and the accounts that go with them
+        self.hostmasks = {}
+        self.index = UserIndex()
+
+        # Maps lowercased nicks to the set of channels we've seen them in
+        self.channels = defaultdict(set)
+
+        # Maps lowercased (irc_lower) channels to hostmask -> account dicts for
+        # WHOX replies that are still coming in
+        self.whox_pending = {}
+
+    def _forget(self, nick):
+        self.accounts.pop(nick, None)
+        self._set_hostmask(nick, None)
+        self.channels.pop(nick, None)
+
+    def _set_hostmask(self, nick, hostmask):
+        """Sets or (with None) forgets the hostmask of a lowercased nick, and
+        updates the index with it and their account
+
+        """
+        old = self.hostmasks.pop(nick, None)
+        if old is not None:
+            self.index.discard(old)
+        if hostmask is not None:
+            self.hostmasks[nick] = hostmask
+            self.index.add(hostmask, self.accounts.get(nick))
+
+    def _set_account(self, nick, account):
+        self.accounts[nick] = account
+        hostmask = self.hostmasks.get(nick)
+        if hostmask is not None:
+            self.index.add(hostmask, account)
+
+    def _left_channel(self, nick, channel):
+        channels = self.channels.get(nick)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                self._forget(nick)
+
+    def on_request_irc_account(self, user):
+        nick = user.split("!",1)[0].lower()
+        if not self.enabled or nick not in self.accounts:
+            raise AccountUnknown(user)
+        return self.accounts[nick]
+
+    def on_request_irc_hostmask(self, nick):
+        return self.hostmasks.get(nick.lower())
+
+    def on_request_irc_match_users(self, mask, channel=None):
+        matches = self.index.matching(mask)
+        if channel is not None:
+            channel = channel.lower()
+            matches = [hostmask for hostmask in matches
+                    if channel in set(c.lower() for c in
+                        self.channels.get(hostmask.split("!",1)[0].lower(), ()))]
+        return matches
+
+    def on_event_irc_on_cap_ack(self, event):
+        # This happens once per connection. Anything we knew from a previous
+        # connection is stale.
+        self.accounts.clear()
+        self.hostmasks.clear()
+        self.index = UserIndex()
+        self.channels.clear()
+        self.enabled = "account-notify" in event.caps
+
+    def on_event_irc_on_cap_del(self, event):
+        if "account-notify" in event.caps:
+            self.enabled = False
+            self.accounts.clear()
+            self.index = UserIndex()
+            for hostmask in self.hostmasks.values():
+                self.index.add(hostmask)
+
+    @defer.inlineCallbacks
+    def on_event_irc_on_join(self, event):
+        """We joined a channel. Whatever we knew about its members is from
+        before, so drop it and ask the server for the whole member list.
+
+        """
+        for nick in list(self.channels):
+            self._left_channel(nick, event.channel)
+
+        try:
+            whox = (yield self.transport.issue_request("irc.supported", "WHOX"))
+        except NotImplementedError:
+            whox = None
+        if whox is None:
+            return
+
+        self.whox_pending[irc_lower(event.channel)] = {}
+        self.transport.send_event(Event("irc.do_sync", channel=event.channel,
+                line="WHO {0} %tcnuhaf,{1}".format(event.channel, self.WHOX_TOKEN)))
+
+    def on_event_irc_on_unknown(self, event):
+        if event.command == "354":
+            # params are: our nick, token, channel, user, host, nick, flags,
+            # account. An account of 0 means not logged in.
+            if len(event.params) != 8 or event.params[1] != self.WHOX_TOKEN:
+                return
+            channel, user, host, nick, flags, account = event.params[2:]
+            if account == "0":
+                account = None
+            hostmask = "{0}!{1}@{2}".format(nick, user, host)
+
+            lnick = nick.lower()
+            self.channels[lnick].add(channel)
+            if self.enabled:
+                self.accounts[lnick] = account
+            self._set_hostmask(lnick, hostmask)
+
+            resolved = self.whox_pending.get(irc_lower(channel))
+            if resolved is not None:
+                resolved[hostmask] = account
+
+        elif event.command == "RPL_ENDOFWHO":
+            resolved = self.whox_pending.pop(irc_lower(event.params[1]), None)
+            if resolved:
+                log.msg("WHOX resolved {0} users in {1}".format(
+                    len(resolved), event.params[1]))
+                self.transport.send_event(Event("ircutil.on_accounts_resolved",
+                    channel=event.params[1], users=resolved))
+
+    def on_event_irc_on_part(self, event):
+        """We left a channel. Forget about users we no longer share a channel
+        with.
+
+        """
+        for nick in list(self.channels):
+            self._left_channel(nick, event.channel)
+
+    def on_event_irc_on_user_joined(self, event):
+        self._user_joined(vars(event))
+
+    def on_event_irc_on_netjoin(self, event):
+        for join in event.joins:
+            self._user_joined(join)
+
+    def _user_joined(self, join):
+        """Takes the attributes of an irc.on_user_joined event as a dict"""
+        nick = join['user'].lower()
+        self.channels[nick].add(join['channel'])
+        if self.enabled and "account" in join:
+            self.accounts[nick] = join['account']
+        if "hostmask" in join:
+            self._set_hostmask(nick, join['hostmask'])
+
+    def on_event_irc_on_user_part(self, event):
+        self._left_channel(event.user.split("!",1)[0].lower(), event.channel)
+
+    def on_event_irc_on_user_kick(self, event):
+        self._left_channel(event.kickee.lower(), event.channel)
+
+    def on_event_irc_on_user_quit(self, event):
+        self._forget(event.user.split("!",1)[0].lower())
+
+    def on_event_irc_on_netsplit(self, event):
+        for nick in event.users:
+            self._forget(nick.lower())
+
+    def on_event_irc_on_nick_change(self, event):
+        oldnick = event.oldnick.lower()
+        newnick = event.newnick.lower()
+        if oldnick in self.channels:
+            self.channels[newnick] = self.channels.pop(oldnick)
+        if oldnick in self.accounts:
+            self.accounts[newnick] = self.accounts.pop(oldnick)
+        if oldnick in self.hostmasks:
+            userhost = self.hostmasks[oldnick].split("!",1)[1]
+            self._set_hostmask(oldnick, None)
+            self._set_hostmask(newnick, event.newnick + "!" + userhost)
+
+    def on_event_irc_on_account(self, event):
+        nick = event.user.lower()
+        if self.enabled and nick in self.channels:
+            self._set_account(nick, event.account)
+
+    def _message_seen(self, event):
+        """Message events carry the sender's hostmask, and their account if
+        account-tag is on
+
+        """
+        if "!" not in event.user:
+            # From a server
+            return
+        nick = event.user.split("!",1)[0].lower()
+        if nick not in self.channels:
+            # We didn't see them join, probably because they were already
+            # there when we joined. Direct messages from users we don't share
+            # a channel with aren't tracked though, since we won't see them
+            # leave or change nick.
+            if not event.channel or event.channel[0] not in "#&!+":
+                return
+            self.channels[nick].add(event.channel)
+        if self.enabled and hasattr(event, "account"):
+            self.accounts[nick] = event.account
+        self._set_hostmask(nick, event.user)
+
+    on_event_irc_on_privmsg = _message_seen
+    on_event_irc_on_notice = _message_seen
+    on_event_irc_on_action = _message_seen
+
 class ReplyInserter(CommandPluginSuperclass):
     """This plugin's function is to insert a reply() function to each incoming
     irc.on_privmsg event. It is required for a lot of functionality, including
@@ -259,7 +1004,8 @@ class ReplyInserter(CommandPluginSuperclass):
         else:
             newtarget = None
 
-        def reply(msg, userprefix=True, notice=False, direct=False):
+        def reply(msg, userprefix=True, notice=False, direct=False,
+                priority=None, coalesce=True):
             """This function is inserted to every irc.on_privmsg event that's
             sent. It sends a reply directed at the user that sent the message.
 
@@ -275,6 +1021,13 @@ class ReplyInserter(CommandPluginSuperclass):
             obviously has no effect if the incoming message was a direct
             message; the reply will always be direct)
 
+            priority is the irc plugin's outbound lane to send the reply in,
+            e.g. "bulk" for lots of output that can wait. By default replies
+            go in the reply lane, or the notice lane if notice is True.
+
+            If coalesce is False, the reply is sent as a line of its own
+            instead of possibly being merged with others to the same target.
+
             """
             if notice:
                 eventname = "irc.do_notice"
@@ -301,6 +1054,14 @@ class ReplyInserter(CommandPluginSuperclass):
                 outchannel = event.channel
 
             newevent = Event(eventname, user=outchannel, message=msg)
+            if priority is not None:
+                newevent.priority = priority
+            if not coalesce:
+                newevent.coalesce = False
+            # Reply from the connection (of the irc plugin's pool) the
+            # message came in on, so it's from the nick that was talked to
+            if hasattr(event, "connection"):
+                newevent.connection = event.connection
             self.transport.send_event(newevent)
         event.reply = reply
         return event
@@ -330,7 +1091,7 @@ class HasOp(BotPlugin):
 
             names_list = (yield self.transport.issue_request("irc.names",channel))
 
-            nick = (yield self.transport.issue_request("irc.getnick"))
+            nick = (yield self.transport.issue_request("irc.getnick", channel))
 
             has_op = "@"+nick in names_list
             self.has_op[channel] = has_op
@@ -351,7 +1112,7 @@ class HasOp(BotPlugin):
         operation on ourselves and cache it
 
         """
-        mynick = (yield self.transport.issue_request("irc.getnick"))
+        mynick = (yield self.transport.issue_request("irc.getnick", event.channel))
 
         if (event.set == True and "o" == event.mode and
                 event.arg == mynick):
@@ -370,30 +1131,80 @@ class HasOp(BotPlugin):
 
 class ChanMode(EventWatcher, BotPlugin):
     """A simple plugin that provides channel mode information to other channels
-    
+
+    Provides a request:
+
+    irc.chanmode
+
+    takes one argument: the channel. The deferred fires with a (modes, params)
+    tuple such as ("+ntk", ["key"]), like the server's reply to a MODE query.
+
+    The modes of a channel are queried from the server when we join it. After
+    that, mode changes we see are applied to the cached modes, using the
+    server's CHANMODES and PREFIX to tell which modes are list, member and
+    parameter modes. The server is only asked again if a change doesn't fit
+    what we have, which means we've missed something.
+
+    irc.chanlist
+
+    takes the channel and a list mode letter (b, q, e or I) and fires with a
+    list of (mask, setter, time) tuples of the entries in that list. Each
+    list is asked for with MODE #channel <letter> the first time it's
+    wanted, and kept up to date from mode changes after that. If a hostmask
+    (and optionally the account the user is logged in as) is given, only the
+    entries that match that user are returned, looked up in a
+    hostmask.MaskIndex of the list.
+
     """
     REQUIRES = []
+    # The replies to a list query for each list mode: one numeric per entry
+    # and one at the end. q lists are a solanum/charybdis extension and have
+    # the letter as an extra parameter.
+    LIST_REPLIES = {
+            "b": ("RPL_BANLIST", "RPL_ENDOFBANLIST"),
+            "e": ("RPL_EXCEPTLIST", "RPL_ENDOFEXCEPTLIST"),
+            "I": ("RPL_INVITELIST", "RPL_ENDOFINVITELIST"),
+            "q": ("728", "729"),
+            }
+
     def start(self):
         super(ChanMode, self).start()
 
+        # Maps lowercased channel names to OrderedDicts mapping the mode
+        # letters set on the channel to their parameter, or None
         self.mode = {}
 
+        # Maps lowercased channel names to dicts mapping list mode letters to
+        # OrderedDicts, which map lowercased masks to (mask, setter, time)
+        # tuples. Only lists that have been loaded are here. indexes has a
+        # hostmask.MaskIndex of each of those lists.
+        self.lists = defaultdict(dict)
+        self.indexes = defaultdict(dict)
+        # Lists being loaded, keyed by (lowercased channel, letter), and
+        # lists the server wouldn't give us. Those aren't asked for again
+        # until we rejoin.
+        self.loading = {}
+        self.unlisted = set()
+
         self.provides_request("irc.chanmode")
+        self.provides_request("irc.chanlist")
 
         self.listen_for_event("irc.on_join")
+        self.listen_for_event("irc.on_part")
         self.listen_for_event("irc.on_mode_change")
         self.listen_for_event("irc.on_unknown")
 
     @defer.inlineCallbacks
     def on_request_irc_chanmode(self, channel):
 
-        try:
-            defer.returnValue( self.mode[channel] )
-        except KeyError:
-
+        if channel.lower() not in self.mode:
             yield self._get_mode(channel)
 
-            defer.returnValue( self.mode[channel] )
+        modes = self.mode[channel.lower()]
+        defer.returnValue((
+            "+" + "".join(modes),
+            [param for param in modes.values() if param is not None],
+            ))
 
     @non_reentrant(channel=1)
     @defer.inlineCallbacks
@@ -401,30 +1212,215 @@ class ChanMode(EventWatcher, BotPlugin):
         log.msg("Sending a request for the mode of channel {0}".format(channel))
         self.transport.send_event(Event("irc.do_raw",line="MODE {0}".format(channel)))
 
-        reply = (yield self.wait_for(Event("irc.on_unknown", command="RPL_CHANNELMODEIS"),
-                timeout=5))
-        
-        if not reply:
-            raise Exception("no response from server")
+        # Replies to queries for other channels may come in first. They're
+        # just as good to have.
+        while True:
+            reply = (yield self.wait_for(Event("irc.on_unknown", command="RPL_CHANNELMODEIS"),
+                    timeout=5))
 
-        mode, params = reply.params[2], reply.params[3:]
+            if not reply:
+                raise Exception("no response from server")
+
+            replychannel = (yield self._record_mode(reply))
+            if replychannel.lower() == channel.lower():
+                break
+
+    @defer.inlineCallbacks
+    def _record_mode(self, reply):
+        """Records the modes in an RPL_CHANNELMODEIS event. Returns a deferred
+        that fires with the channel they're for.
 
-        self.mode[channel] = (mode, params)
-        log.msg("mode in {chan} is {0} {1}".format(mode, " ".join(params), chan=channel))
+        """
+        replychannel, mode, params = reply.params[1], reply.params[2], reply.params[3:]
+
+        # Parameters are given in the order of the modes that take them
+        paramiter = iter(params)
+        types = (yield self._mode_types())
+        modes = OrderedDict()
+        for letter in mode.lstrip("+"):
+            if letter in types['param'] or letter in types['setParam']:
+                modes[letter] = next(paramiter, None)
+            else:
+                modes[letter] = None
+        self.mode[replychannel.lower()] = modes
+        log.msg("mode in {chan} is {0} {1}".format(mode, " ".join(params), chan=replychannel))
+        defer.returnValue(replychannel)
+
+    @defer.inlineCallbacks
+    def on_request_irc_chanlist(self, channel, letter, hostmask=None,
+            account=None):
+        types = (yield self._mode_types())
+        if letter not in types['addressModes'] or letter not in self.LIST_REPLIES:
+            raise ValueError("{0} is not a list mode".format(letter))
+
+        if letter not in self.lists[channel.lower()]:
+            if (channel.lower(), letter) in self.unlisted:
+                raise Exception("The server won't tell us the {0} list of {1}".format(
+                    letter, channel))
+            yield self._get_list(channel, letter)
+
+        entries = self.lists[channel.lower()][letter]
+        if hostmask is None:
+            defer.returnValue(list(entries.values()))
+        matches = self.indexes[channel.lower()][letter].matches(hostmask, account)
+        defer.returnValue([entries[mask_key(mask)]
+            for mask in matches])
+
+    @non_reentrant(channel=1, letter=2)
+    @defer.inlineCallbacks
+    def _get_list(self, channel, letter):
+        log.msg("Sending a request for the +{0} list of {1}".format(letter, channel))
+        key = (channel.lower(), letter)
+        self.loading[key] = OrderedDict()
+        self.transport.send_event(Event("irc.do_raw",
+            line="MODE {0} {1}".format(channel, letter)))
+
+        try:
+            # Entries are collected by on_event_irc_on_unknown. Wait for the
+            # end of our list.
+            end = self.LIST_REPLIES[letter][1]
+            while True:
+                reply = (yield self.wait_for(Event("irc.on_unknown", command=end),
+                        timeout=5))
+                if not reply:
+                    self.unlisted.add(key)
+                    raise Exception("no response from server")
+                if reply.params[1].lower() == key[0]:
+                    break
+        finally:
+            entries = self.loading.pop(key)
+
+        self.lists[key[0]][letter] = entries
+        self.indexes[key[0]][letter] = MaskIndex(
+                mask for mask, _, _ in entries.values())
+        log.msg("{0} entries in the +{1} list of {2}".format(len(entries),
+            letter, channel))
+
+    def on_event_irc_on_unknown(self, event):
+        """Records channel modes and collects the entries of lists we're
+        loading
+
+        """
+        if event.command == "RPL_CHANNELMODEIS" and len(event.params) >= 3:
+            self._record_mode(event)
+            return
+        for letter, (entry, _) in self.LIST_REPLIES.items():
+            if event.command == entry:
+                break
+        else:
+            return
+        params = event.params[1:]
+        if letter == "q":
+            # The letter is an extra parameter
+            params = params[:1] + params[2:]
+        if len(params) < 2:
+            return
+        entries = self.loading.get((params[0].lower(), letter))
+        if entries is None:
+            return
+        mask = params[1]
+        setter = params[2] if len(params) > 2 else None
+        try:
+            settime = int(params[3])
+        except (IndexError, ValueError):
+            settime = None
+        entries[mask_key(mask)] = (mask, setter, settime)
+
+    @defer.inlineCallbacks
+    def _mode_types(self):
+        """Returns the server's CHANMODES as a dict as parsed by twisted, with
+        the keys addressModes, param, setParam and noParam, plus a key prefix
+        with the member modes from PREFIX
+
+        """
+        try:
+            chanmodes = (yield self.transport.issue_request("irc.supported", "CHANMODES"))
+            prefix = (yield self.transport.issue_request("irc.supported", "PREFIX"))
+        except NotImplementedError:
+            chanmodes = prefix = None
+        types = dict(chanmodes or {'addressModes': 'b', 'param': 'k',
+                'setParam': 'l', 'noParam': ''})
+        types['prefix'] = "".join(prefix or "ov")
+        defer.returnValue(types)
 
     @defer.inlineCallbacks
     def on_event_irc_on_mode_change(self, event):
-        """On channel join and when we see a mode change, issue a mode request
-        and record the full modeline
+        """Apply a mode change to the cached modes of the channel. User mode
+        changes on ourself and changes to channels we're waiting on a MODE
+        reply for are ignored.
 
         """
-        nick = (yield self.transport.issue_request("irc.getnick"))
-        if event.channel == nick:
+        modes = self.mode.get(event.channel.lower())
+        if modes is None:
             return
-        self._get_mode(event.channel)
+
+        types = (yield self._mode_types())
+        mode = event.mode
+        if mode in types['addressModes']:
+            # List modes aren't part of the channel's modes, but we may have
+            # the list
+            entries = self.lists[event.channel.lower()].get(mode)
+            if entries is not None and event.arg:
+                index = self.indexes[event.channel.lower()][mode]
+                mask = normalize_mask(event.arg)
+                if event.set:
+                    entries[mask_key(mask)] = (mask, event.user, int(time.time()))
+                    index.add(mask)
+                else:
+                    entries.pop(mask_key(mask), None)
+                    index.discard(mask)
+            return
+        if mode in types['prefix']:
+            # Member modes aren't either
+            return
+
+        takes_param = mode in types['param'] or mode in types['setParam']
+
+        drift = None
+        if not takes_param and mode not in types['noParam']:
+            drift = "unknown mode {0}".format(mode)
+        elif event.set:
+            if takes_param and event.arg is None:
+                drift = "no parameter for +{0}".format(mode)
+            else:
+                modes[mode] = event.arg
+        elif mode not in modes:
+            drift = "-{0} but it wasn't set".format(mode)
+        else:
+            del modes[mode]
+
+        if drift:
+            log.msg("Lost track of the modes in {0} ({1}). Asking the server".format(
+                event.channel, drift))
+            self._get_mode(event.channel).addErrback(self._resync_failed,
+                    event.channel)
+
+    def _resync_failed(self, failure, channel):
+        """The server didn't tell us the modes of a channel we lost track of.
+        Drop what we have, which we know is wrong, so that the next
+        irc.chanmode request asks again.
+
+        """
+        log.msg("Couldn't get the modes of {0}: {1}".format(channel,
+            failure.getErrorMessage()))
+        self.mode.pop(channel.lower(), None)
+
     def on_event_irc_on_join(self, event):
-        """On channel join and when we see a mode change, issue a mode request
-        and record the full modeline
+        """On channel join, queue a mode request with the irc plugin's other
+        state syncs. The reply is recorded by on_event_irc_on_unknown() when
+        it comes.
 
         """
-        self._get_mode(event.channel)
+        self._forget(event.channel)
+        self.transport.send_event(Event("irc.do_sync", channel=event.channel,
+            line="MODE {0}".format(event.channel)))
+
+    def on_event_irc_on_part(self, event):
+        self._forget(event.channel)
+
+    def _forget(self, channel):
+        channel = channel.lower()
+        self.mode.pop(channel, None)
+        self.lists.pop(channel, None)
+        self.indexes.pop(channel, None)
+        self.unlisted = set(key for key in self.unlisted if key[0] != channel)
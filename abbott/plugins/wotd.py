@@ -160,16 +160,14 @@ class WordOfTheDay(EventWatcher, CommandPluginSuperclass):
         # De-voice anyone that still has it.
         # intersect current channel set with a set of current voices
         current_voices = set("+"+x for x in self.config['winners']) & names
-        reqs = []
-        for v in current_voices:
-            reqs.append(
-                    self.transport.issue_request("ircop.devoice", channel, v.lstrip("+"))
-                    )
+        req = self.transport.issue_request("ircop.devoice_many", channel,
+                [v.lstrip("+") for v in current_voices])
         self.config['winners'] = []
         self.winlines = []
         self.lastwintime = 0
-        for r in reqs:
-            yield r
+        for failure in (yield req).values():
+            if failure is not None:
+                failure.raiseException()
 
         # Announce what the winning word was.
         if self.config['theword']:
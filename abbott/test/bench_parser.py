@@ -0,0 +1,57 @@
+"""
+Compares the speed of IRCBot's inbound line parsing with what it did before,
+which was to decode, split off the tags and hand the rest to twisted's
+IRCClient.lineReceived(). Only the parsing and the lookup of the handler are
+timed, not the handlers themselves.
+
+Run it with python -m abbott.test.bench_parser [corpus], where the corpus is
+a file of raw lines as received from a server. The default is a recording of
+typical traffic in data/traffic.irc.
+
+"""
+import os.path
+import sys
+import timeit
+
+from twisted.words.protocols import irc as twisted_irc
+
+from ..plugins.irc import (IRCBot, decode_line, parse_line, parse_tags)
+
+def old_parse(line):
+    try:
+        line = line.decode("UTF-8")
+    except UnicodeDecodeError:
+        line = line.decode("CP1252", 'replace')
+    tags = {}
+    if line.startswith("@"):
+        tagstr, line = line[1:].split(" ", 1)
+        tags = parse_tags(tagstr)
+    line = twisted_irc.lowDequote(line)
+    prefix, command, params = twisted_irc.parsemsg(line)
+    if command in twisted_irc.numeric_to_symbolic:
+        command = twisted_irc.numeric_to_symbolic[command]
+    method = getattr(IRCBot, "irc_%s" % command, None)
+    return tags, prefix, command, params, method
+
+def new_parse(line):
+    line = decode_line(line)
+    if "\x10" in line:
+        line = twisted_irc.lowDequote(line)
+    tags, prefix, command, params = parse_line(line)
+    command, method = IRCBot.DISPATCH.get(command, (command, None))
+    return tags, prefix, command, params, method
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else \
+            os.path.join(os.path.dirname(__file__), "data", "traffic.irc")
+    with open(path, "rb") as corpus:
+        lines = [line.rstrip(b"\r\n") for line in corpus if line.strip()]
+
+    for name, parse in (("old", old_parse), ("new", new_parse)):
+        best = min(timeit.repeat(lambda: [parse(l) for l in lines],
+            number=200, repeat=5))
+        print("{0}: {1:.2f}us per line".format(name,
+            best / 200 / len(lines) * 1e6))
+
+if __name__ == "__main__":
+    main()
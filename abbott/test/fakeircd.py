@@ -0,0 +1,304 @@
+"""
+A small fake IRC server for tests. It speaks just enough of the protocol for
+the bot to connect, negotiate capabilities, register and join channels, and
+answers whois and who (including WHOX) requests from a table of known users.
+
+Tests can inject arbitrary lines to the connected bot with FakeIRCServer.send()
+and look at everything the bot sent in FakeIRCServer.received.
+
+BotTestCase is a base for tests that run a set of plugins connected to a fake
+server.
+
+"""
+import json
+import os.path
+import shutil
+import tempfile
+
+from twisted.internet import protocol, defer, reactor, task
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.trial import unittest
+
+from ..pluginbase import PluginBoss
+from ..transport import Transport
+
+SERVERNAME = "fake.ircd"
+
+class FakeIRCConnection(LineOnlyReceiver):
+    delimiter = b"\r\n"
+
+    def connectionMade(self):
+        self.nick = None
+        self.received = []
+        self.factory.connection = self
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+        if self.factory.connection is self:
+            self.factory.connection = None
+
+    def send(self, line):
+        self.sendLine(line.encode("UTF-8"))
+
+    def numeric(self, num, *params):
+        self.send(":{0} {1} {2} {3}".format(SERVERNAME, num, self.nick or "*",
+            " ".join(params)))
+
+    def lineReceived(self, line):
+        line = line.decode("UTF-8")
+        self.received.append(line)
+        self.factory.received.append(line)
+
+        if " :" in line:
+            line, trailing = line.split(" :", 1)
+            params = line.split() + [trailing]
+        else:
+            params = line.split()
+        command, params = params[0].upper(), params[1:]
+
+        method = getattr(self, "irc_" + command, None)
+        if method:
+            method(params)
+
+        for d in self.factory.waiters.pop(command, []):
+            d.callback(params)
+
+    def irc_CAP(self, params):
+        sub = params[0].upper()
+        if sub == "LS":
+            self.send(":{0} CAP * LS :{1}".format(SERVERNAME,
+                " ".join(sorted(self.factory.caps))))
+        elif sub == "REQ":
+            wanted = set(params[-1].split())
+            if wanted <= self.factory.caps:
+                self.send(":{0} CAP * ACK :{1}".format(SERVERNAME, params[-1]))
+            else:
+                self.send(":{0} CAP * NAK :{1}".format(SERVERNAME, params[-1]))
+
+    def irc_NICK(self, params):
+        self.nick = params[0]
+
+    def irc_USER(self, params):
+        self.numeric("001", ":Welcome to the fake network")
+        self.numeric("005", "PREFIX=(ov)@+", "CHANTYPES=#",
+                "CHANMODES=eIbq,k,flj,CFLMPQScgimnprstz", "MODES=4",
+                *(tuple(self.factory.isupport) + (":are supported by this server",)))
+
+    def irc_PING(self, params):
+        self.send(":{0} PONG {0} :{1}".format(SERVERNAME, params[-1]))
+
+    def irc_JOIN(self, params):
+        for channel in params[0].split(","):
+            self.send(":{0}!bot@bot.host JOIN {1}".format(self.nick, channel))
+            members = self.factory.channels.setdefault(channel, [])
+            self.numeric("353", "=", channel,
+                    ":" + " ".join(["@" + self.nick] + members))
+            self.numeric("366", channel, ":End of /NAMES list.")
+
+    def irc_WHOIS(self, params):
+        if not self.factory.answer_whois:
+            return
+        nick = params[-1]
+        user = self.factory.users.get(nick)
+        if user is None:
+            self.numeric("401", nick, ":No such nick/channel")
+        else:
+            self.numeric("311", nick, user['user'], user['host'], "*",
+                    ":" + nick)
+            if user.get("account"):
+                self.numeric("330", nick, user['account'], ":is logged in as")
+        self.numeric("318", nick, ":End of /WHOIS list.")
+
+    # The entry and end numerics of the replies to list queries
+    LIST_REPLIES = {"b": ("367", "368"), "e": ("348", "349"),
+            "I": ("346", "347"), "q": ("728", "729")}
+
+    def irc_MODE(self, params):
+        channel = params[0]
+        if channel not in self.factory.channels:
+            return
+        if len(params) == 1:
+            self.numeric("324", channel,
+                    *self.factory.modes.get(channel, "+nt").split())
+        elif params[1] in self.LIST_REPLIES:
+            letter = params[1]
+            entry, end = self.LIST_REPLIES[letter]
+            extra = (letter,) if letter == "q" else ()
+            for mask in self.factory.lists.get(channel, {}).get(letter, []):
+                self.numeric(entry, channel, *(extra +
+                    (mask, "op!op@op.host", "1500000000")))
+            self.numeric(end, channel, *(extra + (":End of list",)))
+
+    # The order WHOX fields are sent in, no matter the order they were asked
+    # for in
+    WHOX_FIELDS = "tcuhnfa"
+
+    def irc_WHO(self, params):
+        mask = params[0]
+        members = self.factory.channels.get(mask, [mask])
+        whox = len(params) > 1 and params[1].startswith("%") and \
+                "WHOX" in self.factory.isupport
+        if whox:
+            fields, _, token = params[1][1:].partition(",")
+        for nick in members:
+            nick = nick.lstrip("@+")
+            user = self.factory.users.get(nick)
+            if user is None:
+                continue
+            if whox:
+                values = {"t": token, "c": mask, "u": user['user'],
+                        "h": user['host'], "n": nick, "f": "H",
+                        "a": user.get("account") or "0"}
+                self.numeric("354", *[values[f] for f in self.WHOX_FIELDS
+                    if f in fields])
+            else:
+                self.numeric("352", mask, user['user'], user['host'],
+                        SERVERNAME, nick, "H", ":0 " + nick)
+        self.numeric("315", mask, ":End of /WHO list.")
+
+class FakeIRCServer(protocol.ServerFactory):
+    """A server factory. Listen on it with reactor.listenTCP(0, server)
+
+    caps is the set of IRCv3 capabilities the server offers
+
+    users maps nicks to dicts with the keys user, host and account, and is
+    used to answer whois and who requests
+
+    channels maps channel names to the nicks (from users) that are in it
+    before the bot joins, optionally prefixed with @ or +
+
+    modes maps channel names to their modes, as given in the reply to a MODE
+    query. The default is +nt
+
+    lists maps channel names to dicts mapping list modes (b, q, e, I) to the
+    masks in those lists
+
+    isupport is a list of extra tokens to advertise in RPL_ISUPPORT, e.g.
+    ["WHOX"]
+
+    """
+    protocol = FakeIRCConnection
+
+    def __init__(self, caps=(), users=None, channels=None, isupport=(),
+            modes=None, lists=None):
+        self.caps = set(caps)
+        self.users = users or {}
+        self.channels = dict(channels or {})
+        self.isupport = list(isupport)
+        self.modes = dict(modes or {})
+        self.lists = dict(lists or {})
+        # Tests can turn this off to reply to whoises themselves
+        self.answer_whois = True
+        # The last client to connect, and all of them
+        self.connection = None
+        self.connections = []
+        # The lines received from all clients
+        self.received = []
+        self.waiters = {}
+
+    def send(self, line):
+        """Sends a raw line to the connected client (the last one to connect,
+        if there are several)
+
+        """
+        self.connection.send(line)
+
+    def send_to(self, nick, line):
+        """Sends a raw line to the client registered with the given nick"""
+        for connection in self.connections:
+            if connection.nick == nick:
+                connection.send(line)
+
+    def wait_for_command(self, command):
+        """Returns a deferred that fires with the params of the next line of
+        the given command received from the client
+
+        """
+        d = defer.Deferred()
+        self.waiters.setdefault(command.upper(), []).append(d)
+        return d
+
+    def commands_received(self, command):
+        """Returns the received lines of the given command"""
+        return [l for l in self.received
+                if l.split(" ",1)[0].upper() == command.upper()]
+
+@defer.inlineCallbacks
+def wait_until(condition, timeout=5):
+    """Spins the reactor until condition() returns true"""
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        yield task.deferLater(reactor, 0.01, lambda: None)
+    raise AssertionError("Timed out waiting for condition")
+
+class BotTestCase(unittest.TestCase):
+    """Starts a fake server and connects a bot running the plugins in
+    PLUGINS to it, which joins #test. The class attributes are passed to the
+    FakeIRCServer, PLUGIN_CONFIG is added to the bot's plugin config, and
+    IRC_CONFIG to the config of the irc plugin.
+
+    """
+    PLUGINS = ("irc.IRCBotPlugin",)
+    PLUGIN_CONFIG = {}
+    CAPS = ()
+    USERS = {}
+    CHANNELS = {}
+    ISUPPORT = ()
+    MODES = {}
+    LISTS = {}
+    IRC_CONFIG = {}
+
+    def make_server(self):
+        return FakeIRCServer(caps=self.CAPS, users=self.USERS,
+                channels=self.CHANNELS, isupport=self.ISUPPORT,
+                modes=self.MODES, lists=self.LISTS)
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.server = self.make_server()
+        self.port = reactor.listenTCP(0, self.server, interface="127.0.0.1")
+
+        plugin_config = {
+                "irc.IRCBotPlugin": {
+                    "server": "127.0.0.1",
+                    "port": self.port.getHost().port,
+                    "ssl": False,
+                    "nick": "abbott",
+                    "channels": ["#test"],
+                    # The fake server doesn't mind floods, and tests
+                    # shouldn't wait on them
+                    "flood_burst": 1000,
+                    },
+                }
+        plugin_config["irc.IRCBotPlugin"].update(self.IRC_CONFIG)
+        plugin_config.update(self.PLUGIN_CONFIG)
+
+        self.configdir = tempfile.mkdtemp()
+        with open(os.path.join(self.configdir, "config.json"), "w") as out:
+            json.dump({
+                "core": {"plugins": []},
+                "plugin_config": plugin_config,
+                "command": {"prefix": None},
+                }, out)
+
+        self.boss = PluginBoss(self.configdir, Transport())
+        for plugin in self.PLUGINS:
+            self.boss.load_plugin(plugin)
+        self.ircplugin = self.boss.loaded_plugins['irc.IRCBotPlugin']
+
+        yield wait_until(lambda: self.server.commands_received("JOIN"))
+        # Let the client process the join echoed back by the server
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for plugin in list(self.boss.loaded_plugins):
+            self.boss.unload_plugin(plugin)
+        for connector in self.ircplugin.connectors:
+            connector.disconnect()
+        yield wait_until(lambda: all(factory.client is None
+            for factory in self.ircplugin.pool))
+        yield self.port.stopListening()
+        shutil.rmtree(self.configdir)
@@ -0,0 +1,483 @@
+"""
+A load generator built on the fake IRC server, for capacity testing the bot
+end to end without a real network.
+
+LoadIRCServer simulates a network with a number of channels and users. Once
+started, its users talk in the bot's channels at a configurable rate, and
+some of their lines are probes ("!probe <token>") that the bot is expected
+to answer with a line containing the token, which gives the reply latency
+seen from the network. It also plays ChanServ, answering OP, DEOP, VOICE and
+DEVOICE requests with a MODE after a configurable latency, counts the lines
+the bot sends beyond its flood limit (and optionally kills it for them like
+a real server would), and can be scripted to raid a channel or split the
+network at given times. WHOIS, NAMES, MODE and WHO are answered from the
+simulated users and channels.
+
+Run python -m abbott.test.loadircd --help for the driver, which starts a
+server (with TLS if given a PEM file holding a certificate and its key) and
+a bot connected to it, then ramps the message rate up step by step until
+the probe latency or the flood counter breaks the SLO, and reports the
+saturation point.
+
+"""
+import argparse
+import itertools
+import json
+import os.path
+import random
+import re
+import shutil
+import sys
+import tempfile
+from time import time
+
+from twisted.internet import defer, reactor, ssl, task
+from twisted.python import log
+
+from ..pluginbase import PluginBoss
+from ..transport import Event, Transport
+from .fakeircd import FakeIRCConnection, FakeIRCServer, SERVERNAME, wait_until
+
+PROBE = "!probe"
+PROBE_TOKEN = re.compile(r"\bprobe-\d+\b")
+
+# The mode changes of the ChanServ commands we know
+CHANSERV_MODES = {"OP": "+o", "DEOP": "-o", "VOICE": "+v", "DEVOICE": "-v"}
+
+class LoadIRCConnection(FakeIRCConnection):
+
+    def connectionMade(self):
+        FakeIRCConnection.connectionMade(self)
+        # The server's flood protection: a bucket of flood_burst lines that
+        # refills one line every flood_period seconds
+        self.allowance = self.factory.flood_burst
+        self.allowance_at = time()
+
+    def lineReceived(self, line):
+        now = time()
+        self.allowance = min(self.factory.flood_burst, self.allowance +
+                (now - self.allowance_at) / self.factory.flood_period)
+        self.allowance_at = now
+        if self.allowance < 1:
+            self.factory.flood_violations += 1
+            if self.factory.flood_kill:
+                self.send("ERROR :Closing Link: {0} (Excess Flood)".format(
+                    self.nick))
+                self.transport.loseConnection()
+                return
+        else:
+            self.allowance -= 1
+        FakeIRCConnection.lineReceived(self, line)
+
+    def irc_JOIN(self, params):
+        FakeIRCConnection.irc_JOIN(self, params)
+        self.factory.joined.update(params[0].split(","))
+
+    def irc_PART(self, params):
+        for channel in params[0].split(","):
+            self.factory.joined.discard(channel)
+
+    def irc_NAMES(self, params):
+        for channel in params[0].split(","):
+            members = self.factory.channels.get(channel)
+            if members is not None:
+                # NAMES replies are split over several lines on real servers
+                for i in range(0, len(members), 50):
+                    self.numeric("353", "=", channel,
+                            ":" + " ".join(members[i:i+50]))
+            self.numeric("366", channel, ":End of /NAMES list.")
+
+    def irc_PRIVMSG(self, params):
+        target, text = params[0], params[-1]
+        if target.lower() == "chanserv":
+            self.factory.chanserv(self, text)
+        else:
+            self.factory.answered(PROBE_TOKEN.findall(text))
+
+    irc_NOTICE = irc_PRIVMSG
+
+class LoadIRCServer(FakeIRCServer):
+    """A server factory simulating a busy network. Listen on it like on a
+    FakeIRCServer and call start() once the bot has joined its channels.
+
+    channels and users are how many of each to make up. Each channel gets
+    channel_size of the users, one in ten of them voiced and the first
+    opped. The users are logged in to accounts of the same name.
+
+    rate is the number of lines per second the users say in the bot's
+    channels, and probe_rate how many of those per second are probes. The
+    latencies of the answered probes are collected in latencies.
+
+    chanserv_latency is how many seconds ChanServ takes to answer.
+
+    flood_burst and flood_period are the flood limit the lines from the bot
+    are held to: flood_burst lines at once, and one more every flood_period
+    seconds. Lines beyond that are counted in flood_violations, and if
+    flood_kill is set the bot is disconnected for them.
+
+    """
+    protocol = LoadIRCConnection
+
+    def __init__(self, channels=10, users=100, channel_size=None, rate=1.0,
+            probe_rate=0.2, chanserv_latency=0.5, flood_burst=10,
+            flood_period=1, flood_kill=False, seed=None, **kwargs):
+        self.random = random.Random(seed)
+        nicks = ["user{0:04}".format(i) for i in range(users)]
+        size = min(users, channel_size or 50)
+        members = itertools.cycle(nicks)
+        channellist = {}
+        for i in range(channels):
+            channel = "#load-{0:03}".format(i)
+            channellist[channel] = [("@" if j == 0 else "+" if j % 10 == 0
+                else "") + next(members) for j in range(size)]
+        FakeIRCServer.__init__(self,
+                users=dict((nick, {"user": nick, "host": nick + ".example.com",
+                    "account": nick}) for nick in nicks),
+                channels=channellist, **kwargs)
+        self.rate = rate
+        self.probe_rate = probe_rate
+        self.chanserv_latency = chanserv_latency
+        self.flood_burst = flood_burst
+        self.flood_period = flood_period
+        self.flood_kill = flood_kill
+
+        # Channels the bot is in
+        self.joined = set()
+        # Maps the tokens of unanswered probes to when they were sent
+        self.probes = {}
+        self.tokens = itertools.count()
+        self.latencies = []
+        self.flood_violations = 0
+        self.sent = 0
+
+        self.traffic = None
+        self.due = 0.0
+        self.probes_due = 0.0
+
+    TICK = 0.1
+
+    def start(self):
+        """Starts the users talking"""
+        self.traffic = task.LoopingCall(self._tick)
+        self.traffic.start(self.TICK, now=False)
+
+    def stop(self):
+        if self.traffic is not None and self.traffic.running:
+            self.traffic.stop()
+
+    def set_rate(self, rate, probe_rate=None):
+        self.rate = rate
+        if probe_rate is not None:
+            self.probe_rate = probe_rate
+
+    def _tick(self):
+        if self.connection is None or not self.joined:
+            return
+        self.due += self.rate * self.TICK
+        self.probes_due += min(self.probe_rate, self.rate) * self.TICK
+        while self.due >= 1:
+            self.due -= 1
+            if self.probes_due >= 1:
+                self.probes_due -= 1
+                token = "probe-{0}".format(next(self.tokens))
+                self.probes[token] = time()
+                self.say("{0} {1}".format(PROBE, token))
+            else:
+                self.say("some chatter {0}".format(self.sent))
+
+    def say(self, text, channel=None, nick=None):
+        """Sends a line from a random user (or nick) to a random channel of
+        the bot's (or channel)
+
+        """
+        channel = channel or self.random.choice(sorted(self.joined))
+        if nick is None:
+            members = self.channels.get(channel)
+            nick = self.random.choice(members).lstrip("@+") if members \
+                    else "user"
+        self.send(":{0}!{0}@{0}.example.com PRIVMSG {1} :{2}".format(
+            nick, channel, text))
+        self.sent += 1
+
+    def answered(self, tokens):
+        now = time()
+        for token in tokens:
+            sent = self.probes.pop(token, None)
+            if sent is not None:
+                self.latencies.append(now - sent)
+
+    def unanswered(self, older_than=0):
+        """Returns how many probes sent more than older_than seconds ago have
+        not been answered
+
+        """
+        now = time()
+        return sum(1 for sent in self.probes.values()
+                if now - sent > older_than)
+
+    def chanserv(self, connection, text):
+        words = text.split()
+        if len(words) < 2 or words[0].upper() not in CHANSERV_MODES:
+            return
+        mode = CHANSERV_MODES[words[0].upper()]
+        channel, nicks = words[1], words[2:] or [connection.nick]
+        line = ":ChanServ!ChanServ@services. MODE {0} {1}{2} {3}".format(
+                channel, mode[0], mode[1] * len(nicks), " ".join(nicks))
+        reactor.callLater(self.chanserv_latency, self._send_on, connection,
+                line)
+
+    def _send_on(self, connection, line):
+        if connection in self.connections:
+            connection.send(line)
+
+    def raid(self, channel=None, count=20, lines=3, interval=0.05):
+        """Has count new users join channel (a random one of the bot's by
+        default) interval seconds apart, each saying the same thing lines
+        times right after joining
+
+        """
+        channel = channel or self.random.choice(sorted(self.joined))
+        for i in range(count):
+            reactor.callLater(i * interval, self._raider, channel,
+                    "raider{0:03}".format(i), lines)
+
+    def _raider(self, channel, nick, lines):
+        if self.connection is None:
+            return
+        self.send(":{0}!{0}@raid.example.net JOIN {1}".format(nick, channel))
+        self.channels.setdefault(channel, []).append(nick)
+        for _ in range(lines):
+            self.say("JOIN THE RAID http://spam.example.net/", channel, nick)
+
+    def netsplit(self, fraction=0.3, duration=5,
+            servers=("hub.example.net", "leaf.example.net")):
+        """Splits fraction of the users in the bot's channels off the network
+        for duration seconds. When they come back, the server gives them
+        back their modes.
+
+        """
+        nicks = set(m.lstrip("@+") for channel in self.joined
+                for m in self.channels.get(channel, []))
+        lost = set(self.random.sample(sorted(nicks),
+            int(len(nicks) * fraction)))
+        split = {}
+        for channel in self.joined:
+            members = self.channels.get(channel, [])
+            split[channel] = [m for m in members if m.lstrip("@+") in lost]
+            members[:] = [m for m in members if m.lstrip("@+") not in lost]
+        for nick in sorted(lost):
+            self.send(":{0}!{0}@{0}.example.com QUIT :{1} {2}".format(
+                nick, *servers))
+        reactor.callLater(duration, self._netjoin, split)
+
+    def _netjoin(self, split):
+        if self.connection is None:
+            return
+        for channel, members in split.items():
+            for member in members:
+                nick = member.lstrip("@+")
+                self.send(":{0}!{0}@{0}.example.com JOIN {1}".format(
+                    nick, channel))
+            for symbol, letter in (("@", "o"), ("+", "v")):
+                nicks = [m[1:] for m in members if m.startswith(symbol)]
+                for i in range(0, len(nicks), 4):
+                    self.send(":{0} MODE {1} +{2} {3}".format(SERVERNAME,
+                        channel, letter * len(nicks[i:i+4]),
+                        " ".join(nicks[i:i+4])))
+            self.channels.setdefault(channel, []).extend(members)
+
+    def script(self, actions):
+        """Schedules a list of (seconds from now, method name, kwargs)
+        actions, e.g. [(10, "raid", {"count": 50}), (20, "netsplit", {})]
+
+        """
+        for delay, method, kwargs in actions:
+            reactor.callLater(delay, getattr(self, method), **kwargs)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+@defer.inlineCallbacks
+def ramp(server, start=1.0, step=1.0, step_duration=10, max_rate=1000,
+        slo_latency=2.0, slo_percentile=0.95, max_flood=0):
+    """Raises the server's message rate from start by step every
+    step_duration seconds until a step breaks the SLO: the slo_percentile
+    of the probe latencies (counting probes unanswered after slo_latency as
+    too slow) is over slo_latency seconds, or the bot went over the server's
+    flood limit more than max_flood times. The deferred fires with a report
+    dict: the steps as (rate, latency, flood violations) tuples, and the
+    saturation rate (the first one to break the SLO, or None).
+
+    """
+    steps = []
+    rate = start
+    saturated = None
+    while rate <= max_rate:
+        server.set_rate(rate)
+        server.latencies = []
+        flood = server.flood_violations
+        yield task.deferLater(reactor, step_duration, lambda: None)
+        latencies = server.latencies + [float("inf")] * \
+                server.unanswered(slo_latency)
+        latency = percentile(latencies, slo_percentile)
+        flood = server.flood_violations - flood
+        steps.append((rate, latency, flood))
+        log.msg("Load step: {0} lines/s, p{1:g} latency {2:.3f}s, "
+                "{3} flood violations".format(rate, slo_percentile * 100,
+                    latency, flood))
+        if latency > slo_latency or flood > max_flood:
+            saturated = rate
+            break
+        rate += step
+    defer.returnValue({
+        "steps": steps,
+        "saturated": saturated,
+        "sustained": steps[-2][0] if saturated and len(steps) > 1
+            else None if saturated else rate - step,
+        })
+
+class ProbeAnswerer(object):
+    """Listens on a bot's transport and answers probes"""
+    def __init__(self, transport):
+        self.transport = transport
+        transport.listen_for_event("irc.on_privmsg", self)
+
+    def received_event(self, event):
+        if event.message.startswith(PROBE + " "):
+            self.transport.send_event(Event("irc.do_say",
+                channel=event.channel,
+                message="pong " + event.message.split()[1]))
+
+@defer.inlineCallbacks
+def run(args):
+    server = LoadIRCServer(channels=args.channels, users=args.users,
+            channel_size=args.channel_size, rate=args.start,
+            probe_rate=args.probe_rate, chanserv_latency=args.chanserv_latency,
+            flood_burst=args.server_flood_burst,
+            flood_period=args.server_flood_period,
+            flood_kill=args.flood_kill, seed=args.seed)
+    if args.tls:
+        with open(args.tls) as pem:
+            context = ssl.PrivateCertificate.loadPEM(pem.read()).options()
+        port = reactor.listenSSL(0, server, context, interface="127.0.0.1")
+    else:
+        port = reactor.listenTCP(0, server, interface="127.0.0.1")
+
+    plugin_config = {
+            "irc.IRCBotPlugin": {
+                "server": "127.0.0.1",
+                "port": port.getHost().port,
+                "ssl": bool(args.tls),
+                "nick": "abbott",
+                "channels": sorted(server.channels),
+                "flood_burst": args.flood_burst,
+                "flood_period": args.flood_period,
+                },
+            }
+    configdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(configdir, "config.json"), "w") as out:
+            json.dump({
+                "core": {"plugins": []},
+                "plugin_config": plugin_config,
+                "command": {"prefix": None},
+                }, out)
+        transport = Transport()
+        boss = PluginBoss(configdir, transport)
+        for plugin in ["irc.IRCBotPlugin"] + args.plugin:
+            boss.load_plugin(plugin)
+        ProbeAnswerer(transport)
+
+        yield wait_until(lambda: server.joined == set(server.channels),
+                timeout=60)
+        server.start()
+        server.script([(args.raid_at, "raid", {"count": args.raid_size})]
+                if args.raid_at else [])
+        server.script([(args.netsplit_at, "netsplit",
+            {"fraction": args.netsplit_fraction})] if args.netsplit_at else [])
+        report = (yield ramp(server, start=args.start, step=args.step,
+            step_duration=args.step_duration, max_rate=args.max_rate,
+            slo_latency=args.slo_latency, slo_percentile=args.slo_percentile,
+            max_flood=args.max_flood))
+        server.stop()
+        for plugin in list(boss.loaded_plugins):
+            boss.unload_plugin(plugin)
+    finally:
+        shutil.rmtree(configdir)
+        port.stopListening()
+    defer.returnValue(report)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ramps up the load on a bot "
+            "connected to a simulated network until it breaks the SLO")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--channel-size", type=int, default=None)
+    parser.add_argument("--start", type=float, default=1,
+            help="lines per second to start at")
+    parser.add_argument("--step", type=float, default=1)
+    parser.add_argument("--step-duration", type=float, default=10)
+    parser.add_argument("--max-rate", type=float, default=1000)
+    parser.add_argument("--probe-rate", type=float, default=0.5,
+            help="probes per second")
+    parser.add_argument("--slo-latency", type=float, default=2.0)
+    parser.add_argument("--slo-percentile", type=float, default=0.95)
+    parser.add_argument("--max-flood", type=int, default=0,
+            help="flood violations allowed per step")
+    parser.add_argument("--chanserv-latency", type=float, default=0.5)
+    parser.add_argument("--flood-burst", type=int, default=5,
+            help="the bot's flood_burst")
+    parser.add_argument("--flood-period", type=float, default=2,
+            help="the bot's flood_period")
+    parser.add_argument("--server-flood-burst", type=int, default=10)
+    parser.add_argument("--server-flood-period", type=float, default=1)
+    parser.add_argument("--flood-kill", action="store_true",
+            help="disconnect the bot when it floods")
+    parser.add_argument("--raid-at", type=float, default=None,
+            help="seconds into the run to raid a channel")
+    parser.add_argument("--raid-size", type=int, default=20)
+    parser.add_argument("--netsplit-at", type=float, default=None,
+            help="seconds into the run to split the network")
+    parser.add_argument("--netsplit-fraction", type=float, default=0.3)
+    parser.add_argument("--plugin", action="append", default=[],
+            help="other plugins to load into the bot")
+    parser.add_argument("--tls", metavar="PEMFILE",
+            help="serve TLS with the certificate and key in PEMFILE")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        log.startLogging(sys.stdout)
+
+    result = {}
+    def done(report):
+        result.update(report)
+        reactor.stop()
+    def failed(failure):
+        failure.printTraceback()
+        reactor.stop()
+    reactor.callWhenRunning(lambda: run(args).addCallbacks(done, failed))
+    reactor.run()
+
+    if not result:
+        return 1
+    for rate, latency, flood in result['steps']:
+        print("{0:10g} lines/s  p{1:g} latency {2:8.3f}s  {3} flood "
+                "violations".format(rate, args.slo_percentile * 100, latency,
+                    flood))
+    if result['saturated'] is None:
+        print("Did not saturate up to {0:g} lines/s".format(args.max_rate))
+    elif result['sustained'] is None:
+        print("Saturated at {0:g} lines/s, the first step".format(
+            result['saturated']))
+    else:
+        print("Saturated at {0:g} lines/s; sustained {1:g} lines/s".format(
+            result['saturated'], result['sustained']))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
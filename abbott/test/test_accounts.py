@@ -0,0 +1,146 @@
+from twisted.internet import defer, reactor, task
+
+from ..plugins import ircutil
+from .fakeircd import BotTestCase, wait_until
+
+USERS = {
+        "alice": {"user": "alice", "host": "alice.example.com", "account": "alice_acct"},
+        "bob": {"user": "bob", "host": "bob.example.com"},
+        }
+
+class AccountTestCase(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircutil.IRCWhois",
+            "ircutil.AccountTracker", "auth.Auth")
+    USERS = USERS
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(AccountTestCase, self).setUp()
+        self.auth = self.boss.loaded_plugins['auth.Auth']
+
+class TestAccountCaps(AccountTestCase):
+    CAPS = ("account-notify", "extended-join", "account-tag", "sasl")
+
+    def test_caps_negotiated(self):
+        self.assertEqual(self.ircplugin.client.caps,
+                set(["account-notify", "extended-join", "account-tag"]))
+
+    @defer.inlineCallbacks
+    def test_extended_join_no_whois(self):
+        self.server.send(":alice!alice@alice.example.com JOIN #test alice_acct :Alice")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        authname = (yield self.auth._get_authname("alice!alice@alice.example.com"))
+        self.assertEqual("alice_acct", authname)
+        self.assertEqual([], self.server.commands_received("WHOIS"))
+
+    @defer.inlineCallbacks
+    def test_account_notify(self):
+        self.server.send(":alice!alice@alice.example.com JOIN #test * :Alice")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(None,
+                (yield self.auth._get_authname("alice!alice@alice.example.com")))
+
+        self.server.send(":alice!alice@alice.example.com ACCOUNT alice_acct")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual("alice_acct",
+                (yield self.auth._get_authname("alice!alice@alice.example.com")))
+
+        self.server.send(":alice!alice@alice.example.com NICK alice2")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual("alice_acct",
+                (yield self.auth._get_authname("alice2!alice@alice.example.com")))
+
+        self.server.send(":alice2!alice@alice.example.com QUIT :bye")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        yield self.assertFailure(
+                self.boss._transport.issue_request("irc.account", "alice2"),
+                ircutil.AccountUnknown)
+        self.assertEqual([], self.server.commands_received("WHOIS"))
+
+    @defer.inlineCallbacks
+    def test_account_tag(self):
+        events = []
+        self.boss._transport.listen_for_event("irc.on_privmsg",
+                type("Listener", (), {"received_event": lambda s, e: events.append(e)})())
+        self.server.send("@account=alice_acct :alice!alice@alice.example.com PRIVMSG #test :hi")
+        self.server.send(":bob!bob@bob.example.com PRIVMSG #test :hello")
+        yield wait_until(lambda: len(events) == 2)
+
+        self.assertEqual("alice_acct", events[0].account)
+        self.assertEqual(None, events[1].account)
+
+        # Permission checks on these events don't need to ask the server
+        self.assertFalse((yield events[0].has_permission("some.perm", "#test")))
+        self.assertFalse((yield events[1].has_permission("some.perm", "#test")))
+        self.assertEqual([], self.server.commands_received("WHOIS"))
+
+class TestNoCaps(AccountTestCase):
+    CAPS = ()
+
+    @defer.inlineCallbacks
+    def test_falls_back_to_whois(self):
+        self.server.send(":alice!alice@alice.example.com JOIN #test")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        authname = (yield self.auth._get_authname("alice!alice@alice.example.com"))
+        self.assertEqual("alice_acct", authname)
+        self.assertEqual(1, len(self.server.commands_received("WHOIS")))
+
+class TestWhox(AccountTestCase):
+    CAPS = ()
+    CHANNELS = {"#test": ["alice", "bob"]}
+    ISUPPORT = ("WHOX",)
+
+    @defer.inlineCallbacks
+    def test_whox_on_join(self):
+        yield wait_until(lambda: "bob!bob@bob.example.com" in self.auth.authd_users)
+        self.assertEqual(1, len(self.server.commands_received("WHO")))
+
+        self.assertEqual("alice_acct",
+                (yield self.auth._get_authname("alice!alice@alice.example.com")))
+        self.assertEqual(None,
+                (yield self.auth._get_authname("bob!bob@bob.example.com")))
+        self.assertEqual("alice!alice@alice.example.com",
+                (yield self.boss._transport.issue_request("irc.hostmask", "Alice")))
+        self.assertEqual([], self.server.commands_received("WHOIS"))
+
+    @defer.inlineCallbacks
+    def test_reply_channel_case(self):
+        yield wait_until(lambda: "bob!bob@bob.example.com" in self.auth.authd_users)
+        resolved = []
+        listener = type("Listener", (),
+                {"received_event": lambda s, e: resolved.append(e)})()
+        self.boss._transport.listen_for_event("ircutil.on_accounts_resolved",
+                listener)
+
+        # The server echoes the channel back in its own case
+        connection = self.server.connection
+        irc_WHO = connection.irc_WHO
+        def upper_WHO(params):
+            self.server.channels["#TEST"] = self.server.channels["#test"]
+            irc_WHO(["#TEST"] + params[1:])
+        connection.irc_WHO = upper_WHO
+        self.server.send(":abbott!bot@bot.host JOIN #test")
+        yield wait_until(lambda: resolved)
+
+        self.assertEqual({"alice!alice@alice.example.com": "alice_acct",
+            "bob!bob@bob.example.com": None}, resolved[0].users)
+        self.assertEqual({}, self.boss.loaded_plugins[
+            'ircutil.AccountTracker'].whox_pending)
+
+    @defer.inlineCallbacks
+    def test_match_users(self):
+        yield wait_until(lambda: "bob!bob@bob.example.com" in self.auth.authd_users)
+        issue = self.boss._transport.issue_request
+        self.assertEqual(["alice!alice@alice.example.com"],
+                (yield issue("irc.match_users", "*!*@alice.example.com", "#test")))
+        self.assertEqual(["alice!alice@alice.example.com", "bob!bob@bob.example.com"],
+                sorted((yield issue("irc.match_users", "*!*@*.example.com"))))
+        self.assertEqual([],
+                (yield issue("irc.match_users", "*!*@*.example.com", "#other")))
+
+        self.server.send(":bob!bob@bob.example.com NICK robert")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(["robert!bob@bob.example.com"],
+                (yield issue("irc.match_users", "*!bob@*")))
@@ -0,0 +1,78 @@
+from twisted.internet import defer, reactor, task
+
+from .fakeircd import BotTestCase, wait_until
+
+class TestChanMode(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircutil.ChanMode")
+    MODES = {"#test": "+ntlk 10 secret"}
+
+    def chanmode(self):
+        return self.boss._transport.issue_request("irc.chanmode", "#test")
+
+    @defer.inlineCallbacks
+    def test_deltas_applied_locally(self):
+        yield wait_until(lambda: self.server.commands_received("MODE"))
+        self.assertEqual(("+ntlk", ["10", "secret"]), (yield self.chanmode()))
+
+        self.server.send(":op!op@op.host MODE #test +mvvb-l alice bob *!*@spam")
+        self.server.send(":op!op@op.host MODE #test -k+l secret 20")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        self.assertEqual(("+ntml", ["20"]), (yield self.chanmode()))
+        self.assertEqual(["MODE #test"], self.server.commands_received("MODE"))
+
+    @defer.inlineCallbacks
+    def test_drift_requeries(self):
+        yield wait_until(lambda: self.server.commands_received("MODE"))
+        yield self.chanmode()
+
+        self.server.modes["#test"] = "+ntsi"
+        self.server.send(":op!op@op.host MODE #test -s")
+        yield wait_until(lambda: len(self.server.commands_received("MODE")) == 2)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        self.assertEqual(("+ntsi", []), (yield self.chanmode()))
+
+    @defer.inlineCallbacks
+    def test_failed_requery_forgets_modes(self):
+        yield wait_until(lambda: self.server.commands_received("MODE"))
+        yield self.chanmode()
+
+        plugin = self.boss.loaded_plugins['ircutil.ChanMode']
+        get_mode = plugin._get_mode
+        plugin._get_mode = lambda channel: defer.fail(
+                Exception("no response from server"))
+        self.server.send(":op!op@op.host MODE #test -s")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertNotIn("#test", plugin.mode)
+
+        # The next request asks again
+        plugin._get_mode = get_mode
+        self.server.modes["#test"] = "+nt"
+        self.assertEqual(("+nt", []), (yield self.chanmode()))
+        self.assertEqual(2, len(self.server.commands_received("MODE")))
+
+class TestChanList(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircutil.ChanMode")
+    LISTS = {"#test": {"b": ["*!*@spam.host"], "q": ["troll!*@*"]}}
+
+    def chanlist(self, letter):
+        return self.boss._transport.issue_request("irc.chanlist", "#test", letter)
+
+    @defer.inlineCallbacks
+    def test_loaded_once_and_kept_up_to_date(self):
+        yield wait_until(lambda: self.server.commands_received("MODE"))
+        bans, quiets = (yield defer.gatherResults([self.chanlist("b"),
+            self.chanlist("q")]))
+        self.assertEqual([("*!*@spam.host", "op!op@op.host", 1500000000)], bans)
+        self.assertEqual(["troll!*@*"], [mask for mask, _, _ in quiets])
+
+        self.server.send(":op!op@op.host MODE #test +b-q other troll")
+        self.server.send(":op!op@op.host MODE #test -b *!*@SPAM.host")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        self.assertEqual(["other!*@*"], [mask for mask, _, _ in (yield self.chanlist("b"))])
+        self.assertEqual([], (yield self.chanlist("q")))
+        self.assertEqual(["MODE #test", "MODE #test b", "MODE #test q"],
+                sorted(self.server.commands_received("MODE")))
+        yield self.assertFailure(self.chanlist("n"), ValueError)
@@ -0,0 +1,75 @@
+import random
+
+from twisted.trial import unittest
+
+from ..hostmask import match, normalize_mask, MaskIndex, UserIndex
+
+class TestMatch(unittest.TestCase):
+    def test_globs(self):
+        self.assertTrue(match("*!*@*.example.net", "nick!user@a.example.net"))
+        self.assertFalse(match("*!*@*.example.net", "nick!user@example.net"))
+        self.assertTrue(match("n?ck!*@*", "NICK!user@host"))
+        self.assertTrue(match("nick[a]!*@*", "NICK{A}!user@host"))
+        self.assertFalse(match("n.ck!*@*", "nick!user@host"))
+
+    def test_normalize(self):
+        self.assertEqual("nick!*@*", normalize_mask("nick"))
+        self.assertEqual("*!user@host", normalize_mask("user@host"))
+        self.assertEqual("nick!user@*", normalize_mask("nick!user"))
+        self.assertEqual("$a:acct", normalize_mask("$a:acct"))
+
+class TestMaskIndex(unittest.TestCase):
+    def test_matches(self):
+        index = MaskIndex(["*!*@spam.example.net", "*!*@*.example.net",
+            "troll", "*!*@*", "*!bad@*", "*!*@1.2.*", "$a:evil*", "$~a",
+            "$j:#other"])
+
+        self.assertEqual(set(["*!*@spam.example.net", "*!*@*.example.net",
+            "*!*@*", "$~a"]),
+            set(index.matches("someone!u@spam.example.net")))
+        self.assertEqual(set(["troll", "*!*@*", "*!bad@*", "*!*@1.2.*",
+            "$a:evil*"]),
+            set(index.matches("Troll!bad@1.2.3.4", account="evilacct")))
+
+        index.discard("*!*@*")
+        index.discard("TROLL!*@*")
+        self.assertEqual(["*!*@*.example.net"],
+                index.matches("someone!u@www.example.net", account="good"))
+        self.assertFalse("troll" in index)
+        self.assertEqual(7, len(index))
+
+    def test_same_as_scan(self):
+        rng = random.Random(147)
+        hosts = ["a.example.net", "b.example.net", "example.net",
+                "x.y.example.org", "1.2.3.4", "gateway/web/x"]
+        words = ["alice", "bob", "carol", "*", "?ob", "a*"]
+        masks = set()
+        for _ in range(200):
+            host = rng.choice(hosts + ["*." + h for h in hosts] + ["*", "1.2.*"])
+            masks.add("{0}!{1}@{2}".format(rng.choice(words), rng.choice(words), host))
+        index = MaskIndex(masks)
+        for _ in range(200):
+            hostmask = "{0}!{1}@{2}".format(rng.choice(words[:3]),
+                    rng.choice(words[:3]), rng.choice(hosts))
+            self.assertEqual(
+                    sorted(m for m in masks if match(m, hostmask)),
+                    sorted(index.matches(hostmask)))
+
+class TestUserIndex(unittest.TestCase):
+    def test_matching(self):
+        index = UserIndex()
+        index.add("alice!a@a.example.net", "alice_acct")
+        index.add("bob!b@example.net")
+        index.add("carol!c@c.example.org")
+
+        self.assertEqual(["alice!a@a.example.net"],
+                index.matching("*!*@*.example.net"))
+        self.assertEqual(["bob!b@example.net"], index.matching("*@example.net"))
+        self.assertEqual(["carol!c@c.example.org"], index.matching("Carol"))
+        self.assertEqual(["alice!a@a.example.net"], index.matching("$a"))
+        self.assertEqual(set(["bob!b@example.net", "carol!c@c.example.org"]),
+                set(index.matching("$~a")))
+        self.assertEqual(3, len(index.matching("*!*@*")))
+
+        index.discard("alice!a@a.example.net")
+        self.assertEqual([], index.matching("*!*@*.example.net"))
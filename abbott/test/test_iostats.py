@@ -0,0 +1,40 @@
+from twisted.internet import defer
+
+from .fakeircd import BotTestCase, wait_until
+
+class TestIOStats(BotTestCase):
+    IRC_CONFIG = {"stats_interval": 0.05, "lag_interval": 0.1}
+
+    def stats(self):
+        return self.boss._transport.issue_request("irc.stats")
+
+    @defer.inlineCallbacks
+    def test_counters_and_lag(self):
+        yield wait_until(lambda: self.server.commands_received("PING"))
+        yield wait_until(lambda: self.ircplugin.iostats.last_lag is not None)
+        stats = (yield self.stats())
+
+        self.assertTrue(stats['connected'])
+        self.assertEqual(0, stats['reconnects'])
+        self.assertEqual(len(self.server.received), stats['lines_out'])
+        self.assertEqual(sum(len(l.encode("UTF-8")) + 2
+            for l in self.server.received), stats['bytes_out'])
+        self.assertTrue(stats['lines_in'] > 3)
+        self.assertTrue(stats['bytes_in'] > stats['lines_in'] * 2)
+        self.assertTrue(0 <= stats['lag'] < 1)
+        self.assertTrue(stats['depth'])
+        self.assertTrue("throttles" in stats['outbound'])
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        self.ircplugin.initialDelay = self.ircplugin.delay = 0.1
+        self.ircplugin.jitter = 0
+        old = self.ircplugin.client
+        self.server.connection.transport.loseConnection()
+        yield wait_until(lambda: self.ircplugin.client not in (None, old) and
+                self.ircplugin.client.synced_after is not None)
+
+        stats = (yield self.stats())
+        self.assertEqual(1, stats['reconnects'])
+        self.assertEqual(1, len(stats['rejoin_times']))
+        self.assertTrue(stats['rejoin_times'][0] >= 0.1)
@@ -0,0 +1,323 @@
+from collections import defaultdict
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+from ..plugins import ircop
+from ..plugins.ircop import plan_modes, OpFailed
+from .fakeircd import BotTestCase, wait_until
+
+class TestPlanModes(unittest.TestCase):
+
+    def test_packs_up_to_max_modes(self):
+        changes = [("+v", nick) for nick in "abcdefg"]
+        self.assertEqual([
+            "MODE #c +vvvv a b c d",
+            "MODE #c +vvv e f g",
+            ], plan_modes("#c", changes, max_modes=4))
+
+    def test_signs(self):
+        self.assertEqual(["MODE #c +vm-vo+b a b c *!*@host"],
+                plan_modes("#c", [("+v", "a"), ("+m", None), ("-v", "b"),
+                    ("-o", "c"), ("+b", "*!*@host")], max_modes=None))
+
+    def test_line_length(self):
+        changes = [("+b", "*!*@" + "x"*200), ("+b", "*!*@" + "y"*200),
+                ("+b", "*!*@" + "z"*200)]
+        lines = plan_modes("#c", changes, max_modes=None)
+        self.assertEqual(2, len(lines))
+        self.assertTrue(all(len(line) <= 510 for line in lines))
+        self.assertEqual(3, len(plan_modes("#c", changes, max_modes=None, maxlen=400)))
+
+    def test_opposing_changes(self):
+        # Only the last change to each thing counts
+        self.assertEqual(["MODE #c -v+m A"],
+                plan_modes("#c", [("+v", "a"), ("-m", None), ("-v", "A"),
+                    ("+m", None)]))
+
+    def test_noops(self):
+        voiced = set(["a"])
+        is_noop = lambda mode, param: (param in voiced) == (mode == "+v")
+        self.assertEqual(["MODE #c +v-v b a"],
+                plan_modes("#c", [("+v", "a"), ("+v", "b"), ("-v", "a"),
+                    ("-v", "c"), ("-v", "a")], is_noop=is_noop))
+        self.assertEqual([], plan_modes("#c", [("+v", "a")], is_noop=is_noop))
+
+class TestBatchWindow(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ircop, "reactor", self.clock)
+        self.patch(ircop, "time", type("Time", (), {
+            "time": staticmethod(self.clock.seconds)}))
+
+        self.provider = ircop.OpProvider.__new__(ircop.OpProvider)
+        self.provider.config = dict(ircop.OpProvider.DEFAULT_CONFIG)
+        self.provider.request_rate = {}
+        self.provider.buffer_timers = {}
+        self.provider.first_buffered = {}
+        self.provider.stats = defaultdict(int)
+        self.provider.mode_buffer = defaultdict(list)
+        self.provider.event_buffer = defaultdict(set)
+        self.provider.connector_buffer = defaultdict(set)
+        self.flushes = []
+        self.provider._process_buffer = lambda channel: defer.succeed(
+                self.flushes.append(self.clock.seconds()))
+
+    def test_steady_stream_flushed_within_max_window(self):
+        # A request every 0.15 seconds keeps pushing the timer back
+        for _ in range(60):
+            self.provider._set_buffer_processor_timer("#test")
+            self.clock.advance(0.15)
+        # The clock only moves in steps of 0.15, so flushes are seen up to
+        # that late
+        late = self.provider.config['max_window'] + 0.15
+        self.assertTrue(len(self.flushes) >= 4)
+        self.assertTrue(self.flushes[0] <= late)
+        for before, after in zip(self.flushes, self.flushes[1:]):
+            self.assertTrue(after - before <= late)
+
+    def test_window_at_low_rates(self):
+        config = self.provider.config
+        self.assertEqual(config['min_window'],
+                self.provider._batch_window("#test"))
+        # Too slow for the next request to be expected within max_window,
+        # but still worth waiting as long as we can for
+        slow = 1.0 / config['max_window']
+        self.provider.request_rate["#test"] = (slow, self.clock.seconds())
+        self.assertEqual(config['max_window'],
+                self.provider._batch_window("#test"))
+
+class TestOpProviderModes(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircutil.Names", "ircutil.HasOp",
+            "ircutil.ChanMode", "ircop.OpProvider")
+    CHANNELS = {"#test": ["+alice", "bob", "carol", "dave", "eve", "frank"]}
+
+    @defer.inlineCallbacks
+    def test_batched_by_server_limits(self):
+        yield wait_until(lambda: self.server.commands_received("MODE"))
+        self.server.send(":ChanServ!ChanServ@services MODE #test +o abbott")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        issue = self.boss._transport.issue_request
+        yield defer.gatherResults(
+                [issue("ircop.voice", "#test", nick) for nick in
+                    ("alice", "bob", "carol", "dave", "eve", "frank")] +
+                [issue("ircop.devoice", "#test", "carol"),
+                 issue("ircop.mode", "#test", "+t"),
+                 issue("ircop.mode", "#test", "+m")])
+
+        # alice is already voiced, the voice and devoice of carol cancel
+        # out, the channel is already +t, and the server takes 4 modes a line
+        yield wait_until(lambda: len(self.server.commands_received("MODE")) > 2)
+        self.assertEqual(["MODE #test +vvvv bob dave eve frank", "MODE #test +m"],
+                self.server.commands_received("MODE")[1:])
+
+    @defer.inlineCallbacks
+    def test_hold_op(self):
+        yield wait_until(lambda: self.server.commands_received("MODE"))
+        self.server.send(":ChanServ!ChanServ@services MODE #test +o abbott")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        issue = self.boss._transport.issue_request
+        yield issue("ircop.become_op", "#test", 0.2)
+        yield issue("ircop.become_op", "#test", 0.4)
+        yield wait_until(lambda: len(self.server.commands_received("MODE")) > 1)
+        self.assertEqual(["MODE #test -o abbott"],
+                self.server.commands_received("MODE")[1:])
+
+        self.server.send(":abbott!bot@bot.host MODE #test -o abbott")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        stats = (yield issue("ircop.stats"))
+        self.assertEqual(1, stats['batches'])
+        self.assertEqual(1, stats['op_sessions'])
+        self.assertTrue(stats['op_seconds'] >= 0.4)
+
+    @defer.inlineCallbacks
+    def test_many(self):
+        yield wait_until(lambda: self.server.commands_received("MODE"))
+        self.server.send(":ChanServ!ChanServ@services MODE #test +o abbott")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        issue = self.boss._transport.issue_request
+        results = yield defer.gatherResults([
+            issue("ircop.voice_many", "#test", ["bob", "carol"]),
+            issue("ircop.mode_many", "#test", [("+m", None), ("+z", "x")]),
+            ])
+
+        self.assertEqual({"bob": None, "carol": None}, results[0])
+        self.assertEqual(None, results[1][("+m", None)])
+        # +z doesn't take a parameter
+        self.assertTrue(results[1][("+z", "x")].check(ValueError))
+        yield wait_until(lambda: len(self.server.commands_received("MODE")) > 1)
+        self.assertEqual(["MODE #test +vvm bob carol"],
+                self.server.commands_received("MODE")[1:])
+        # Only the targets that passed the checks went into the buffers,
+        # all in the one batch
+        stats = (yield issue("ircop.stats"))
+        self.assertEqual(1, stats['batches'])
+        self.assertEqual(3, stats['batched_requests'])
+
+class TestOpProviderReplay(BotTestCase):
+    # Without ChanMode the lists aren't known, so nothing is skipped as
+    # redundant
+    PLUGINS = ("irc.IRCBotPlugin", "ircutil.Names", "ircutil.HasOp",
+            "ircop.OpProvider")
+
+    @defer.inlineCallbacks
+    def test_quiet_and_unquiet_collapse(self):
+        yield wait_until(lambda: self.server.commands_received("JOIN"))
+        self.server.send(":ChanServ!ChanServ@services MODE #test +o abbott")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        ircplugin = self.boss.loaded_plugins['irc.IRCBotPlugin']
+        ircplugin.client._registered = False
+        issue = self.boss._transport.issue_request
+        yield issue("ircop.quiet", "#test", "*!*@spam.host")
+        yield issue("ircop.unquiet", "#test", "*!*@SPAM.host")
+        yield issue("ircop.voice", "#test", "bob")
+        self.assertEqual(2, len(ircplugin.replay))
+        self.assertTrue(ircplugin.replay.pending("#test"))
+
+        self.server.received = []
+        self.server.send(":fake.ircd 001 abbott :Welcome back")
+        yield wait_until(lambda: len(self.server.commands_received("MODE")) > 1)
+        modes = [line for line in self.server.received
+                if line.startswith(("JOIN", "MODE #test +", "MODE #test -"))]
+        self.assertEqual(["JOIN #test", "MODE #test -q *!*@SPAM.host",
+            "MODE #test +v bob"], modes)
+
+class TestChanservConnector(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircop.ChanservConnector")
+
+    @defer.inlineCallbacks
+    def test_multi_target(self):
+        issue = self.boss._transport.issue_request
+        nicks = ["nick{0:02}".format(i) for i in range(100)]
+        yield defer.gatherResults(
+                [issue("connector.chanserv.voice", "#test", nick) for nick in nicks] +
+                [issue("connector.chanserv.quiet", "#test", "spammer")])
+
+        yield wait_until(lambda: len(self.server.commands_received("PRIVMSG")) > 2)
+        lines = self.server.commands_received("PRIVMSG")
+        voices = [l for l in lines if l.startswith("PRIVMSG ChanServ :VOICE #test ")]
+        self.assertEqual(2, len(voices))
+        self.assertTrue(all(len(l) <= 510 for l in voices))
+        self.assertEqual(nicks, " ".join(l.split(" ", 4)[4] for l in voices).split())
+        self.assertIn("PRIVMSG ChanServ :QUIET #test spammer", lines)
+
+class TestWeechatConnector(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircop.WeechatConnector")
+
+    def setUp(self):
+        self.fifodir = tempfile.mkdtemp()
+        self.fifo = os.path.join(self.fifodir, "weechat_fifo_1")
+        os.mkfifo(self.fifo)
+        self.PLUGIN_CONFIG = {"ircop.WeechatConnector": {
+            "fifo": os.path.join(self.fifodir, "weechat_fifo_*")}}
+        return super(TestWeechatConnector, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fifodir)
+        return super(TestWeechatConnector, self).tearDown()
+
+    @defer.inlineCallbacks
+    def test_writes_and_fails_fast(self):
+        issue = self.boss._transport.issue_request
+
+        # Nobody's reading
+        yield self.assertFailure(issue("connector.weechat.voice", "#test", "bob"),
+                OpFailed)
+
+        reader = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
+        yield issue("connector.weechat.voice", "#test", "bob")
+        yield issue("connector.weechat.op", "#test", "carol")
+        received = []
+        def read():
+            try:
+                received.append(os.read(reader, 4096))
+            except BlockingIOError:
+                pass
+            return b"carol\n" in b"".join(received)
+        yield wait_until(read)
+        self.assertEqual(
+                b"irc.server.freenode */msg ChanServ VOICE #test bob\n"
+                b"irc.server.freenode */msg ChanServ OP #test carol\n",
+                b"".join(received))
+
+        # Weechat goes away
+        os.close(reader)
+        yield issue("connector.weechat.voice", "#test", "dave")
+        connector = self.boss.loaded_plugins['ircop.WeechatConnector']
+        yield wait_until(lambda: connector.writer is None)
+        yield self.assertFailure(issue("connector.weechat.voice", "#test", "bob"),
+                OpFailed)
+
+class TestOpProviderLists(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircutil.Names", "ircutil.HasOp",
+            "ircutil.ChanMode", "ircop.OpProvider")
+    CHANNELS = {"#test": ["bob"]}
+    LISTS = {"#test": {"b": ["*!*@spam.host"], "q": ["troll!*@*"]}}
+
+    @defer.inlineCallbacks
+    def test_redundant_list_changes_skipped(self):
+        yield wait_until(lambda: self.server.commands_received("MODE"))
+        issue = self.boss._transport.issue_request
+
+        # Nothing to do here, so no op is needed
+        yield defer.gatherResults([
+            issue("ircop.ban", "#test", "*!*@spam.host"),
+            issue("ircop.quiet", "#test", "troll"),
+            issue("ircop.unban", "#test", "nobody"),
+            ])
+        stats = (yield issue("ircop.stats"))
+        self.assertEqual(3, stats['redundant'])
+        self.assertEqual(0, stats.get('batches', 0))
+
+        self.server.send(":ChanServ!ChanServ@services MODE #test +o abbott")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        yield defer.gatherResults([
+            issue("ircop.ban", "#test", "*!*@other.host"),
+            issue("ircop.unquiet", "#test", "troll"),
+            ])
+        yield wait_until(lambda: len(self.server.commands_received("MODE")) > 3)
+        self.assertEqual("MODE #test +b-q *!*@other.host troll",
+                self.server.commands_received("MODE")[-1])
+        self.assertEqual(["*!*@spam.host"],
+                [mask for mask, _, _ in (yield issue("ircop.list", "#test"))])
+
+    @defer.inlineCallbacks
+    def test_request_buffered_while_list_pending(self):
+        yield wait_until(lambda: self.server.commands_received("MODE"))
+        self.server.send(":ChanServ!ChanServ@services MODE #test +o abbott")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        issue = self.boss._transport.issue_request
+
+        # The first list lookup is the redundancy check when the request
+        # comes in. The second, while processing the buffers, hangs until
+        # we let it go.
+        provider = self.boss.loaded_plugins['ircop.OpProvider']
+        pending = defer.Deferred()
+        lookups = []
+        def get_list(channel, letter):
+            lookups.append(letter)
+            return defer.succeed(set()) if len(lookups) == 1 else pending
+        provider._get_list = get_list
+
+        exempt = issue("ircop.mode", "#test", "+e", "*!*@friend.host")
+        yield wait_until(lambda: len(lookups) == 2)
+        # This comes in while the buffers are being processed, and its timer
+        # fires while they still are
+        voice = issue("ircop.voice", "#test", "bob")
+        yield wait_until(lambda: provider.stats['batches'] == 2)
+
+        pending.callback(set())
+        yield exempt
+        yield voice
+        sent = lambda: [line for line in self.server.commands_received("MODE")
+                if line.startswith("MODE #test +")]
+        yield wait_until(lambda: len(sent()) == 2)
+        self.assertEqual(["MODE #test +e *!*@friend.host", "MODE #test +v bob"],
+                sent())
@@ -0,0 +1,55 @@
+from time import time
+
+from twisted.internet import defer
+
+from .fakeircd import BotTestCase, wait_until
+from .loadircd import LoadIRCServer, ProbeAnswerer, ramp
+
+class TestLoadIRCServer(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircop.ChanservConnector")
+    IRC_CONFIG = {"channels": ["#load-000", "#load-001"], "storm_window": 0.1}
+
+    def make_server(self):
+        return LoadIRCServer(channels=2, users=20, channel_size=10,
+                chanserv_latency=0.1, flood_burst=5, seed=1)
+
+    def record(self, eventtype):
+        events = []
+        self.boss._transport.listen_for_event(eventtype,
+                type("Listener", (), {"received_event":
+                    lambda s, e: events.append(e)})())
+        return events
+
+    @defer.inlineCallbacks
+    def test_chanserv(self):
+        modes = self.record("irc.on_mode_change")
+        self.boss._transport.issue_request("connector.chanserv.voice",
+                "#load-000", "user0001")
+        yield self.server.wait_for_command("PRIVMSG")
+        sent = time()
+        yield wait_until(lambda: modes)
+        self.assertTrue(time() - sent >= 0.1)
+        self.assertEqual(("ChanServ", "v", "user0001"),
+                (modes[0].user.split("!")[0], modes[0].mode, modes[0].arg))
+
+    @defer.inlineCallbacks
+    def test_netsplit(self):
+        splits = self.record("irc.on_netsplit")
+        self.server.netsplit(fraction=0.5, duration=0.2)
+        yield wait_until(lambda: splits)
+        self.assertEqual(10, len(splits[0].users))
+        yield wait_until(lambda: len(self.server.channels["#load-000"]) == 10)
+
+    @defer.inlineCallbacks
+    def test_ramp(self):
+        ProbeAnswerer(self.boss._transport)
+        self.server.start()
+        self.server.set_rate(20, probe_rate=20)
+        report = (yield ramp(self.server, start=20, step=20, step_duration=1,
+            max_rate=40, slo_latency=0.5))
+        # The bot doesn't mind the flood limit in tests, so the server's
+        # flood counter ends the ramp
+        self.assertEqual(20, report['saturated'])
+        self.assertEqual([20], [rate for rate, _, _ in report['steps']])
+        self.assertTrue(report['steps'][0][2] > 0)
+        self.server.stop()
@@ -0,0 +1,58 @@
+from twisted.internet import defer, reactor, task
+
+from .fakeircd import BotTestCase
+
+class TestNames(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircutil.Names")
+    USERS = {
+            "alice": {"user": "alice", "host": "alice.example.com"},
+            "bob": {"user": "bob", "host": "bob.example.com"},
+            }
+    CHANNELS = {"#test": ["alice", "bob"]}
+
+    def names(self, channel="#test"):
+        return self.boss._transport.issue_request("irc.names", channel)
+
+    @defer.inlineCallbacks
+    def test_tracks_membership(self):
+        self.assertEqual(["@abbott", "alice", "bob"], sorted((yield self.names())))
+
+        self.server.send(":bob!bob@bob.example.com MODE #test +vo alice alice")
+        self.server.send(":bob!bob@bob.example.com PART #test")
+        self.server.send(":carol!carol@carol.example.com JOIN #test")
+        self.server.send(":alice!alice@alice.example.com NICK alice2")
+        self.server.send(":alice!alice@alice.example.com MODE #test -o alice2")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        self.assertEqual(["+alice2", "@abbott", "carol"], sorted((yield self.names())))
+        members = (yield self.boss._transport.issue_request("irc.members", "#TEST"))
+        self.assertEqual(("v", None), members["alice2"])
+        self.assertEqual(("", "carol!carol@carol.example.com"), members["carol"])
+
+        # All of that without asking the server
+        self.assertEqual([], self.server.commands_received("NAMES"))
+
+    @defer.inlineCallbacks
+    def test_other_channel(self):
+        d = self.names("#other")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(["NAMES #other"], self.server.commands_received("NAMES"))
+        self.server.send(":fake.ircd 353 abbott = #other :@alice bob")
+        self.server.send(":fake.ircd 366 abbott #other :End of /NAMES list.")
+        self.assertEqual(["@alice", "bob"], sorted((yield d)))
+
+    @defer.inlineCallbacks
+    def test_no_reply(self):
+        plugin = self.boss.loaded_plugins['ircutil.Names']
+        d = plugin._wait_for_names("#silent", timeout=0.1)
+        yield self.assertFailure(d, Exception)
+        self.assertNotIn("#silent", plugin.pending)
+
+        # The next request sends a NAMES again
+        d = self.names("#silent")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(["NAMES #silent", "NAMES #silent"],
+                self.server.commands_received("NAMES"))
+        self.server.send(":fake.ircd 353 abbott = #silent :carol")
+        self.server.send(":fake.ircd 366 abbott #silent :End of /NAMES list.")
+        self.assertEqual(["carol"], (yield d))
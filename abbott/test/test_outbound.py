@@ -0,0 +1,145 @@
+import random
+import unicodedata
+
+from twisted.internet import reactor, task
+from twisted.trial import unittest
+
+from ..plugins import irc
+from ..plugins.irc import OutboundScheduler, sanitize_line
+
+class TestOutboundScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(irc, "reactor", self.clock)
+        self.patch(irc, "time", self.clock.seconds)
+        self.sent = []
+        self.scheduler = OutboundScheduler(self.sent.append, burst=2, period=2,
+                max_age={"bulk": 5})
+
+    def test_burst_then_rate(self):
+        for i in range(4):
+            self.scheduler.enqueue("PRIVMSG #a :{0}".format(i), "reply", "#a")
+        self.assertEqual(2, len(self.sent))
+        self.clock.advance(2)
+        self.assertEqual(3, len(self.sent))
+        self.clock.advance(2)
+        self.assertEqual(4, len(self.sent))
+        self.assertEqual(0, self.scheduler.depth())
+
+    def test_throttles(self):
+        for i in range(4):
+            self.scheduler.enqueue("PRIVMSG #a :{0}".format(i), "reply", "#a")
+        self.clock.pump([2] * 3)
+        # Waiting for the flood limit through two lines counts once
+        self.assertEqual(1, self.scheduler.stats()['throttles'])
+        self.scheduler.enqueue("PRIVMSG #a :4", "reply", "#a")
+        self.scheduler.enqueue("PRIVMSG #a :5", "reply", "#a")
+        self.scheduler.enqueue("PRIVMSG #a :6", "reply", "#a")
+        self.clock.pump([2] * 3)
+        stats = self.scheduler.stats()
+        self.assertEqual(2, stats['throttles'])
+        self.assertEqual(2, stats['wait_p50'])
+        self.assertEqual(4, stats['wait_p95'])
+
+    def test_priority_and_round_robin(self):
+        self.scheduler.enqueue("PING x", "op")
+        self.scheduler.enqueue("PING y", "op")
+        for i in range(3):
+            self.scheduler.enqueue("PRIVMSG #a :a{0}".format(i), "reply", "#a")
+        self.scheduler.enqueue("PRIVMSG #b :b0", "reply", "#b")
+        self.scheduler.enqueue("KICK #a troll", "op", "#a")
+        self.clock.pump([2] * 5)
+        self.assertEqual(["PING x", "PING y", "KICK #a troll",
+            "PRIVMSG #a :a0", "PRIVMSG #b :b0", "PRIVMSG #a :a1",
+            "PRIVMSG #a :a2"], self.sent)
+
+    def test_stale_dropped(self):
+        self.scheduler.enqueue("PING x", "op")
+        self.scheduler.enqueue("PING y", "op")
+        for i in range(3):
+            self.scheduler.enqueue("PRIVMSG #a :{0}".format(i), "bulk", "#a")
+        self.clock.pump([2] * 5)
+        # The first waited 2s, the second 4s, and the last would have waited 6
+        self.assertEqual(["PING x", "PING y", "PRIVMSG #a :0", "PRIVMSG #a :1"],
+                self.sent)
+
+        stats = self.scheduler.stats()
+        self.assertEqual(0, stats['depth'])
+        self.assertEqual(2, stats['lanes']['bulk']['sent'])
+        self.assertEqual(1, stats['lanes']['bulk']['dropped'])
+        self.assertEqual(3, stats['lanes']['bulk']['mean_wait'])
+        self.assertEqual(4, stats['lanes']['bulk']['max_wait'])
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(irc, "reactor", self.clock)
+        self.patch(irc, "time", self.clock.seconds)
+        self.sent = []
+
+    def scheduler(self, **kwargs):
+        return OutboundScheduler(self.sent.append, burst=1, period=2,
+                **kwargs)
+
+    def test_same_target(self):
+        scheduler = self.scheduler(max_length=lambda prefix: 36)
+        scheduler.enqueue("NOTICE bob :first", "notice", "bob", True)
+        for text in ("one", "two", "three", "four"):
+            scheduler.enqueue("NOTICE bob :" + text, "notice", "bob", True)
+        scheduler.enqueue("PRIVMSG bob :msg", "notice", "bob", True)
+        scheduler.enqueue("NOTICE bob :apart", "notice", "bob")
+        scheduler.enqueue("NOTICE bob :last", "notice", "bob", True)
+        self.clock.pump([2] * 5)
+        self.assertEqual(["NOTICE bob :first",
+            "NOTICE bob :one | two | three",
+            "NOTICE bob :four",
+            "PRIVMSG bob :msg",
+            "NOTICE bob :apart",
+            "NOTICE bob :last"], self.sent)
+        stats = scheduler.stats()['lanes']['notice']
+        self.assertEqual(6, stats['sent'])
+        self.assertEqual(2, stats['coalesced'])
+
+    def test_targmax(self):
+        scheduler = self.scheduler(targmax={"PRIVMSG": 2}.get)
+        scheduler.enqueue("PING x", "op")
+        for target in ("#a", "#b", "#c"):
+            scheduler.enqueue("PRIVMSG {0} :hi".format(target), "reply",
+                    target, True)
+        scheduler.enqueue("PRIVMSG #d :hello", "reply", "#d", True)
+        self.clock.pump([2] * 3)
+        self.assertEqual(["PING x", "PRIVMSG #a,#b :hi", "PRIVMSG #c :hi",
+            "PRIVMSG #d :hello"], self.sent)
+
+    def test_delay(self):
+        scheduler = OutboundScheduler(self.sent.append, burst=5, period=2,
+                delay=0.5)
+        scheduler.enqueue("PRIVMSG #a :one", "reply", "#a", True)
+        scheduler.enqueue("PING x", "op")
+        self.clock.advance(0.2)
+        scheduler.enqueue("PRIVMSG #a :two", "reply", "#a", True)
+        self.assertEqual(["PING x"], self.sent)
+        self.clock.advance(0.3)
+        self.assertEqual(["PING x", "PRIVMSG #a :one | two"], self.sent)
+        self.assertEqual(0, scheduler.depth())
+
+class TestSanitizeLine(unittest.TestCase):
+    def reference(self, line):
+        # What sendLine used to do
+        whitelist = frozenset("\x02\x03\x0f\x12\x1f")
+        return "".join(x for x in line if
+                unicodedata.category(x) != "Cc" or x in whitelist)
+
+    def test_same_as_reference(self):
+        rng = random.Random(43)
+        alphabet = ([chr(c) for c in range(0x100)] +
+                ["\u200b", "\u2028", "\ufeff", "\u00e9", "\U0001f600"])
+        for _ in range(2000):
+            line = "".join(rng.choice(alphabet)
+                    for _ in range(rng.randint(0, 40)))
+            self.assertEqual(self.reference(line), sanitize_line(line))
+
+    def test_clean_line_untouched(self):
+        line = "PRIVMSG #a :\x02bold\x02 \x0304red\x0f caf\u00e9"
+        self.assertTrue(sanitize_line(line) is line)
+        self.assertEqual("PRIVMSG #a :ab", sanitize_line("PRIVMSG #a :a\r\nb"))
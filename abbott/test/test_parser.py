@@ -0,0 +1,64 @@
+import os.path
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.words.protocols import irc as twisted_irc
+
+from ..plugins.irc import IRCBot, decode_line, parse_line
+from .fakeircd import BotTestCase, wait_until
+
+CORPUS = os.path.join(os.path.dirname(__file__), "data", "traffic.irc")
+
+class TestParseLine(unittest.TestCase):
+    def test_same_as_parsemsg(self):
+        with open(CORPUS, "rb") as corpus:
+            lines = [decode_line(l.rstrip(b"\r\n")) for l in corpus]
+        for line in lines:
+            if line.startswith("@"):
+                line = line.split(" ", 1)[1]
+            tags, prefix, command, params = parse_line(line)
+            self.assertEqual({}, tags)
+            self.assertEqual(twisted_irc.parsemsg(line),
+                    (prefix, command, params))
+
+    def test_tags(self):
+        self.assertEqual(({"account": "alice", "msgid": "a b", "flag": ""},
+            "alice!a@host", "PRIVMSG", ["#chan", "hi there"]),
+            parse_line("@account=alice;msgid=a\\sb;flag  :alice!a@host "
+                "PRIVMSG #chan :hi there"))
+        self.assertEqual(({"time": "now"}, "", "PING", ["x"]),
+                parse_line("@time=now PING :x"))
+
+    def test_bad_lines(self):
+        for line in ("", "   ", "@tags", ":prefix", "@tags :prefix"):
+            self.assertRaises(twisted_irc.IRCBadMessage, parse_line, line)
+
+    def test_decode(self):
+        self.assertEqual("café", decode_line(b"caf\xc3\xa9"))
+        self.assertEqual("café", decode_line(b"caf\xe9"))
+
+    def test_dispatch(self):
+        self.assertEqual(("RPL_WELCOME", "irc_RPL_WELCOME"),
+                IRCBot.DISPATCH["001"])
+        self.assertEqual(("RPL_WHOISUSER", None), IRCBot.DISPATCH["311"])
+        self.assertEqual(("JOIN", "irc_JOIN"), IRCBot.DISPATCH["JOIN"])
+        self.assertFalse("354" in IRCBot.DISPATCH)
+
+class TestTagsOnEvents(BotTestCase):
+    CAPS = ("server-time",)
+
+    @defer.inlineCallbacks
+    def test_tags(self):
+        events = []
+        listener = type("Listener", (),
+                {"received_event": lambda s, e: events.append(e)})()
+        for eventname in ("irc.on_user_joined", "irc.on_unknown"):
+            self.boss._transport.listen_for_event(eventname, listener)
+        self.server.send("@time=2020-05-01T12:00:00.000Z "
+                ":alice!a@alice.host JOIN #test")
+        self.server.send(":fake.ircd 354 abbott 152 #test")
+        yield wait_until(lambda: len(events) == 2)
+
+        self.assertEqual({"time": "2020-05-01T12:00:00.000Z"}, events[0].tags)
+        self.assertEqual({}, events[1].tags)
+        self.assertEqual("354", events[1].command)
@@ -0,0 +1,112 @@
+from twisted.internet import defer, reactor, task
+
+from ..plugins.irc import HashRing
+from ..transport import Event
+from .fakeircd import BotTestCase, wait_until
+
+CHANNELS = ["#a", "#b", "#c", "#d"]
+RING = HashRing(2)
+
+class TestPool(BotTestCase):
+    IRC_CONFIG = {
+            "channels": CHANNELS,
+            "pool_nicks": ["abbott2"],
+            "pool_shared_channels": ["#shared"],
+            }
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(TestPool, self).setUp()
+        yield wait_until(lambda: all(factory.client is not None and
+            factory.client._registered for factory in self.ircplugin.pool))
+        yield wait_until(lambda: len(self.joined("abbott") +
+            self.joined("abbott2")) == len(CHANNELS) + 2)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        self.events = []
+        listener = type("Listener", (),
+                {"received_event": lambda s, e: self.events.append(e)})()
+        for eventname in ("irc.on_privmsg", "irc.on_user_quit"):
+            self.boss._transport.listen_for_event(eventname, listener)
+
+    def connection(self, nick):
+        return [c for c in self.server.connections if c.nick == nick][0]
+
+    def joined(self, nick):
+        return sorted(channel for line in self.connection(nick).received
+                if line.startswith("JOIN")
+                for channel in line.split()[1].split(","))
+
+    def test_sharding(self):
+        for index, nick in enumerate(["abbott", "abbott2"]):
+            self.assertEqual(sorted([c for c in CHANNELS if RING.get(c) == index]
+                + ["#shared"]), self.joined(nick))
+
+    @defer.inlineCallbacks
+    def test_events(self):
+        owned = [c for c in CHANNELS if RING.get(c) == 1][0]
+        self.server.send_to("abbott2",
+                ":bob!b@b.host PRIVMSG {0} :in a shard".format(owned))
+        for nick in ("abbott", "abbott2"):
+            self.server.send_to(nick, ":bob!b@b.host PRIVMSG #shared :shared")
+            self.server.send_to(nick, ":bob!b@b.host PRIVMSG {0} :hi".format(nick))
+            self.server.send_to(nick, ":bob!b@b.host QUIT :bye")
+        yield wait_until(lambda: len(self.events) >= 5)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+        # The two connections' lines can arrive in any order, so which one
+        # reports the quit isn't known
+        events = sorted((e.eventtype, getattr(e, "channel", None) or "",
+            e.connection) for e in self.events)
+        quits = [e for e in events if e[0] == "irc.on_user_quit"]
+        self.assertEqual(1, len(quits))
+        self.assertEqual(sorted([
+            ("irc.on_privmsg", owned, 1),
+            ("irc.on_privmsg", "#shared", RING.get("#shared")),
+            ("irc.on_privmsg", "abbott", 0),
+            ("irc.on_privmsg", "abbott2", 1),
+            ]), [e for e in events if e[0] == "irc.on_privmsg"])
+
+    @defer.inlineCallbacks
+    def test_routing(self):
+        transport = self.boss._transport
+        for channel in CHANNELS:
+            transport.send_event(Event("irc.do_say", channel=channel,
+                message="to " + channel))
+        transport.send_event(Event("irc.do_msg", user="bob", message="first"))
+        transport.send_event(Event("irc.do_msg", user="bob", message="second",
+            connection=1))
+        yield wait_until(lambda:
+                len(self.server.commands_received("PRIVMSG")) == 6)
+
+        for index, nick in enumerate(["abbott", "abbott2"]):
+            sent = [line for line in self.connection(nick).received
+                    if line.startswith("PRIVMSG")]
+            expected = ["PRIVMSG {0} :to {0}".format(c) for c in CHANNELS
+                    if RING.get(c) == index]
+            expected.append("PRIVMSG bob :" + ["first", "second"][index])
+            self.assertEqual(expected, sent)
+
+        self.assertEqual("abbott2", (yield transport.issue_request(
+            "irc.getnick", [c for c in CHANNELS if RING.get(c) == 1][0])))
+
+    @defer.inlineCallbacks
+    def test_owner_down(self):
+        plugin = self.ircplugin
+        owner = RING.get("#shared")
+        other = 1 - owner
+        client = plugin.pool[owner].client
+        plugin.pool[owner].client = None
+        try:
+            # Only the next connection on the ring takes the channel's lines
+            line = ("bob!b@b.host", "PRIVMSG", ["#shared", "hi"])
+            self.assertEqual([other], [index for index in (owner, other)
+                if plugin.accept_pooled_line(index,
+                    plugin.pool[index].client or client, *line)])
+            self.assertEqual(other, RING.get("#shared",
+                lambda node: node != owner))
+            self.assertEqual(None, RING.get("#shared", lambda node: False))
+            self.assertEqual(None, (yield self.boss._transport.issue_request(
+                "irc.getnick", connection=owner)))
+        finally:
+            plugin.pool[owner].client = client
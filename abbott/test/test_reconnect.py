@@ -0,0 +1,46 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ..plugins.irc import pack_targets
+from ..transport import Event
+from .fakeircd import BotTestCase, wait_until
+
+CHANNELS = ["#test", "#one", "#two", "#three"]
+
+class TestPackTargets(unittest.TestCase):
+    def test_fits(self):
+        channels = ["#channel-{0:03}".format(i) for i in range(100)]
+        lines = pack_targets("JOIN", channels, lambda prefix: 200)
+        self.assertTrue(len(lines) > 1)
+        self.assertTrue(all(len(line) + 2 <= 200 for line in lines))
+        self.assertEqual(channels, [c for line in lines
+            for c in line.split()[1].split(",")])
+
+        self.assertEqual(["JOIN #a,#b", "JOIN #c"],
+                pack_targets("JOIN", ["#a", "#b", "#c"], lambda p: 512, 2))
+
+class TestReconnect(BotTestCase):
+    IRC_CONFIG = {"channels": CHANNELS, "sync_interval": 0.05}
+
+    @defer.inlineCallbacks
+    def test_batched_join_and_sync(self):
+        self.assertEqual(["JOIN " + ",".join(CHANNELS)],
+                self.server.commands_received("JOIN"))
+        yield wait_until(lambda:
+                self.ircplugin.client.synced_after is not None)
+
+        events = []
+        self.boss._transport.listen_for_event("irc.on_synced",
+                type("Listener", (), {"received_event": lambda s, e: events.append(e)})())
+        client = self.ircplugin.client
+        client.synced_after = None
+        for channel in CHANNELS:
+            self.boss._transport.send_event(Event("irc.do_sync",
+                channel=channel, line="MODE " + channel))
+        # The first goes right away, the rest are spaced out
+        self.assertEqual(["MODE " + c for c in CHANNELS[1:]],
+                list(client.sync_queue))
+        yield wait_until(lambda: events)
+        self.assertEqual(["MODE " + c for c in CHANNELS],
+                self.server.commands_received("MODE"))
+        self.assertTrue(events[0].duration > 0)
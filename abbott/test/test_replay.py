@@ -0,0 +1,105 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ..plugins import irc
+from ..plugins.irc import ReplayQueue
+from ..transport import Event
+from .fakeircd import BotTestCase, wait_until
+
+class TestReplayQueue(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(irc, "time", self.clock.seconds)
+
+    def test_collapse(self):
+        queue = ReplayQueue()
+        queue.add(Event("irc.do_mode", channel="#a", set=True, modes="q",
+            mask="*!*@spam"))
+        queue.add(Event("irc.do_say", channel="#a", message="hi"))
+        queue.add(Event("irc.do_mode", channel="#A", set=False, modes="q",
+            mask="*!*@SPAM"))
+        queue.add(Event("irc.do_mode", channel="#a", set=True, modes="v",
+            user="bob"))
+        queue.add(Event("irc.do_setnick", nickname="one"))
+        queue.add(Event("irc.do_setnick", nickname="two"))
+
+        self.assertTrue(queue.pending("#A"))
+        self.assertEqual(["#a"], queue.channels())
+        events = queue.take("#a")
+        self.assertFalse(queue.pending("#a"))
+        self.assertEqual(["hi", False, True],
+                [getattr(e, "message", None) or e.set for e in events])
+        self.assertEqual(["two"], [e.nickname for e in queue.take()])
+        self.assertEqual(0, len(queue))
+
+    def test_ttl_and_bound(self):
+        queue = ReplayQueue(maxlen=2, ttl={"irc.do_notice": 10,
+            "irc.do_quit": 0}, priority={"irc.do_kick": 1})
+        queue.add(Event("irc.do_quit", message="bye"))
+        queue.add(Event("irc.do_notice", user="bob", message="old"))
+        self.clock.advance(11)
+        queue.add(Event("irc.do_kick", channel="#a", user="troll"))
+        queue.add(Event("irc.do_msg", user="bob", message="one"))
+        queue.add(Event("irc.do_msg", user="bob", message="two"))
+
+        self.assertEqual(["two"], [e.message for e in queue.take()])
+        self.assertEqual(["troll"], [e.user for e in queue.take("#a")])
+        self.assertEqual(2, queue.dropped)
+
+class TestReplay(BotTestCase):
+    @defer.inlineCallbacks
+    def test_replayed_after_registration_and_join(self):
+        client = self.ircplugin.client
+        client._registered = False
+        transport = self.boss._transport
+        transport.send_event(Event("irc.do_say", channel="#test",
+            message="to the channel"))
+        transport.send_event(Event("irc.do_msg", user="bob",
+            message="to bob"))
+        transport.send_event(Event("irc.do_say", channel="#test",
+            message="later"))
+        yield task.deferLater(irc.reactor, 0.05, lambda: None)
+        self.assertEqual([], self.server.commands_received("PRIVMSG"))
+
+        # Registering joins the channels again, and the server's JOIN echo
+        # lets the channel's messages go
+        self.server.received = []
+        self.server.send(":fake.ircd 001 abbott :Welcome back")
+        yield wait_until(lambda:
+                len(self.server.commands_received("PRIVMSG")) == 3)
+        self.assertEqual(["JOIN #test", "PRIVMSG bob :to bob",
+            "PRIVMSG #test :to the channel", "PRIVMSG #test :later"],
+            [line for line in self.server.received
+                if line.startswith(("PRIVMSG", "JOIN"))])
+
+    @defer.inlineCallbacks
+    def test_dropped_when_join_fails(self):
+        self.ircplugin.client._registered = False
+        transport = self.boss._transport
+        transport.send_event(Event("irc.do_say", channel="#closed",
+            message="held"))
+        self.ircplugin.client._registered = True
+        transport.send_event(Event("irc.do_say", channel="#closed",
+            message="behind it"))
+        self.assertEqual(2, len(self.ircplugin.replay))
+
+        self.server.send(":fake.ircd 473 abbott #closed :Cannot join channel (+i)")
+        yield wait_until(lambda: not self.ircplugin.replay.pending("#closed"))
+        self.assertEqual(0, len(self.ircplugin.replay))
+        transport.send_event(Event("irc.do_say", channel="#closed",
+            message="now"))
+        yield wait_until(lambda: self.server.commands_received("PRIVMSG"))
+        self.assertEqual(["PRIVMSG #closed :now"],
+                self.server.commands_received("PRIVMSG"))
+
+    @defer.inlineCallbacks
+    def test_unjoined_channel_sent_after_registration(self):
+        self.ircplugin.client._registered = False
+        self.boss._transport.send_event(Event("irc.do_say",
+            channel="#elsewhere", message="no need to join"))
+        self.server.received = []
+        self.server.send(":fake.ircd 001 abbott :Welcome back")
+        yield wait_until(lambda: self.server.commands_received("PRIVMSG"))
+        self.assertEqual(["PRIVMSG #elsewhere :no need to join"],
+                self.server.commands_received("PRIVMSG"))
+        self.assertFalse(self.ircplugin.replay.pending("#elsewhere"))
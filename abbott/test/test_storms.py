@@ -0,0 +1,106 @@
+from twisted.internet import defer, reactor, task
+
+from .fakeircd import BotTestCase, wait_until
+
+class Recorder(object):
+    def __init__(self):
+        self.events = []
+
+    def received_event(self, event):
+        self.events.append(event)
+
+    def of(self, eventtype):
+        return [e for e in self.events if e.eventtype == eventtype]
+
+class TestStorms(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircutil.Names", "ircutil.AccountTracker")
+    IRC_CONFIG = {"storm_window": 0.1}
+    USERS = {
+            "alice": {"user": "alice", "host": "alice.example.com"},
+            "bob": {"user": "bob", "host": "bob.example.com"},
+            }
+    CHANNELS = {"#test": ["alice", "bob"]}
+
+    def record(self, *eventtypes):
+        recorder = Recorder()
+        for eventtype in eventtypes:
+            self.boss._transport.listen_for_event(eventtype, recorder)
+        return recorder
+
+    def names(self):
+        return self.boss._transport.issue_request("irc.names", "#test")
+
+    def hostmask(self, nick):
+        return self.boss._transport.issue_request("irc.hostmask", nick)
+
+    @defer.inlineCallbacks
+    def test_mode_batch(self):
+        yield self.names()
+        recorder = self.record("irc.on_mode_change", "irc.on_mode_change_batch")
+        self.server.send(":ChanServ!cs@services. MODE #test +ov-o alice bob abbott")
+        yield wait_until(lambda: recorder.of("irc.on_mode_change_batch"))
+
+        batch, = recorder.of("irc.on_mode_change_batch")
+        self.assertEqual([(True, "o", "alice"), (True, "v", "bob"),
+            (False, "o", "abbott")], batch.changes)
+        singles = recorder.of("irc.on_mode_change")
+        self.assertEqual(3, len(singles))
+        self.assertTrue(all(e.batched for e in singles))
+        self.assertEqual(["+bob", "@alice", "abbott"], sorted((yield self.names())))
+
+        # A single change is not batched
+        self.server.send(":ChanServ!cs@services. MODE #test +v alice")
+        yield wait_until(lambda: len(recorder.of("irc.on_mode_change")) == 4)
+        self.assertFalse(recorder.of("irc.on_mode_change")[-1].batched)
+        self.assertEqual(1, len(recorder.of("irc.on_mode_change_batch")))
+
+    @defer.inlineCallbacks
+    def test_netsplit_and_netjoin(self):
+        yield self.names()
+        self.server.send(":alice!alice@alice.example.com PRIVMSG #test :hi")
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual("alice!alice@alice.example.com",
+                (yield self.hostmask("alice")))
+        recorder = self.record("irc.on_user_quit", "irc.on_netsplit",
+                "irc.on_user_joined", "irc.on_netjoin")
+        for nick in ("alice", "bob"):
+            self.server.send(":{0}!{0}@{0}.example.com QUIT "
+                    ":hub.example.net leaf.example.net".format(nick))
+        self.server.send(":carol!carol@carol.example.com QUIT :bye")
+        yield wait_until(lambda: recorder.of("irc.on_netsplit"))
+
+        split, = recorder.of("irc.on_netsplit")
+        self.assertEqual(("hub.example.net", "leaf.example.net"), split.servers)
+        self.assertEqual(["alice", "bob"], split.users)
+        quits = recorder.of("irc.on_user_quit")
+        self.assertEqual([True, True, False],
+                [getattr(e, "batched", False) for e in quits])
+        self.assertEqual(["@abbott"], sorted((yield self.names())))
+        self.assertEqual(None, (yield self.hostmask("alice")))
+
+        for nick in ("alice", "bob", "dave"):
+            self.server.send(":{0}!{0}@{0}.example.com JOIN #test".format(nick))
+        # The server gives alice back her op before the netjoin is out
+        self.server.send(":hub.example.net MODE #test +o alice")
+        yield wait_until(lambda: recorder.of("irc.on_netjoin"))
+
+        join, = recorder.of("irc.on_netjoin")
+        self.assertEqual("#test", join.channel)
+        self.assertEqual(["alice", "bob"], join.users)
+        self.assertEqual("alice!alice@alice.example.com",
+                join.joins[0]['hostmask'])
+        self.assertEqual([(True, "o")], join.joins[0]['modes'])
+        joins = recorder.of("irc.on_user_joined")
+        self.assertEqual([True, True, False],
+                [getattr(e, "batched", False) for e in joins])
+        # Names takes the users back from the netjoin, modes and all
+        self.assertEqual(["@abbott", "@alice", "bob", "dave"],
+                sorted((yield self.names())))
+        self.assertEqual("bob!bob@bob.example.com",
+                (yield self.hostmask("bob")))
+
+        # Once the netjoin is sent out, the next join starts a new one
+        self.server.send(":alice!alice@alice.example.com PART #test")
+        self.server.send(":alice!alice@alice.example.com JOIN #test")
+        yield wait_until(lambda: len(recorder.of("irc.on_netjoin")) == 2)
+        self.assertEqual(["alice"], recorder.of("irc.on_netjoin")[1].users)
@@ -0,0 +1,140 @@
+from twisted.internet import defer
+
+from ..plugins import ircutil
+from .fakeircd import BotTestCase, wait_until
+
+class WhoisTestCase(BotTestCase):
+    PLUGINS = ("irc.IRCBotPlugin", "ircutil.IRCWhois")
+
+    def setUp(self):
+        d = super(WhoisTestCase, self).setUp()
+        self.server.answer_whois = False
+        return d
+
+    def whois(self, nick):
+        return self.boss._transport.issue_request("irc.whois", nick)
+
+    def reply_user(self, nick):
+        self.server.send(":fake.ircd 311 abbott {0} {0} {0}.host * :{0}".format(nick))
+
+    def reply_end(self, nick):
+        self.server.send(":fake.ircd 318 abbott {0} :End of /WHOIS list.".format(nick))
+
+class TestWhois(WhoisTestCase):
+    PLUGIN_CONFIG = {"ircutil.IRCWhois": {"max_inflight": 2}}
+
+    @defer.inlineCallbacks
+    def test_interleaved_replies(self):
+        d1 = self.whois("alice")
+        d2 = self.whois("bob")
+        yield wait_until(lambda: len(self.server.commands_received("WHOIS")) == 2)
+
+        self.reply_user("alice")
+        self.reply_user("bob")
+        self.server.send(":fake.ircd 330 abbott bob bob_acct :is logged in as")
+        self.reply_end("bob")
+        self.reply_end("alice")
+
+        alice, bob = (yield d1), (yield d2)
+        self.assertEqual("alice.host", alice['RPL_WHOISUSER'][2])
+        self.assertNotIn("330", alice)
+        self.assertEqual("bob.host", bob['RPL_WHOISUSER'][2])
+        self.assertEqual("bob_acct", bob['330'][1])
+
+    @defer.inlineCallbacks
+    def test_coalesce_and_cache(self):
+        d1 = self.whois("alice")
+        d2 = self.whois("Alice")
+        yield wait_until(lambda: self.server.commands_received("WHOIS"))
+        self.reply_user("alice")
+        self.reply_end("alice")
+
+        self.assertEqual((yield d1), (yield d2))
+        yield self.whois("alice")
+        self.assertEqual(1, len(self.server.commands_received("WHOIS")))
+
+    @defer.inlineCallbacks
+    def test_inflight_limit(self):
+        ds = [self.whois(nick) for nick in ("a", "b", "c")]
+        yield wait_until(lambda: len(self.server.commands_received("WHOIS")) == 2)
+        self.assertEqual(["WHOIS a", "WHOIS b"], self.server.commands_received("WHOIS"))
+
+        self.server.send(":fake.ircd 401 abbott a :No such nick/channel")
+        yield self.assertFailure(ds[0], ircutil.NoSuchNick)
+        yield wait_until(lambda: len(self.server.commands_received("WHOIS")) == 3)
+
+        # The end of whois that follows the 401 must not be taken as the
+        # reply to a new whois of the same nick
+        d = self.whois("a")
+        self.reply_end("a")
+        for nick in ("b", "c", "a"):
+            self.reply_user(nick)
+            self.reply_end(nick)
+        self.assertEqual("a.host", (yield d)['RPL_WHOISUSER'][2])
+        yield ds[1]
+        yield ds[2]
+
+class TestWhoisAdmission(WhoisTestCase):
+    PLUGIN_CONFIG = {"ircutil.IRCWhois": {"max_inflight": 1,
+        "max_queued": {"op": 5, "normal": 5, "low": 1}}}
+
+    @defer.inlineCallbacks
+    def test_priority_and_shedding(self):
+        busy = self.whois("busy")
+        low = self.boss._transport.issue_request("irc.whois", "low1", priority="low")
+        yield self.assertFailure(
+                self.boss._transport.issue_request("irc.whois", "low2", priority="low"),
+                ircutil.WhoisShed)
+        op = self.boss._transport.issue_request("irc.whois", "op1", priority="op")
+
+        yield wait_until(lambda: self.server.commands_received("WHOIS"))
+        for nick in ("busy", "op1", "low1"):
+            self.reply_user(nick)
+            self.reply_end(nick)
+        yield busy
+        yield op
+        yield low
+        yield wait_until(lambda: len(self.server.commands_received("WHOIS")) == 3)
+        self.assertEqual(["WHOIS busy", "WHOIS op1", "WHOIS low1"],
+                self.server.commands_received("WHOIS"))
+
+        stats = (yield self.boss._transport.issue_request("irc.whois_stats"))
+        self.assertEqual(1, stats['shed_low'])
+        self.assertEqual(3, stats['sent'])
+        self.assertEqual(0, stats['queued_low'])
+
+class TestWhoisDeadlines(WhoisTestCase):
+    # A slow server: one whois a second, each answered just before the
+    # timeout
+    PLUGIN_CONFIG = {"ircutil.IRCWhois": {"max_inflight": 4, "rate": 1,
+        "burst": 1, "timeout": 0.6, "max_queue_wait": 1.2,
+        "max_queued": {"op": 5, "normal": 5, "low": 5}}}
+
+    @defer.inlineCallbacks
+    def test_timeout_starts_when_sent(self):
+        # More than rate * timeout requests: most of them wait longer in the
+        # queue than the timeout, but those sent in time still succeed
+        nicks = ["n{0}".format(i) for i in range(4)]
+        ds = [self.whois(nick) for nick in nicks]
+        answered = []
+        def answer(params):
+            nick = params[-1]
+            answered.append(nick)
+            self.reply_user(nick)
+            self.reply_end(nick)
+            self.server.wait_for_command("WHOIS").addCallback(answer)
+        self.server.wait_for_command("WHOIS").addCallback(answer)
+
+        results = []
+        for d in ds:
+            try:
+                results.append((yield d)['RPL_WHOISUSER'][0])
+            except ircutil.WhoisShed:
+                results.append("shed")
+        # n1 went out after a second in the queue, longer than the timeout.
+        # n2 would have after two seconds, but may only wait 1.2.
+        self.assertEqual(["n0", "n1", "shed", "shed"], results)
+        self.assertEqual(["n0", "n1"], answered)
+        stats = (yield self.boss._transport.issue_request("irc.whois_stats"))
+        self.assertEqual(2, stats['shed_normal'])
+        self.assertEqual(0, stats.get('timeouts', 0))